@@ -0,0 +1,94 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+# Бенчмарки путей чтения: python -m bench [micro|load|all] [параметры]
+#
+# Данные генерируются в новую временную БД (или в --db, если файла еще нет;
+# существующий файл используется как есть). --save-baseline FILE сохраняет
+# результаты, --baseline FILE сравнивает с ними и завершает прогон с кодом 1,
+# если p95 выросла или rps упал больше чем на --tolerance.
+# Базовая линия имеет смысл только для той же машины и тех же параметров.
+#
+# Нагрузка на живой сервер:
+#   python -m bench load --db bench.db --url http://127.0.0.1:8080
+# (сервер должен быть запущен с RANOBE_DB=bench.db).
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog='python -m bench', description='Бенчмарки Ranobe Reader')
+    parser.add_argument('mode', nargs='?', choices=['micro', 'load', 'all'], default='all')
+    parser.add_argument('--db', help='файл БД (по умолчанию - временный)')
+    parser.add_argument('--profile', default='tuned', help='профиль движка БД')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--ranobe', type=int)
+    parser.add_argument('--volumes', type=int)
+    parser.add_argument('--chapters', type=int, help='глав в томе')
+    parser.add_argument('--chapter-chars', type=int, help='символов в главе')
+    parser.add_argument('--users', type=int)
+    parser.add_argument('--comments', type=int, help='среднее число комментариев к главе')
+    parser.add_argument('--iterations', type=int, default=200, help='запросов на сценарий в micro')
+    parser.add_argument('--scenario', action='append', help='только эти сценарии micro')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10.0, help='секунд нагрузки')
+    parser.add_argument('--url', help='адрес живого сервера для load')
+    parser.add_argument('--no-cache', action='store_true', help='отключить кэш ответов')
+    parser.add_argument('--json', help='записать результаты в файл')
+    parser.add_argument('--baseline', help='сравнить с сохраненными результатами')
+    parser.add_argument('--save-baseline', help='сохранить результаты как базовую линию')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    # настройки кэша читаются при импорте модулей приложения
+    if args.no_cache:
+        os.environ['RANOBE_CACHE_SIZE'] = '0'
+
+    from data import db_session
+    from . import fixtures, runner
+
+    db_file = args.db or os.path.join(tempfile.mkdtemp(prefix='ranobe-bench-'), 'bench.db')
+    fresh = not os.path.exists(db_file)
+    db_session.global_init(db_file, args.profile)
+
+    if fresh:
+        sizes = {name: getattr(args, name) for name in fixtures.DEFAULT_SIZES if getattr(args, name) is not None}
+        print(f"Генерация данных: {dict(fixtures.DEFAULT_SIZES, **sizes)}")
+        ids = fixtures.generate(sizes, args.seed)
+    else:
+        ids = fixtures.describe()
+    print(f"Ранобе: {len(ids['ranobe_ids'])}, глав: {len(ids['chapter_ids'])}, "
+          f"комментариев: {ids['comments']}, файл БД: {db_file}")
+
+    import server
+
+    results = {}
+    if args.mode in ('micro', 'all'):
+        print("\nmicro (последовательно, тестовый клиент)")
+        results['micro'] = runner.micro(server.app, ids, args.iterations, args.scenario, args.seed)
+    if args.mode in ('load', 'all'):
+        print(f"\nload ({args.threads} потоков, {args.duration:g} с, {args.url or 'в процессе'})")
+        results['load'] = runner.load(server.app, ids, args.threads, args.duration, args.url, seed=args.seed)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as file:
+            json.dump(results, file, ensure_ascii=False, indent=2)
+    if args.save_baseline:
+        runner.save_baseline(args.save_baseline, results)
+        print(f"\nБазовая линия сохранена в {args.save_baseline}")
+    if args.baseline:
+        problems = runner.compare(runner.load_baseline(args.baseline), results, args.tolerance)
+        if problems:
+            print(f"\nРегрессии (допуск {args.tolerance:.0%}):")
+            for problem in problems:
+                print(f"  {problem}")
+            sys.exit(1)
+        print(f"\nРегрессий нет (допуск {args.tolerance:.0%})")
+
+
+if __name__ == '__main__':
+    main()
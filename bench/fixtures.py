@@ -0,0 +1,112 @@
+import datetime
+import random
+
+import sqlalchemy as sa
+from werkzeug.security import generate_password_hash
+
+from data import chapter_import, counters, db_session
+from data.chapter import Chapter
+from data.comment import Comment
+from data.ranobe import Ranobe
+from data.users import User
+from data.volume import Volume
+
+# Синтетические данные для бенчмарков.
+#
+# Все случайное берется из random.Random(seed), поэтому при одних параметрах
+# получается одна и та же БД. Главы вставляются через ChapterImporter - тем же
+# путем, что и при настоящем импорте, с поиском, порядком чтения и счетчиками.
+
+DEFAULT_SIZES = {
+    'ranobe': 10,
+    'volumes': 3,
+    'chapters': 20,
+    'chapter_chars': 20000,
+    'users': 50,
+    'comments': 30,
+}
+PASSWORD = 'bench'
+
+_SYLLABLES = ('ка', 'ло', 'ми', 'ра', 'то', 'не', 'ви', 'да', 'су', 'ре', 'на', 'ко', 'ли', 'ше', 'мо',
+              'ту', 'ба', 'ги', 'зе', 'по', 'ны', 'ха', 'ю', 'я', 'ст', 'пр', 'ен', 'ов', 'ий')
+
+
+def _word(rng):
+    return ''.join(rng.choice(_SYLLABLES) for _ in range(rng.randint(1, 4)))
+
+
+def _sentence(rng):
+    words = [_word(rng) for _ in range(rng.randint(4, 16))]
+    return words[0].capitalize() + ' ' + ' '.join(words[1:]) + rng.choice('..!?')
+
+
+# текст примерно из chars символов, разбитый на абзацы
+def _text(rng, chars):
+    paragraphs, size = [], 0
+    while size < chars:
+        paragraph = ' '.join(_sentence(rng) for _ in range(rng.randint(2, 7)))
+        paragraphs.append(paragraph)
+        size += len(paragraph) + 2
+    return '\n\n'.join(paragraphs)
+
+
+# заполнить БД, уже подключенную через db_session.global_init;
+# возвращает id созданных сущностей для построения адресов
+def generate(sizes=None, seed=1):
+    sizes = {**DEFAULT_SIZES, **(sizes or {})}
+    rng = random.Random(seed)
+    start = datetime.datetime(2024, 1, 1)
+
+    db_sess = db_session.create_session()
+    try:
+        # хэш пароля дорогой - считаем один раз на всех
+        hashed_password = generate_password_hash(PASSWORD)
+        db_sess.execute(User.__table__.insert(), [
+            {'username': f'bench{i}', 'email': f'bench{i}@example.com', 'hashed_password': hashed_password,
+             'avatar': 'default.jpg', 'is_admin': False, 'created_date': start}
+            for i in range(sizes['users'])
+        ])
+        db_sess.commit()
+        user_ids = [id for id, in db_sess.query(User.id).order_by(User.id)]
+
+        for n in range(sizes['ranobe']):
+            ranobe = Ranobe(title=f'{_word(rng).capitalize()} {_word(rng)} {n + 1}',
+                            description=_text(rng, 600), author_id=rng.choice(user_ids))
+            db_sess.add(ranobe)
+            db_sess.commit()
+
+            items = ({'title': _sentence(rng)[:60], 'content': _text(rng, sizes['chapter_chars']),
+                      'volume_number': volume + 1, 'chapter_number': chapter + 1}
+                     for volume in range(sizes['volumes']) for chapter in range(sizes['chapters']))
+            chapter_import.ChapterImporter(db_sess, ranobe.id).run(items)
+
+        chapter_ids = [id for id, in db_sess.query(Chapter.id).order_by(Chapter.id)]
+        comments = [
+            {'content': _sentence(rng), 'user_id': rng.choice(user_ids), 'chapter_id': chapter_id,
+             'created_date': start + datetime.timedelta(minutes=rng.randint(0, 500000))}
+            for chapter_id in chapter_ids for _ in range(rng.randint(0, 2 * sizes['comments']))
+        ]
+        for i in range(0, len(comments), 5000):
+            db_sess.execute(Comment.__table__.insert(), comments[i:i + 5000])
+        counters.recompute(db_sess.connection())
+        db_sess.commit()
+    finally:
+        db_sess.close()
+    return describe()
+
+
+# id сущностей уже заполненной БД - для повторных прогонов на том же файле
+def describe():
+    db_sess = db_session.create_session()
+    try:
+        volumes = db_sess.query(Volume.ranobe_id, Volume.volume_number).order_by(Volume.id).all()
+        return {
+            'ranobe_ids': [id for id, in db_sess.query(Ranobe.id).order_by(Ranobe.id)],
+            'chapter_ids': [id for id, in db_sess.query(Chapter.id).order_by(Chapter.id)],
+            'volumes': [tuple(volume) for volume in volumes],
+            'chapters_per_volume': db_sess.query(sa.func.min(Volume.chapter_count)).scalar() or 1,
+            'users': db_sess.query(sa.func.count(User.id)).scalar(),
+            'comments': db_sess.query(sa.func.count(Comment.id)).scalar(),
+        }
+    finally:
+        db_sess.close()
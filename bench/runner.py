@@ -0,0 +1,175 @@
+import http.client
+import json
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+from .scenarios import SCENARIOS, LOAD_MIX, weighted
+
+# Прогоны и отчеты.
+#
+# micro - каждый сценарий отдельно, последовательно, через тестовый клиент Flask:
+# чистое время обработки без сети. load - несколько потоков в течение заданного
+# времени шлют смесь запросов LOAD_MIX либо в приложение в этом же процессе,
+# либо на живой сервер (--url, например gunicorn). Результаты: задержки в мс
+# (p50/p95/p99) и запросов в секунду.
+
+# сравнение с базовой линией: разница меньше этого числа мс - шум
+ABSOLUTE_SLACK_MS = 0.5
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, round(p / 100 * (len(ordered) - 1)))]
+
+
+def summarize(latencies, elapsed=None, errors=0):
+    ordered = sorted(latencies)
+    result = {
+        'count': len(ordered),
+        'errors': errors,
+        'mean': round(sum(ordered) / len(ordered), 3) if ordered else 0.0,
+        'p50': round(percentile(ordered, 50), 3),
+        'p95': round(percentile(ordered, 95), 3),
+        'p99': round(percentile(ordered, 99), 3),
+        'max': round(ordered[-1], 3) if ordered else 0.0,
+    }
+    if elapsed:
+        result['rps'] = round(len(ordered) / elapsed, 1)
+    return result
+
+
+class _AppClient:
+    def __init__(self, app):
+        self._client = app.test_client()
+
+    def get(self, url):
+        response = self._client.get(url)
+        response.get_data()
+        return response.status_code
+
+
+class _HttpClient:
+    def __init__(self, base_url):
+        parts = urlsplit(base_url)
+        self._connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+
+    def get(self, url):
+        self._connection.request('GET', url)
+        response = self._connection.getresponse()
+        response.read()
+        return response.status
+
+
+def _client(app, base_url):
+    return _HttpClient(base_url) if base_url else _AppClient(app)
+
+
+def _timed_get(client, url):
+    start = time.perf_counter()
+    status = client.get(url)
+    return (time.perf_counter() - start) * 1000, status < 400
+
+
+def micro(app, ids, iterations=200, scenarios=None, seed=1, warmup=10, progress=print):
+    results = {}
+    for name in scenarios or SCENARIOS:
+        rng = random.Random(seed)
+        client = _client(app, None)
+        build = SCENARIOS[name]
+        for _ in range(warmup):
+            client.get(build(rng, ids))
+
+        latencies, errors = [], 0
+        for _ in range(iterations):
+            elapsed, ok = _timed_get(client, build(rng, ids))
+            latencies.append(elapsed)
+            errors += not ok
+        results[name] = summarize(latencies, errors=errors)
+        progress(format_row(name, results[name]))
+    return results
+
+
+def load(app, ids, threads=8, duration=10.0, base_url=None, mix=None, seed=1, progress=print):
+    names = weighted(mix or LOAD_MIX)
+    latencies = {name: [] for name in set(names)}
+    errors = {name: 0 for name in set(names)}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker(number):
+        rng = random.Random(seed * 1000 + number)
+        client = _client(app, base_url)
+        own = {name: [] for name in latencies}
+        own_errors = {name: 0 for name in latencies}
+        while time.perf_counter() < deadline:
+            name = rng.choice(names)
+            try:
+                elapsed, ok = _timed_get(client, SCENARIOS[name](rng, ids))
+            except (OSError, http.client.HTTPException):
+                own_errors[name] += 1
+                client = _client(app, base_url)
+                continue
+            own[name].append(elapsed)
+            own_errors[name] += not ok
+        with lock:
+            for name in latencies:
+                latencies[name] += own[name]
+                errors[name] += own_errors[name]
+
+    started = time.perf_counter()
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    results = {name: summarize(values, elapsed, errors[name]) for name, values in sorted(latencies.items())}
+    results['total'] = summarize([v for values in latencies.values() for v in values], elapsed,
+                                 sum(errors.values()))
+    for name, result in results.items():
+        progress(format_row(name, result))
+    return results
+
+
+def format_row(name, result):
+    row = (f"{name:24} n={result['count']:<6} p50={result['p50']:8.2f} p95={result['p95']:8.2f} "
+           f"p99={result['p99']:8.2f} мс")
+    if 'rps' in result:
+        row += f"  {result['rps']:8.1f} rps"
+    if result['errors']:
+        row += f"  ошибок: {result['errors']}"
+    return row
+
+
+# Базовая линия
+
+def save_baseline(path, results):
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(results, file, ensure_ascii=False, indent=2, sort_keys=True)
+
+
+# регрессии относительно сохраненных результатов: p95 выросла или rps упал
+# больше чем на долю tolerance; возвращает список описаний
+def compare(baseline, results, tolerance=0.25):
+    problems = []
+    for kind, scenarios in results.items():
+        for name, current in scenarios.items():
+            base = baseline.get(kind, {}).get(name)
+            if base is None:
+                continue
+            if current['p95'] > base['p95'] * (1 + tolerance) + ABSOLUTE_SLACK_MS:
+                problems.append(f"{kind}/{name}: p95 {base['p95']:.2f} -> {current['p95']:.2f} мс")
+            if 'rps' in base and 'rps' in current and current['rps'] < base['rps'] * (1 - tolerance):
+                problems.append(f"{kind}/{name}: {base['rps']:.1f} -> {current['rps']:.1f} rps")
+            if current['errors'] > base.get('errors', 0):
+                problems.append(f"{kind}/{name}: ошибок {base.get('errors', 0)} -> {current['errors']}")
+    return problems
+
+
+def load_baseline(path):
+    with open(path, encoding='utf-8') as file:
+        return json.load(file)
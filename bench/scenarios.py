@@ -0,0 +1,39 @@
+# Адреса, которые меряют бенчмарки, - пути чтения сайта.
+# Каждый сценарий по объекту random.Random и id из fixtures.generate() строит адрес.
+
+SCENARIOS = {
+    'index': lambda rng, ids: '/',
+    'ranobe_page': lambda rng, ids: f'/ranobe/{rng.choice(ids["ranobe_ids"])}',
+    'chapter_page': lambda rng, ids: f'/chapter/{rng.choice(ids["chapter_ids"])}',
+    'api_ranobe': lambda rng, ids: '/api/ranobe',
+    'api_chapter': lambda rng, ids: f'/api/chapters/{rng.choice(ids["chapter_ids"])}',
+    'api_chapter_content': lambda rng, ids: f'/api/chapters/{rng.choice(ids["chapter_ids"])}/content',
+    'api_chapter_by_number': lambda rng, ids: _chapter_by_number(rng, ids),
+    'api_chapter_batch': lambda rng, ids: _chapter_batch(rng, ids),
+    'api_comments': lambda rng, ids: f'/api/chapters/{rng.choice(ids["chapter_ids"])}/comments',
+}
+
+# сценарии нагрузочного прогона и их доли в смеси запросов
+LOAD_MIX = {
+    'index': 2,
+    'chapter_page': 5,
+    'api_ranobe': 2,
+    'api_chapter': 2,
+    'api_chapter_content': 3,
+    'api_chapter_batch': 1,
+}
+
+
+def _chapter_by_number(rng, ids):
+    ranobe_id, volume_number = rng.choice(ids['volumes'])
+    chapter_number = rng.randint(1, ids['chapters_per_volume'])
+    return f'/api/ranobe/{ranobe_id}/volumes/{volume_number}/chapters/{chapter_number}'
+
+
+def _chapter_batch(rng, ids):
+    ranobe_id = rng.choice(ids['ranobe_ids'])
+    return f'/api/ranobe/{ranobe_id}/chapters?from={rng.randint(1, ids["chapters_per_volume"])}&count=5'
+
+
+def weighted(mix):
+    return [name for name, weight in mix.items() for _ in range(weight)]
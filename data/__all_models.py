@@ -2,6 +2,10 @@ from .users import User
 from .ranobe import Ranobe
 from .volume import Volume
 from .chapter import Chapter
+from .chapter_pages import ChapterPage
 from .comment import Comment
+from .reading_progress import ReadingProgress
+from .deletion import DeletionJob
+from .changes import Change
 
-__all__ = ['User', 'Ranobe', 'Volume', 'Chapter', 'Comment']
+__all__ = ['User', 'Ranobe', 'Volume', 'Chapter', 'ChapterPage', 'Comment', 'ReadingProgress', 'DeletionJob', 'Change']
@@ -0,0 +1,212 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+import sqlalchemy as sa
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from . import db_session
+from .cache import LRUCache
+from .users import PASSWORD_METHOD, User
+
+# Вход и загрузка пользователя.
+#
+# load_user вызывается на каждый запрос авторизованного пользователя, поэтому
+# пользователи кэшируются в памяти процесса на USER_CACHE_TTL секунд; изменение
+# или удаление пользователя через ORM сразу убирает его из кэша этого процесса,
+# остальные процессы увидят изменение по истечении срока.
+#
+# Проверка и вычисление хэша пароля (PBKDF2) занимают процессор на десятки
+# миллисекунд, поэтому идут в отдельном пуле из PASSWORD_WORKERS потоков с
+# очередью не длиннее PASSWORD_QUEUE: поток с массовым подбором паролей упирается
+# в пул и не отнимает процессор у читателей. Перед проверкой действуют лимиты
+# неудачных попыток с одного IP и на один аккаунт - отклоненная попытка хэш не
+# считает, а успешные входы (много пользователей за одним NAT) лимит не тратят.
+# Хэш со старыми параметрами пересчитывается после успешного входа. Для
+# неизвестного email пароль сверяется с заранее посчитанным хэшем случайной
+# строки, чтобы по времени ответа нельзя было узнать, зарегистрирован ли адрес.
+# Email сравнивается без учета регистра (индекс ix_users_email_lower).
+#
+# IP клиента за обратным прокси берется из X-Forwarded-For (RANOBE_PROXY_HOPS в server.py).
+
+USER_CACHE_TTL = int(os.environ.get('RANOBE_USER_CACHE_TTL', 60))
+USER_CACHE_SIZE = int(os.environ.get('RANOBE_USER_CACHE_SIZE', 10000))
+
+PASSWORD_WORKERS = int(os.environ.get('RANOBE_PASSWORD_WORKERS', 2))
+PASSWORD_QUEUE = int(os.environ.get('RANOBE_PASSWORD_QUEUE', 16))
+PASSWORD_TIMEOUT = 10
+
+# (неудачных попыток, за секунд)
+IP_LIMIT = (20, 300)
+ACCOUNT_LIMIT = (5, 900)
+
+
+class LoginRateLimited(Exception):
+    pass
+
+
+class PasswordPoolBusy(Exception):
+    pass
+
+
+# Кэш пользователей
+
+_users = LRUCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+
+def load_user(user_id):
+    user_id = int(user_id)
+    user = _users.get(user_id)
+    if user is not None:
+        return user
+
+    db_sess = db_session.create_session()
+    try:
+        user = db_sess.query(User).get(user_id)
+        if user is not None:
+            db_sess.expunge(user)
+            _users.set(user_id, user)
+        return user
+    finally:
+        db_sess.close()
+
+
+def invalidate_user(user_id):
+    _users.delete(user_id)
+
+
+@sa.event.listens_for(User, 'after_update')
+@sa.event.listens_for(User, 'after_delete')
+def _user_changed(mapper, connection, target):
+    invalidate_user(target.id)
+
+
+# Пул для хэшей паролей
+
+_lock = threading.Lock()
+_executor = None
+_executor_pid = None
+_slots = threading.BoundedSemaphore(PASSWORD_WORKERS + PASSWORD_QUEUE)
+
+
+def _pool():
+    global _executor, _executor_pid
+    with _lock:
+        # после fork пул родителя без потоков - создаем свой
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(PASSWORD_WORKERS, thread_name_prefix='password')
+            _executor_pid = os.getpid()
+        return _executor
+
+
+# выполнить функцию в пуле и дождаться результата; если очередь полна или результата
+# нет за PASSWORD_TIMEOUT секунд - PasswordPoolBusy (задача дорабатывает в пуле и освобождает место)
+def run_hashing(function, *args):
+    if not _slots.acquire(blocking=False):
+        raise PasswordPoolBusy()
+    try:
+        future = _pool().submit(function, *args)
+    except Exception:
+        _slots.release()
+        raise
+    future.add_done_callback(lambda f: _slots.release())
+    try:
+        return future.result(PASSWORD_TIMEOUT)
+    except FutureTimeoutError:
+        raise PasswordPoolBusy()
+
+
+# Лимиты попыток
+
+class RateLimiter:
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self._hits = {}
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+
+    def _recent(self, key, now):
+        hits = self._hits.get(key)
+        if hits is None:
+            return None
+        while hits and hits[0] <= now - self.window:
+            hits.popleft()
+        if not hits:
+            del self._hits[key]
+            return None
+        return hits
+
+    # раз в окно выбрасываются ключи без свежих попыток, чтобы словарь не рос
+    def _sweep(self, now):
+        if now - self._last_sweep < self.window:
+            return
+        self._last_sweep = now
+        for key in list(self._hits):
+            self._recent(key, now)
+
+    def allowed(self, key):
+        with self._lock:
+            hits = self._recent(key, time.monotonic())
+            return hits is None or len(hits) < self.limit
+
+    def hit(self, key):
+        now = time.monotonic()
+        with self._lock:
+            self._sweep(now)
+            self._hits.setdefault(key, deque()).append(now)
+
+    def reset(self, key):
+        with self._lock:
+            self._hits.pop(key, None)
+
+
+_ip_failures = RateLimiter(*IP_LIMIT)
+_account_failures = RateLimiter(*ACCOUNT_LIMIT)
+
+
+# Вход
+
+_dummy_hash = generate_password_hash(os.urandom(16).hex(), PASSWORD_METHOD)
+
+
+# email в том виде, в каком он хранится и сравнивается
+def normalize_email(email):
+    return (email or '').strip().lower()
+
+# пользователь по email и паролю или None; LoginRateLimited - лимит попыток исчерпан,
+# PasswordPoolBusy - пул проверки паролей перегружен
+def authenticate(email, password, ip):
+    account = normalize_email(email)
+    if not _ip_failures.allowed(ip) or not _account_failures.allowed(account):
+        raise LoginRateLimited()
+
+    db_sess = db_session.create_session()
+    try:
+        user = db_sess.query(User).filter(sa.func.lower(User.email) == account).first()
+        password_hash = user.hashed_password if user is not None else _dummy_hash
+        if not run_hashing(check_password_hash, password_hash, password) or user is None:
+            _ip_failures.hit(ip)
+            _account_failures.hit(account)
+            return None
+        _account_failures.reset(account)
+
+        if user.password_needs_rehash():
+            try:
+                set_password(user, password)
+                db_sess.commit()
+                db_sess.refresh(user)
+            except PasswordPoolBusy:
+                # пересчитаем при следующем входе
+                db_sess.rollback()
+        db_sess.expunge(user)
+        return user
+    finally:
+        db_sess.close()
+
+
+# то же, что User.set_password, но хэш считается в пуле
+def set_password(user, password):
+    user.hashed_password = run_hashing(generate_password_hash, password, PASSWORD_METHOD)
@@ -0,0 +1,208 @@
+import hashlib
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+from . import db_session
+from .users import User
+
+# Обработка аватаров.
+#
+# Загрузка декодируется, поворачивается по EXIF и пересохраняется квадратными
+# миниатюрами SIZES в WebP и JPEG (для браузеров без WebP). Метаданные в
+# миниатюры не переносятся, оригинал не хранится.
+# Файлы называются по хэшу содержимого загрузки: одинаковые картинки хранятся
+# один раз, а сами файлы никогда не меняются и отдаются с вечным кэшем.
+# В User.avatar записывается только хэш; старые значения - имя файла с
+# расширением - отдаются как есть.
+# Миниатюры строятся в пуле потоков (Pillow отпускает GIL на декодировании и
+# сжатии), регистрация их не ждет: пользователь получает аватар по умолчанию,
+# а хэш записывается ему только после успешной обработки (assign) - ссылки на
+# еще не созданные или так и не созданные файлы не появляются. Без пакета
+# Pillow загрузка сохраняется как есть, но тоже под именем из хэша.
+
+AVATAR_DIR = os.path.join('static', 'uploads', 'avatars')
+DEFAULT_AVATAR = 'default.jpg'
+SIZES = (64, 256)
+FORMATS = (
+    ('webp', 'WEBP', {'quality': 80, 'method': 4}),
+    ('jpg', 'JPEG', {'quality': 85, 'optimize': True, 'progressive': True}),
+)
+MAX_BYTES = 10 * 1024 * 1024
+MAX_PIXELS = 40_000_000
+WORKERS = int(os.environ.get('RANOBE_AVATAR_WORKERS', 2))
+
+# имена файлов, которые никогда не перезаписываются другим содержимым
+HASHED_NAME = re.compile(r'[0-9a-f]{32}(-\d+)?\.\w+')
+_DIGEST = re.compile(r'[0-9a-f]{32}')
+
+_lock = threading.Lock()
+_executor = None
+_executor_pid = None
+_pending = {}
+
+
+class AvatarError(ValueError):
+    pass
+
+
+def is_hashed(filename):
+    return HASHED_NAME.fullmatch(filename) is not None
+
+
+# файл аватара нужного размера: миниатюра для хэша, исходный файл для старых значений
+# (у них нет WebP - тогда None)
+def filename(avatar, size=SIZES[0], ext='jpg'):
+    if avatar and _DIGEST.fullmatch(avatar):
+        return f'{avatar}-{size}.{ext}'
+    return (avatar or DEFAULT_AVATAR) if ext == 'jpg' else None
+
+
+def _path(digest, size, ext):
+    return os.path.join(AVATAR_DIR, f'{digest}-{size}.{ext}')
+
+
+def _ready(digest):
+    return all(os.path.exists(_path(digest, size, ext)) for size in SIZES for ext, _, _ in FORMATS)
+
+
+# запись через временный файл: читатели не увидят недописанную картинку
+def _write(path, write):
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wb') as file:
+        write(file)
+    os.replace(tmp_path, path)
+
+
+# в потоке запроса проверяется только заголовок, без декодирования пикселей
+def _check(data):
+    try:
+        image = Image.open(BytesIO(data))
+        image.verify()
+    except Exception:
+        raise AvatarError('Не удалось прочитать изображение')
+    width, height = image.size
+    if width * height > MAX_PIXELS:
+        raise AvatarError('Слишком большое изображение')
+
+
+def _to_rgb(image):
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+# построить все миниатюры; синхронно - для пула и manage.py
+def render(data, digest):
+    image = Image.open(BytesIO(data))
+    image = _to_rgb(ImageOps.exif_transpose(image))
+    for size in SIZES:
+        thumbnail = ImageOps.fit(image, (size, size), Image.LANCZOS)
+        for ext, format, options in FORMATS:
+            _write(_path(digest, size, ext), lambda file: thumbnail.save(file, format, **options))
+
+
+def _pool():
+    global _executor, _executor_pid
+    # после fork пул родителя без потоков - создаем свой
+    if _executor is None or _executor_pid != os.getpid():
+        _executor = ThreadPoolExecutor(WORKERS, thread_name_prefix='avatar')
+        _executor_pid = os.getpid()
+        _pending.clear()
+    return _executor
+
+
+def _done(digest, future):
+    with _lock:
+        _pending.pop(digest, None)
+    error = future.exception()
+    if error is not None:
+        print(f"Не удалось обработать аватар {digest}: {error}")
+
+
+def _submit(data, digest):
+    with _lock:
+        pool = _pool()
+        future = _pending.get(digest)
+        if future is None:
+            future = _pending[digest] = pool.submit(render, data, digest)
+            future.add_done_callback(lambda f: _done(digest, f))
+    return future
+
+
+# сохранить загруженный аватар (FileStorage); возвращает значение для User.avatar
+def save(upload):
+    data = upload.read(MAX_BYTES + 1)
+    if len(data) > MAX_BYTES:
+        raise AvatarError('Файл больше 10 МБ')
+    digest = hashlib.sha256(data).hexdigest()[:32]
+
+    if Image is None:
+        ext = os.path.splitext(upload.filename or '')[1].lower().lstrip('.')
+        name = f'{digest}.{ext if ext.isalnum() else "img"}'
+        path = os.path.join(AVATAR_DIR, name)
+        if not os.path.exists(path):
+            _write(path, lambda file: file.write(data))
+        return name
+
+    _check(data)
+    if not _ready(digest):
+        _submit(data, digest)
+    return digest
+
+
+def _set_avatar(user_id, avatar):
+    db_sess = db_session.create_session()
+    try:
+        user = db_sess.query(User).get(user_id)
+        # пока шла обработка, аватар могли сменить иначе - тогда не трогаем
+        if user is not None and user.avatar == DEFAULT_AVATAR:
+            user.avatar = avatar
+            db_sess.commit()
+    finally:
+        db_sess.close()
+
+
+def _assign_when_done(user_id, avatar, future):
+    if future.exception() is None:
+        _set_avatar(user_id, avatar)
+
+
+# записать пользователю аватар из save(), когда его файлы готовы: сразу или после
+# обработки в пуле; если обработка не удалась, остается аватар по умолчанию
+def assign(user_id, avatar):
+    with _lock:
+        future = _pending.get(avatar)
+    if future is not None:
+        future.add_done_callback(lambda f: _assign_when_done(user_id, avatar, f))
+    elif not _DIGEST.fullmatch(avatar) or _ready(avatar):
+        _set_avatar(user_id, avatar)
+
+
+# дождаться обработки аватара, если она еще идет
+def wait(digest, timeout=None):
+    with _lock:
+        future = _pending.get(digest)
+    if future is not None:
+        future.result(timeout)
+
+
+# перевести старый аватар (исходный файл) на миниатюры; возвращает хэш
+def convert(path):
+    with open(path, 'rb') as file:
+        data = file.read()
+    digest = hashlib.sha256(data).hexdigest()[:32]
+    _check(data)
+    if not _ready(digest):
+        render(data, digest)
+    return digest
@@ -0,0 +1,42 @@
+import os
+import threading
+
+# Периодическая фоновая запись накопленных в памяти данных.
+#
+# Поток создается при первом обращении - и заново в дочернем процессе после
+# fork (рабочие процессы gunicorn), потому что потоки родителя туда не переходят.
+
+
+class PeriodicFlusher:
+    def __init__(self, name, flush, interval):
+        self.name = name
+        self.flush = flush
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def start(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    # сбросить сейчас, не дожидаясь таймера
+    def wake(self):
+        self.start()
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Фоновая запись {self.name} не удалась: {e}")
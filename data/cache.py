@@ -0,0 +1,281 @@
+import os
+import pickle
+import threading
+import time
+import uuid
+from collections import OrderedDict, namedtuple
+
+from .chapter import Chapter
+from .volume import Volume
+
+# Кэш готовых ответов.
+#
+# Первый уровень - LRU в памяти процесса с TTL и ограничением числа записей.
+# Второй (необязательный) - общий для всех процессов бэкенд, например Redis:
+# любой объект с методами get/set/delete/delete_prefix.
+# Маршруты на запись удаляют ровно те ключи, которые зависят от измененной сущности
+# (см. chapter_keys, ranobe_keys и функции invalidate_* ниже).
+#
+# Записи о главах и томах привязаны к поколению своего ранобе (put(..., ranobe_id=)):
+# смена поколения разом делает их все устаревшими, не перечисляя глав. Поколение
+# хранится в общем уровне, если он есть, иначе в памяти процесса.
+#
+# Без общего уровня удаление ключей доходит только до процесса, который
+# обработал запись, поэтому несколько рабочих процессов gunicorn требуют Redis
+# (см. gunicorn.conf.py). С Redis первый уровень других процессов может отдать
+# удаленную запись еще LOCAL_TTL секунд - это граница отставания.
+
+
+class LRUCache:
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            expires, value = item
+            if expires < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (time.monotonic() + (ttl or self.ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_prefix(self, prefix):
+        with self._lock:
+            for key in [key for key in self._data if key.startswith(prefix)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {'size': len(self._data), 'maxsize': self.maxsize,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+# общий кэш в Redis; пакет redis нужен только если он включен
+class RedisBackend:
+    def __init__(self, url, namespace='ranobe:'):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.namespace = namespace
+
+    def get(self, key):
+        raw = self.client.get(self.namespace + key)
+        return pickle.loads(raw) if raw is not None else None
+
+    def set(self, key, value, ttl):
+        self.client.set(self.namespace + key, pickle.dumps(value), ex=ttl)
+
+    def delete(self, key):
+        self.client.delete(self.namespace + key)
+
+    def delete_prefix(self, prefix):
+        keys = list(self.client.scan_iter(match=self.namespace + prefix + '*'))
+        if keys:
+            self.client.delete(*keys)
+
+
+# значение, действительное, пока не сменилось поколение ранобе
+Scoped = namedtuple('Scoped', 'ranobe_id generation value')
+
+
+class ResponseCache:
+    def __init__(self, local, shared=None, ttl=None):
+        self.local = local
+        self.shared = shared
+        self.ttl = ttl or local.ttl
+        self.shared_hits = 0
+        self.shared_misses = 0
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is not None or self.shared is None:
+            return value
+
+        value = self.shared.get(key)
+        if value is None:
+            self.shared_misses += 1
+            return None
+        self.shared_hits += 1
+        self.local.set(key, value)
+        return value
+
+    def set(self, key, value):
+        self.local.set(key, value)
+        if self.shared is not None:
+            self.shared.set(key, value, self.ttl)
+
+    # текущее поколение по ключу; пропавшее (вытесненное, истекшее) заменяется
+    # новым, и все записи старого поколения становятся устаревшими
+    def generation(self, key):
+        backend = self.shared if self.shared is not None else self.local
+        value = backend.get(key)
+        if value is None:
+            value = uuid.uuid4().hex
+            backend.set(key, value, self.ttl)
+        return value
+
+    def invalidate(self, keys=(), prefixes=()):
+        for backend in (self.local, self.shared):
+            if backend is None:
+                continue
+            for key in keys:
+                backend.delete(key)
+            for prefix in prefixes:
+                backend.delete_prefix(prefix)
+
+    def stats(self):
+        stats = dict(self.local.stats())
+        if self.shared is not None:
+            stats.update(shared_hits=self.shared_hits, shared_misses=self.shared_misses)
+        return stats
+
+
+TTL = int(os.environ.get('RANOBE_CACHE_TTL', 300))
+LOCAL_TTL = int(os.environ.get('RANOBE_CACHE_LOCAL_TTL', 2))
+REDIS_URL = os.environ.get('RANOBE_CACHE_REDIS_URL')
+
+
+def _from_env():
+    size = int(os.environ.get('RANOBE_CACHE_SIZE', 2048))
+    if not REDIS_URL:
+        return ResponseCache(LRUCache(size, TTL))
+    return ResponseCache(LRUCache(size, min(LOCAL_TTL, TTL)), RedisBackend(REDIS_URL), TTL)
+
+
+_cache = _from_env()
+
+
+# заменить кэш целиком (например, на другой общий бэкенд)
+def configure(local, shared=None):
+    global _cache
+    _cache = ResponseCache(local, shared)
+    return _cache
+
+
+def get(key):
+    value = _cache.get(key)
+    if isinstance(value, Scoped):
+        if value.generation != _cache.generation(ranobe_generation_key(value.ranobe_id)):
+            return None
+        return value.value
+    return value
+
+
+# ranobe_id - запись устаревает вместе с поколением этого ранобе (см. ranobe_keys)
+def put(key, value, ranobe_id=None):
+    if ranobe_id is not None:
+        value = Scoped(ranobe_id, _cache.generation(ranobe_generation_key(ranobe_id)), value)
+    _cache.set(key, value)
+
+
+def invalidate(keys=(), prefixes=()):
+    _cache.invalidate(keys, prefixes)
+
+
+def stats():
+    return _cache.stats()
+
+
+# Ключи
+
+CATALOGUE_PREFIXES = ('ranobe-list:', 'page:index:')
+
+
+def chapter_key(chapter_id):
+    return f'chapter:{chapter_id}'
+
+
+def chapter_by_number_key(ranobe_id, volume_number, chapter_number):
+    return f'chapter-by-number:{ranobe_id}:{volume_number}:{chapter_number}'
+
+
+def volume_chapters_key(ranobe_id, volume_number):
+    return f'volume-chapters:{ranobe_id}:{volume_number}'
+
+
+def page_key(name, id):
+    return f'page:{name}:{id}'
+
+
+def ranobe_generation_key(ranobe_id):
+    return f'ranobe-generation:{ranobe_id}'
+
+
+# ключи, зависящие от всего ранобе (название, состав): его страница, страницы томов
+# и поколение, к которому привязаны записи о главах и списки глав томов
+def ranobe_keys(db_sess, ranobe_id):
+    keys = [ranobe_generation_key(ranobe_id), page_key('ranobe', ranobe_id)]
+    keys += [page_key('volume', id) for id, in db_sess.query(Volume.id).filter(Volume.ranobe_id == ranobe_id)]
+    return keys
+
+
+# ключи, зависящие от одной главы: ее страница и записи API, те же записи соседей
+# по порядку чтения (в них ссылки на нее), список глав ее тома, страницы тома и
+# ранобе. Номер и соседи главы могут измениться, поэтому при правке ключи берутся
+# и до записи, и после нее
+def chapter_keys(db_sess, chapter_id):
+    chapter = db_sess.query(Chapter.ranobe_id, Chapter.reading_order, Chapter.volume_id) \
+        .filter(Chapter.id == chapter_id) \
+        .first()
+    if not chapter:
+        return []
+
+    rows = db_sess.query(Chapter.id, Chapter.chapter_number, Volume.volume_number) \
+        .join(Volume, Chapter.volume_id == Volume.id) \
+        .filter(Chapter.ranobe_id == chapter.ranobe_id)
+    if chapter.reading_order is None:
+        rows = rows.filter(Chapter.id == chapter_id)
+    else:
+        position = chapter.reading_order
+        rows = rows.filter(Chapter.reading_order.between(position - 1, position + 1))
+
+    keys = [page_key('ranobe', chapter.ranobe_id), page_key('volume', chapter.volume_id)]
+    for row in rows:
+        keys += [page_key('chapter', row.id), chapter_key(row.id),
+                 chapter_by_number_key(chapter.ranobe_id, row.volume_number, row.chapter_number)]
+        if row.id == chapter_id:
+            keys.append(volume_chapters_key(chapter.ranobe_id, row.volume_number))
+    return keys
+
+
+def invalidate_catalogue():
+    invalidate(prefixes=CATALOGUE_PREFIXES)
+
+
+# страницы, на которых видно число комментариев главы: сама глава, ее том и ранобе
+def invalidate_comments(db_sess, chapter_id):
+    keys = [page_key('chapter', chapter_id)]
+    row = db_sess.query(Chapter.volume_id, Volume.ranobe_id) \
+        .join(Volume, Chapter.volume_id == Volume.id) \
+        .filter(Chapter.id == chapter_id) \
+        .first()
+    if row:
+        keys += [page_key('volume', row.volume_id), page_key('ranobe', row.ranobe_id)]
+    invalidate(keys=keys)
@@ -0,0 +1,126 @@
+import datetime
+
+import sqlalchemy as sa
+
+from . import pagination
+from .chapter import Chapter
+from .db_session import SqlAlchemyBase
+from .ranobe import Ranobe
+from .volume import Volume
+
+# Лента изменений для синхронизации зеркал и читалок (/api/changes).
+#
+# В таблице changes на каждое ранобе, том и главу - одна строка о последнем
+# изменении: любая запись заменяет ее новой (INSERT OR REPLACE), и строка
+# получает следующий номер. AUTOINCREMENT гарантирует, что номера не
+# переиспользуются, а SQLite пропускает писателей по одному, поэтому номера
+# видны читателям строго по возрастанию: клиент запоминает номер последней
+# строки и в следующий раз получает только то, что изменилось после нее.
+# Удаление оставляет строку с deleted = true - надгробие.
+#
+# Записи через ORM отмечаются событиями ниже, касания томов и ранобе при
+# изменении глав - в data/versioning.py, массовые вставки и удаления в обход
+# ORM вызывают record() сами. Счетчики комментариев и просмотров в ленту не
+# попадают: они меняются постоянно и без изменения содержимого.
+
+RANOBE = 'ranobe'
+VOLUME = 'volume'
+CHAPTER = 'chapter'
+
+KINDS = {
+    Ranobe.__table__: RANOBE,
+    Volume.__table__: VOLUME,
+    Chapter.__table__: CHAPTER,
+}
+
+
+class Change(SqlAlchemyBase):
+    __tablename__ = 'changes'
+    __table_args__ = (
+        sa.Index('ix_changes_kind_entity', 'kind', 'entity_id', unique=True),
+        {'sqlite_autoincrement': True},
+    )
+
+    id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
+    kind = sa.Column(sa.String, nullable=False)
+    entity_id = sa.Column(sa.Integer, nullable=False)
+    deleted = sa.Column(sa.Boolean, nullable=False, default=False)
+    changed_at = sa.Column(sa.DateTime, nullable=False)
+
+
+_changes = Change.__table__
+
+
+# отметить изменение (или удаление) сущностей kind с указанными id
+def record(connection, kind, ids, deleted=False):
+    now = datetime.datetime.utcnow()
+    rows = [{'kind': kind, 'entity_id': id, 'deleted': deleted, 'changed_at': now} for id in ids]
+    if rows:
+        connection.execute(_changes.insert().prefix_with('OR REPLACE'), rows)
+
+
+@sa.event.listens_for(Ranobe, 'after_insert')
+@sa.event.listens_for(Volume, 'after_insert')
+@sa.event.listens_for(Chapter, 'after_insert')
+def _inserted(mapper, connection, target):
+    record(connection, KINDS[mapper.local_table], [target.id])
+
+
+@sa.event.listens_for(Ranobe, 'after_update')
+@sa.event.listens_for(Volume, 'after_update')
+@sa.event.listens_for(Chapter, 'after_update')
+def _updated(mapper, connection, target):
+    if sa.orm.object_session(target).is_modified(target, include_collections=False):
+        record(connection, KINDS[mapper.local_table], [target.id])
+
+
+@sa.event.listens_for(Ranobe, 'after_delete')
+@sa.event.listens_for(Volume, 'after_delete')
+@sa.event.listens_for(Chapter, 'after_delete')
+def _deleted(mapper, connection, target):
+    record(connection, KINDS[mapper.local_table], [target.id], deleted=True)
+
+
+# первая строка для каждой существующей сущности - если лента появилась в уже заполненной БД
+def backfill(db_sess):
+    if db_sess.query(Change.id).first():
+        return
+    for table, kind in KINDS.items():
+        dates = [table.c[name] for name in ('updated_date', 'created_date') if name in table.c]
+        db_sess.execute(_changes.insert().from_select(
+            ['kind', 'entity_id', 'deleted', 'changed_at'],
+            sa.select(sa.literal(kind), table.c.id, sa.false(), sa.func.coalesce(*dates, sa.func.now()))
+            .order_by(table.c.id)
+        ))
+    db_sess.commit()
+
+
+# страница ленты после изменения с номером after: (элементы, есть ли еще, номер последнего)
+def get_page(db_sess, after, limit):
+    rows, has_more = pagination.keyset_page(
+        db_sess.query(Change), (Change.id,), [after] if after else None, limit
+    )
+
+    alive = {kind: [row.entity_id for row in rows if row.kind == kind and not row.deleted]
+             for kind in (VOLUME, CHAPTER)}
+    volumes = {row.id: row for row in db_sess.query(Volume.id, Volume.ranobe_id, Volume.volume_number)
+               .filter(Volume.id.in_(alive[VOLUME]))}
+    chapters = {row.id: row for row in
+                db_sess.query(Chapter.id, Chapter.chapter_number, Volume.ranobe_id, Volume.volume_number)
+                .join(Volume, Chapter.volume_id == Volume.id)
+                .filter(Chapter.id.in_(alive[CHAPTER]))}
+
+    items = []
+    for row in rows:
+        item = {'type': row.kind, 'id': row.entity_id, 'deleted': row.deleted,
+                'updated_at': row.changed_at.isoformat()}
+        # где искать живую сущность в остальном API
+        if row.kind == VOLUME and row.entity_id in volumes:
+            volume = volumes[row.entity_id]
+            item.update(ranobe_id=volume.ranobe_id, volume_number=volume.volume_number)
+        elif row.kind == CHAPTER and row.entity_id in chapters:
+            chapter = chapters[row.entity_id]
+            item.update(ranobe_id=chapter.ranobe_id, volume_number=chapter.volume_number,
+                        chapter_number=chapter.chapter_number)
+        items.append(item)
+    return items, has_more, rows[-1].id if rows else after
@@ -1,21 +1,45 @@
 import sqlalchemy
 from sqlalchemy import orm
 from sqlalchemy_serializer import SerializerMixin
+from .compression import CompressedText
 from .db_session import SqlAlchemyBase
 
 
 class Chapter(SqlAlchemyBase, SerializerMixin):
     __tablename__ = 'chapters'
+    __table_args__ = (
+        sqlalchemy.Index('ix_chapters_volume_number', 'volume_id', 'chapter_number'),
+        # соседние главы ищутся по позиции в порядке чтения всего ранобе
+        sqlalchemy.Index('ix_chapters_ranobe_reading_order', 'ranobe_id', 'reading_order'),
+    )
 
     id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True, autoincrement=True)
     title = sqlalchemy.Column(sqlalchemy.String, nullable=False)
-    content = sqlalchemy.Column(sqlalchemy.Text, nullable=False)
+    # текст главы - самая тяжелая колонка, поэтому по умолчанию не загружается;
+    # запросы, которым он нужен, просят его явно (orm.undefer или колонка в query)
+    content = orm.deferred(sqlalchemy.Column(CompressedText, nullable=False))
+    # смещения страниц готового HTML и его размер в байтах; сами страницы лежат
+    # в таблице chapter_pages, все поддерживается data/chapter_pages.py
+    page_offsets = sqlalchemy.Column(sqlalchemy.String, nullable=True)
+    html_size = sqlalchemy.Column(sqlalchemy.Integer, nullable=True)
     chapter_number = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
-    volume_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('volumes.id'))
+    volume_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('volumes.id', ondelete='CASCADE'))
     created_date = sqlalchemy.Column(sqlalchemy.DateTime, default=sqlalchemy.func.now())
 
+    # денормализация для навигации: ранобе главы и ее сквозной номер по всем томам,
+    # поддерживаются data/reading_order.py
+    ranobe_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('ranobe.id', ondelete='CASCADE'))
+    reading_order = sqlalchemy.Column(sqlalchemy.Integer, nullable=True)
+
+    # версия строки и время последнего изменения (UTC) для ETag/Last-Modified,
+    # поддерживаются data/versioning.py
+    version = sqlalchemy.Column(sqlalchemy.Integer, nullable=False, default=1, server_default='1')
+    updated_date = sqlalchemy.Column(sqlalchemy.DateTime, nullable=True)
+
     volume = orm.relationship('Volume', back_populates='chapters')
-    comments = orm.relationship('Comment', back_populates='chapter', cascade='all, delete-orphan')
+    # комментарии удаляет БД; счетчики при этом поправляет data/counters.py
+    comments = orm.relationship('Comment', back_populates='chapter', cascade='all, delete-orphan',
+                                passive_deletes=True)
 
     def __repr__(self):
         return f'<Chapter {self.id} {self.title}>'
@@ -0,0 +1,338 @@
+import datetime
+import json
+import os
+import posixpath
+import re
+import zipfile
+from html.parser import HTMLParser
+from xml.etree import ElementTree
+
+import sqlalchemy as sa
+
+from . import changes, chapter_pages, counters, reading_order, search, versioning
+from .chapter import Chapter
+from .volume import Volume
+
+# Массовый импорт глав.
+#
+# Источник (JSON lines, EPUB или каталог .txt) читается потоком и превращается
+# в словари {'title', 'content', 'chapter_number'?, 'volume_number'?}.
+# Главы вставляются пачками через executemany, одна транзакция на пачку.
+# После каждой пачки в файл контрольной точки записывается число обработанных
+# элементов источника, поэтому прерванный импорт продолжается с того же места.
+# Порядок чтения и счетчики ранобе пересчитываются один раз, после последней
+# пачки (и после ошибки - для уже записанных пачек): порядок - начиная с самого
+# раннего места среди новых глав, при продолжении импорта - целиком.
+
+DEFAULT_BATCH_SIZE = 200
+
+
+class ChapterImportError(Exception):
+    pass
+
+
+# Чтение источников
+
+def read_jsonl(lines):
+    for line_number, line in enumerate(lines, 1):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError:
+            raise ChapterImportError(f"Строка {line_number}: некорректный JSON")
+        if not isinstance(item, dict):
+            raise ChapterImportError(f"Строка {line_number}: ожидался объект")
+        yield item
+
+
+def _natural_key(name):
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', name)]
+
+
+# каталог .txt: первая непустая строка - название, остальное - текст,
+# номер главы - первое число в имени файла
+def read_directory(path):
+    for name in sorted(os.listdir(path), key=_natural_key):
+        if not name.lower().endswith('.txt'):
+            continue
+        with open(os.path.join(path, name), encoding='utf-8') as file:
+            text = file.read().strip()
+        if not text:
+            continue
+        title, _, content = text.partition('\n')
+        item = {'title': title.strip(), 'content': content.strip() or title.strip()}
+        number = re.search(r'\d+', name)
+        if number:
+            item['chapter_number'] = int(number.group())
+        yield item
+
+
+class _XhtmlText(HTMLParser):
+    BLOCKS = {'p', 'div', 'br', 'h1', 'h2', 'h3', 'h4', 'li'}
+    HEADINGS = {'h1', 'h2', 'h3'}
+
+    def __init__(self):
+        super().__init__()
+        self.parts = []
+        self.title = ''
+        self._heading = None
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ('script', 'style', 'head'):
+            self._skip += 1
+        if tag in self.HEADINGS and not self.title:
+            self._heading = []
+        if tag in self.BLOCKS:
+            self.parts.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in ('script', 'style', 'head'):
+            self._skip = max(self._skip - 1, 0)
+        if tag in self.HEADINGS and self._heading is not None:
+            self.title = ''.join(self._heading).strip()
+            self._heading = None
+        if tag in self.BLOCKS:
+            self.parts.append('\n')
+
+    def handle_data(self, data):
+        if self._skip:
+            return
+        if self._heading is not None:
+            self._heading.append(data)
+            return
+        self.parts.append(data)
+
+    def text(self):
+        text = ''.join(self.parts)
+        paragraphs = [' '.join(p.split()) for p in re.split(r'\n\s*\n|\n', text)]
+        return '\n\n'.join(p for p in paragraphs if p)
+
+
+# EPUB: документы читаются в порядке spine, пустые (обложка, оглавление) пропускаются
+def read_epub(path):
+    with zipfile.ZipFile(path) as epub:
+        container = ElementTree.fromstring(epub.read('META-INF/container.xml'))
+        rootfile = container.find('.//{*}rootfile').get('full-path')
+        opf = ElementTree.fromstring(epub.read(rootfile))
+        base = posixpath.dirname(rootfile)
+
+        manifest = {item.get('id'): item.get('href') for item in opf.find('{*}manifest')}
+        for itemref in opf.find('{*}spine'):
+            href = manifest.get(itemref.get('idref'))
+            if not href:
+                continue
+            parser = _XhtmlText()
+            parser.feed(epub.read(posixpath.join(base, href)).decode('utf-8'))
+            content = parser.text()
+            if not content:
+                continue
+            yield {'title': parser.title or content.split('\n', 1)[0][:100], 'content': content}
+
+
+# формат определяется по пути, если не указан явно
+def read_source(path, format=None):
+    if format is None:
+        format = 'txt' if os.path.isdir(path) else 'epub' if path.lower().endswith('.epub') else 'jsonl'
+    if format == 'txt':
+        return read_directory(path)
+    if format == 'epub':
+        return read_epub(path)
+    return _read_jsonl_file(path)
+
+
+def _read_jsonl_file(path):
+    with open(path, encoding='utf-8') as file:
+        yield from read_jsonl(file)
+
+
+# Контрольные точки
+
+def load_checkpoint(path):
+    if not path or not os.path.exists(path):
+        return 0
+    with open(path, encoding='utf-8') as file:
+        return json.load(file).get('processed', 0)
+
+
+def save_checkpoint(path, processed):
+    if not path:
+        return
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump({'processed': processed}, file)
+    os.replace(tmp_path, path)
+
+
+# Импорт
+
+# номер тома или главы: целое от 1; bool - тоже int в Python, но номером не считается
+def _is_number(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 1
+
+
+class ChapterImporter:
+    def __init__(self, db_sess, ranobe_id, volume_number=None, batch_size=DEFAULT_BATCH_SIZE,
+                 skip_existing=False, checkpoint=None, progress=None):
+        self.db_sess = db_sess
+        self.ranobe_id = ranobe_id
+        self.default_volume_number = volume_number
+        self.batch_size = batch_size
+        self.skip_existing = skip_existing
+        self.checkpoint = checkpoint
+        self.progress = progress
+        self.imported = 0
+        self.skipped = 0
+        self.volume_ids = set()
+        self._since = None
+        self._volumes = {}
+        self._next_numbers = {}
+        self._seen = set()
+
+    def _default_volume(self):
+        if self.default_volume_number is None:
+            last = self.db_sess.query(sa.func.max(Volume.volume_number)) \
+                .filter(Volume.ranobe_id == self.ranobe_id).scalar()
+            self.default_volume_number = last or 1
+        elif not _is_number(self.default_volume_number):
+            raise ChapterImportError("Том по умолчанию должен быть целым числом от 1")
+        return self.default_volume_number
+
+    # id тома по номеру; недостающие тома создаются так же, как в add_chapter
+    def _volume_id(self, volume_number):
+        if volume_number not in self._volumes:
+            volume = self.db_sess.query(Volume).filter(
+                Volume.ranobe_id == self.ranobe_id,
+                Volume.volume_number == volume_number
+            ).first()
+            if not volume:
+                volume = Volume(volume_number=volume_number, ranobe_id=self.ranobe_id,
+                                title=f"Том {volume_number}")
+                self.db_sess.add(volume)
+                self.db_sess.flush()
+            self._volumes[volume_number] = volume.id
+        return self._volumes[volume_number]
+
+    def _next_number(self, volume_id):
+        if volume_id not in self._next_numbers:
+            last = self.db_sess.query(sa.func.max(Chapter.chapter_number)) \
+                .filter(Chapter.volume_id == volume_id).scalar()
+            self._next_numbers[volume_id] = (last or 0) + 1
+        return self._next_numbers[volume_id]
+
+    def _row(self, position, item):
+        title = str(item.get('title') or '').strip()
+        content = item.get('content')
+        if not title or not isinstance(content, str) or not content.strip():
+            raise ChapterImportError(f"Элемент {position}: нужны непустые title и content")
+
+        volume_number = item.get('volume_number')
+        if volume_number is None:
+            volume_number = self._default_volume()
+        elif not _is_number(volume_number):
+            raise ChapterImportError(f"Элемент {position}: volume_number должен быть целым числом от 1")
+        volume_id = self._volume_id(volume_number)
+
+        chapter_number = item.get('chapter_number')
+        if chapter_number is None:
+            chapter_number = self._next_number(volume_id)
+        elif not _is_number(chapter_number):
+            raise ChapterImportError(f"Элемент {position}: chapter_number должен быть целым числом от 1")
+        if (volume_id, chapter_number) in self._seen:
+            raise ChapterImportError(f"Элемент {position}: глава {chapter_number} тома {volume_number} повторяется")
+        self._seen.add((volume_id, chapter_number))
+        self._next_numbers[volume_id] = max(self._next_number(volume_id), chapter_number + 1)
+
+        return {'title': title, 'content': content, 'chapter_number': chapter_number,
+                'volume_id': volume_id, 'ranobe_id': self.ranobe_id,
+                'version': 1, 'updated_date': datetime.datetime.utcnow()}
+
+    # проверка пачки по уже существующим главам - один запрос на том
+    def _drop_existing(self, rows):
+        by_volume = {}
+        for row in rows:
+            by_volume.setdefault(row['volume_id'], []).append(row['chapter_number'])
+
+        existing = set()
+        for volume_id, numbers in by_volume.items():
+            existing.update(
+                (volume_id, number) for number, in self.db_sess.query(Chapter.chapter_number)
+                .filter(Chapter.volume_id == volume_id, Chapter.chapter_number.in_(numbers))
+            )
+        if not existing:
+            return rows
+        if not self.skip_existing:
+            volume_id, number = sorted(existing)[0]
+            raise ChapterImportError(f"Глава {number} уже есть в томе (id {volume_id})")
+        self.skipped += sum(1 for row in rows if (row['volume_id'], row['chapter_number']) in existing)
+        return [row for row in rows if (row['volume_id'], row['chapter_number']) not in existing]
+
+    def _flush(self, rows, processed):
+        rows = self._drop_existing(rows)
+        connection = self.db_sess.connection()
+        if rows:
+            connection.execute(Chapter.__table__.insert(), rows)
+
+            # executemany в SQLite не возвращает id - находим их по (том, номер)
+            ids = {}
+            for volume_id in {row['volume_id'] for row in rows}:
+                numbers = [row['chapter_number'] for row in rows if row['volume_id'] == volume_id]
+                ids.update(
+                    ((volume_id, number), id) for id, number in self.db_sess.query(Chapter.id, Chapter.chapter_number)
+                    .filter(Chapter.volume_id == volume_id, Chapter.chapter_number.in_(numbers))
+                )
+            changes.record(connection, changes.CHAPTER, ids.values())
+            chapter_pages.store(connection, {ids[(row['volume_id'], row['chapter_number'])]: row['content']
+                                             for row in rows})
+            for row in rows:
+                search.index_chapter(connection, ids[(row['volume_id'], row['chapter_number'])],
+                                     row['title'], row['content'])
+            for volume_id in {row['volume_id'] for row in rows}:
+                versioning.touch_volume(connection, volume_id)
+                self.volume_ids.add(volume_id)
+            volume_numbers = {volume_id: number for number, volume_id in self._volumes.items()}
+            since = min((volume_numbers[row['volume_id']], row['chapter_number']) for row in rows)
+            self._since = since if self._since is None else min(self._since, since)
+
+        self.db_sess.commit()
+        self.imported += len(rows)
+        save_checkpoint(self.checkpoint, processed)
+        if self.progress:
+            self.progress(processed, self.imported, self.skipped)
+
+    # порядок чтения и счетчики для всех записанных пачек; resumed - продолжение
+    # прерванного импорта, главы прошлого запуска могли остаться без порядка
+    def _finish(self, resumed):
+        if not self.imported and not resumed:
+            return
+        reading_order.reindex_ranobe(self.db_sess, self.ranobe_id, since=None if resumed else self._since)
+        counters.recompute(self.db_sess.connection(), self.ranobe_id)
+        self.db_sess.commit()
+
+    def run(self, items):
+        start = load_checkpoint(self.checkpoint)
+        batch, processed = [], 0
+        try:
+            for position, item in enumerate(items, 1):
+                if position <= start:
+                    continue
+                batch.append(self._row(position, item))
+                processed = position
+                if len(batch) >= self.batch_size:
+                    self._flush(batch, processed)
+                    batch = []
+            if batch:
+                self._flush(batch, processed)
+        except Exception:
+            self.db_sess.rollback()
+            self._finish(start > 0)
+            raise
+        self._finish(start > 0)
+
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+        return {'imported': self.imported, 'skipped': self.skipped}
@@ -0,0 +1,155 @@
+import bisect
+import os
+
+import sqlalchemy as sa
+from markupsafe import escape
+
+from .chapter import Chapter
+from .compression import CompressedText
+from .db_session import SqlAlchemyBase
+
+# Готовый HTML глав, разбитый на страницы.
+#
+# Текст главы превращается в HTML один раз при сохранении: каждая непустая
+# строка - абзац <p>, текст экранируется. Страница - несколько целых абзацев
+# размером около PAGE_BYTES байт UTF-8; страницы лежат в таблице chapter_pages
+# по строке на страницу и сжимаются тем же кодеком, что и текст глав
+# (data/compression.py), поэтому читается и распаковывается только нужная
+# страница. В Chapter.page_offsets - смещения начала страниц в байтах через
+# запятую, в Chapter.html_size - размер всего HTML: по ним API отдает куски
+# HTML по смещению (границы страниц всегда на границах символов).
+#
+# HTML пересчитывается при каждом изменении content через ORM; массовый импорт
+# в обход ORM вызывает store(). Главы без готового HTML (html_size пуст)
+# дорисовываются при старте (backfill).
+
+PAGE_BYTES = int(os.environ.get('RANOBE_CHAPTER_PAGE_BYTES', 32 * 1024))
+BACKFILL_BATCH = 100
+
+
+class ChapterPage(SqlAlchemyBase):
+    __tablename__ = 'chapter_pages'
+
+    chapter_id = sa.Column(sa.Integer, sa.ForeignKey('chapters.id', ondelete='CASCADE'), primary_key=True)
+    page = sa.Column(sa.Integer, primary_key=True)
+    html = sa.Column(CompressedText, nullable=False)
+
+
+_pages = ChapterPage.__table__
+_chapters = Chapter.__table__
+
+
+# HTML страниц главы; у главы всегда есть хотя бы одна (возможно пустая) страница
+def render(text):
+    pages, paragraphs, page_size = [], [], 0
+    for line in (text or '').replace('\r\n', '\n').replace('\r', '\n').split('\n'):
+        line = line.strip()
+        if not line:
+            continue
+        paragraph = f'<p>{escape(line)}</p>\n'
+        size = len(paragraph.encode('utf-8'))
+        if paragraphs and page_size + size > PAGE_BYTES:
+            pages.append(''.join(paragraphs))
+            paragraphs, page_size = [], 0
+        paragraphs.append(paragraph)
+        page_size += size
+    pages.append(''.join(paragraphs))
+    return pages
+
+
+def dump_offsets(offsets):
+    return ','.join(str(offset) for offset in offsets)
+
+
+def load_offsets(value):
+    return [int(offset) for offset in value.split(',')] if value else [0]
+
+
+# значения колонок главы для отрисованных страниц
+def columns(pages):
+    offsets, size = [], 0
+    for html in pages:
+        offsets.append(size)
+        size += len(html.encode('utf-8'))
+    return {'page_offsets': dump_offsets(offsets), 'html_size': size}
+
+
+# границы страницы page (с 1) в байтах или None, если такой страницы нет
+def page_bounds(offsets, size, page):
+    if not 1 <= page <= len(offsets):
+        return None
+    end = offsets[page] if page < len(offsets) else size
+    return offsets[page - 1], end
+
+
+# номер страницы, на которую приходится байт offset
+def page_of(offsets, offset):
+    return max(bisect.bisect_right(offsets, offset), 1)
+
+
+# номер страницы, на которую приходится доля position (0..1) всей главы
+def page_at(offsets, size, position):
+    return page_of(offsets, position * size)
+
+
+def _write_pages(connection, pages_by_chapter):
+    connection.execute(_pages.delete().where(_pages.c.chapter_id.in_(list(pages_by_chapter))))
+    rows = [{'chapter_id': chapter_id, 'page': page, 'html': html}
+            for chapter_id, pages in pages_by_chapter.items()
+            for page, html in enumerate(pages, 1)]
+    connection.execute(_pages.insert(), rows)
+
+
+# отрисовать и сохранить страницы глав в обход ORM: contents - {id главы: текст}
+def store(connection, contents):
+    if not contents:
+        return
+    pages_by_chapter = {chapter_id: render(text) for chapter_id, text in contents.items()}
+    _write_pages(connection, pages_by_chapter)
+
+    updates = []
+    for chapter_id, pages in pages_by_chapter.items():
+        values = columns(pages)
+        updates.append({'_id': chapter_id, '_offsets': values['page_offsets'], '_size': values['html_size']})
+    connection.execute(
+        _chapters.update().where(_chapters.c.id == sa.bindparam('_id'))
+        .values(page_offsets=sa.bindparam('_offsets'), html_size=sa.bindparam('_size')),
+        updates
+    )
+
+
+# колонки главы считаются до записи строки, сами страницы пишутся после - им нужен id
+@sa.event.listens_for(Chapter, 'before_insert')
+@sa.event.listens_for(Chapter, 'before_update')
+def _render_content(mapper, connection, target):
+    state = sa.inspect(target)
+    if state.persistent and not state.attrs.content.history.has_changes():
+        return
+    pages = render(target.content)
+    for name, value in columns(pages).items():
+        setattr(target, name, value)
+    state.info['rendered_pages'] = pages
+
+
+@sa.event.listens_for(Chapter, 'after_insert')
+@sa.event.listens_for(Chapter, 'after_update')
+def _store_pages(mapper, connection, target):
+    pages = sa.inspect(target).info.pop('rendered_pages', None)
+    if pages is not None:
+        _write_pages(connection, {target.id: pages})
+
+
+# отрисовать главы без готового HTML; chapter_ids - только эти главы
+def backfill(db_sess, chapter_ids=None):
+    done = 0
+    while True:
+        query = sa.select(_chapters.c.id, _chapters.c.content).where(_chapters.c.html_size.is_(None))
+        if chapter_ids is not None:
+            query = query.where(_chapters.c.id.in_(chapter_ids))
+        rows = db_sess.execute(query.limit(BACKFILL_BATCH)).all()
+        if not rows:
+            break
+        store(db_sess.connection(), dict(rows))
+        db_sess.commit()
+        done += len(rows)
+    return done
@@ -6,12 +6,23 @@ from .db_session import SqlAlchemyBase
 
 class Comment(SqlAlchemyBase, SerializerMixin):
     __tablename__ = 'comments'
+    __table_args__ = (
+        # страницы комментариев главы: новые сверху, keyset по (created_date, id)
+        sqlalchemy.Index('ix_comments_chapter_created_id', 'chapter_id', 'created_date', 'id'),
+        # ответы на комментарий в порядке написания
+        sqlalchemy.Index('ix_comments_parent_created_id', 'parent_id', 'created_date', 'id'),
+    )
 
     id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True, autoincrement=True)
     content = sqlalchemy.Column(sqlalchemy.Text, nullable=False)
     user_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey("users.id"))
-    chapter_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey("chapters.id"))
+    chapter_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey("chapters.id", ondelete='CASCADE'))
     created_date = sqlalchemy.Column(sqlalchemy.DateTime, default=sqlalchemy.func.now())
+    # комментарий, на который это ответ; ветки одного уровня - ответ на ответ относится к корню
+    parent_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey("comments.id", ondelete='CASCADE'),
+                                  nullable=True)
 
     user = orm.relationship('User')
-    chapter = orm.relationship('Chapter', back_populates="comments")
\ No newline at end of file
+    chapter = orm.relationship('Chapter', back_populates="comments")
+    replies = orm.relationship('Comment', cascade='all, delete-orphan', passive_deletes=True,
+                               backref=orm.backref('parent', remote_side=[id]))
\ No newline at end of file
@@ -0,0 +1,210 @@
+import collections
+import os
+import re
+import zlib
+
+import sqlalchemy as sa
+
+from .db_session import SqlAlchemyBase, create_session
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Сжатое хранение текста глав.
+#
+# Значение в колонке - либо обычная строка (старые строки и режим 'none'),
+# либо bytes вида: 1 байт кодека (b'z' - zlib, b's' - zstd),
+# 2 байта номера словаря (0 - без словаря) и сжатые данные.
+# Кодек для новых записей задается переменной RANOBE_CONTENT_CODEC
+# (none, zlib или zstd; для zstd нужен пакет zstandard).
+# Словарь обучается на существующих главах командой manage.py recompress --train-dictionary
+# и хранится в таблице compression_dictionaries.
+
+ZLIB = b'z'
+ZSTD = b's'
+
+# короткие тексты не сжимаются: выигрыш меньше заголовка
+MIN_COMPRESS_SIZE = 512
+ZLIB_DICTIONARY_SIZE = 32 * 1024
+
+_codec = os.environ.get('RANOBE_CONTENT_CODEC', 'none')
+_dictionaries = {}
+_active_dictionary = 0
+
+
+class CompressionDictionary(SqlAlchemyBase):
+    __tablename__ = 'compression_dictionaries'
+
+    id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
+    codec = sa.Column(sa.String, nullable=False)
+    data = sa.Column(sa.LargeBinary, nullable=False)
+    created_date = sa.Column(sa.DateTime, default=sa.func.now())
+
+
+def configure(codec):
+    global _codec
+    if codec not in ('none', 'zlib', 'zstd'):
+        raise Exception(f"Неизвестный кодек: {codec}")
+    if codec == 'zstd' and zstandard is None:
+        raise Exception("Для кодека zstd нужен пакет zstandard")
+    _codec = codec
+
+
+# загрузить словари из БД; последний словарь текущего кодека используется для записи
+def load_dictionaries(db_sess):
+    global _active_dictionary
+    _dictionaries.clear()
+    _active_dictionary = 0
+    for dictionary in db_sess.query(CompressionDictionary).order_by(CompressionDictionary.id):
+        _dictionaries[dictionary.id] = dictionary.data
+        if dictionary.codec == _codec:
+            _active_dictionary = dictionary.id
+
+
+# словарь по номеру; словарь, обученный уже после старта процесса (другим процессом
+# или командой manage.py), читается из БД одной строкой и запоминается
+def _dictionary(dictionary_id):
+    if not dictionary_id:
+        return None
+    dictionary = _dictionaries.get(dictionary_id)
+    if dictionary is None:
+        db_sess = create_session()
+        try:
+            row = db_sess.get(CompressionDictionary, dictionary_id)
+        finally:
+            db_sess.close()
+        if row is None:
+            raise Exception(f"Словарь сжатия {dictionary_id} не найден")
+        dictionary = _dictionaries[dictionary_id] = row.data
+    return dictionary
+
+
+# обучение словаря. Для zstd - штатный тренер, для zlib - частые слова текстов:
+# zlib ищет совпадения в последних 32 КБ словаря, поэтому самые частые слова идут в конец
+def train_dictionary(samples, codec):
+    if codec == 'zstd':
+        return zstandard.train_dictionary(112 * 1024, [s.encode('utf-8') for s in samples]).as_bytes()
+
+    counter = collections.Counter()
+    for sample in samples:
+        counter.update(re.findall(r'\w+[ ,.]', sample))
+
+    words, size = [], 0
+    for word, count in counter.most_common():
+        if count < 2:
+            break
+        encoded = word.encode('utf-8')
+        if size + len(encoded) > ZLIB_DICTIONARY_SIZE:
+            break
+        words.append(encoded)
+        size += len(encoded)
+    return b''.join(reversed(words))
+
+
+def compress(text):
+    if _codec == 'none' or text is None:
+        return text
+    data = text.encode('utf-8')
+    if len(data) < MIN_COMPRESS_SIZE:
+        return text
+
+    dictionary_id = _active_dictionary
+    dictionary = _dictionary(dictionary_id)
+    if _codec == 'zstd':
+        params = {'dict_data': zstandard.ZstdCompressionDict(dictionary)} if dictionary else {}
+        payload = zstandard.ZstdCompressor(level=9, **params).compress(data)
+        codec = ZSTD
+    else:
+        compressor = zlib.compressobj(9, zdict=dictionary) if dictionary else zlib.compressobj(9)
+        payload = compressor.compress(data) + compressor.flush()
+        codec = ZLIB
+    return codec + dictionary_id.to_bytes(2, 'big') + payload
+
+
+def decompress(value):
+    if value is None or isinstance(value, str):
+        return value
+
+    codec, dictionary_id, payload = value[:1], int.from_bytes(value[1:3], 'big'), value[3:]
+    dictionary = _dictionary(dictionary_id)
+
+    if codec == ZSTD:
+        params = {'dict_data': zstandard.ZstdCompressionDict(dictionary)} if dictionary else {}
+        data = zstandard.ZstdDecompressor(**params).decompress(payload)
+    else:
+        decompressor = zlib.decompressobj(zdict=dictionary) if dictionary else zlib.decompressobj()
+        data = decompressor.decompress(payload) + decompressor.flush()
+    return data.decode('utf-8')
+
+
+# если значение сжато без словаря, его можно отдать клиенту как есть:
+# поток zlib - это Content-Encoding: deflate, кадр zstd - Content-Encoding: zstd
+def http_encoding(value):
+    if not isinstance(value, bytes) or int.from_bytes(value[1:3], 'big'):
+        return None, None
+    if value[:1] == ZLIB:
+        return 'deflate', value[3:]
+    if value[:1] == ZSTD:
+        return 'zstd', value[3:]
+    return None, None
+
+
+class CompressedText(sa.types.TypeDecorator):
+    impl = sa.Text
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return compress(value)
+
+    def process_result_value(self, value, dialect):
+        return decompress(value)
+
+
+# пересжать все главы и их страницы HTML (data/chapter_pages.py) текущим кодеком
+# (и, если нужно, заново обученным словарем)
+def recompress(db_sess, train=False, sample_size=500, batch_size=200, progress=print):
+    from .chapter import Chapter
+    from .chapter_pages import ChapterPage
+
+    table, pages = Chapter.__table__, ChapterPage.__table__
+    if train and _codec != 'none':
+        samples = [content for content, in db_sess.query(Chapter.content)
+                   .order_by(sa.func.random()).limit(sample_size)]
+        if samples:
+            db_sess.add(CompressionDictionary(codec=_codec, data=train_dictionary(samples, _codec)))
+            db_sess.commit()
+    # словарь для записи выбирается заново: кодек мог смениться после загрузки словарей
+    load_dictionaries(db_sess)
+
+    last_id, done = 0, 0
+    while True:
+        rows = db_sess.execute(
+            sa.select(table.c.id, table.c.content)
+            .where(table.c.id > last_id)
+            .order_by(table.c.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        db_sess.execute(
+            table.update().where(table.c.id == sa.bindparam('_id')).values(content=sa.bindparam('_content')),
+            [{'_id': row.id, '_content': row.content} for row in rows]
+        )
+        page_rows = db_sess.execute(
+            sa.select(pages.c.chapter_id, pages.c.page, pages.c.html)
+            .where(pages.c.chapter_id.in_([row.id for row in rows]))
+        ).all()
+        if page_rows:
+            db_sess.execute(
+                pages.update()
+                .where(pages.c.chapter_id == sa.bindparam('_chapter_id'), pages.c.page == sa.bindparam('_page'))
+                .values(html=sa.bindparam('_html')),
+                [{'_chapter_id': row.chapter_id, '_page': row.page, '_html': row.html} for row in page_rows]
+            )
+        db_sess.commit()
+        last_id = rows[-1].id
+        done += len(rows)
+        progress(f"Пересжато глав: {done}")
+    return done
@@ -0,0 +1,226 @@
+import atexit
+import os
+import threading
+from collections import Counter
+
+import sqlalchemy as sa
+
+from . import db_session
+from .background import PeriodicFlusher
+from .chapter import Chapter
+from .comment import Comment
+from .ranobe import Ranobe
+from .volume import Volume
+
+# Денормализованные счетчики ранобе и томов: chapter_count, comment_count,
+# last_chapter_at и view_count.
+#
+# Первые три поддерживаются событиями ORM при добавлении и удалении глав и
+# комментариев; массовый импорт, который пишет в обход ORM, пересчитывает их
+# через recompute(). Комментарии удаляемой главы и ответы удаляемого комментария
+# удаляет сама БД (ON DELETE CASCADE) без событий ORM, поэтому они вычитаются
+# заранее, в before_delete. Просмотры копятся в памяти процесса и раз в
+# VIEW_FLUSH_INTERVAL секунд прибавляются к view_count одной транзакцией.
+# Просмотр главы засчитывается ее тому и ранобе, просмотр тома - и ранобе.
+# manage.py repair-counters пересчитывает все, кроме просмотров, с нуля.
+
+VIEW_FLUSH_INTERVAL = float(os.environ.get('RANOBE_VIEW_FLUSH_INTERVAL', 30))
+
+COUNTER_COLUMNS = ('chapter_count', 'comment_count', 'last_chapter_at', 'view_count')
+
+_ranobe = Ranobe.__table__
+_volumes = Volume.__table__
+_chapters = Chapter.__table__
+_comments = Comment.__table__
+
+
+def _volume_of_chapter(chapter_id):
+    return sa.select(_chapters.c.volume_id).where(_chapters.c.id == chapter_id).scalar_subquery()
+
+
+def _ranobe_of_volume(volume_id):
+    return sa.select(_volumes.c.ranobe_id).where(_volumes.c.id == volume_id).scalar_subquery()
+
+
+# прибавить к счетчикам тома и его ранобе; volume_id - число или подзапрос
+def _add(connection, volume_id, **deltas):
+    connection.execute(
+        _volumes.update().where(_volumes.c.id == volume_id)
+        .values({name: _volumes.c[name] + delta for name, delta in deltas.items()})
+    )
+    connection.execute(
+        _ranobe.update().where(_ranobe.c.id == _ranobe_of_volume(volume_id))
+        .values({name: _ranobe.c[name] + delta for name, delta in deltas.items()})
+    )
+
+
+def _refresh_last_chapter(connection, volume_id):
+    connection.execute(
+        _volumes.update().where(_volumes.c.id == volume_id)
+        .values(last_chapter_at=sa.select(sa.func.max(_chapters.c.created_date))
+                .where(_chapters.c.volume_id == volume_id).scalar_subquery())
+    )
+    connection.execute(
+        _ranobe.update().where(_ranobe.c.id == _ranobe_of_volume(volume_id))
+        .values(last_chapter_at=sa.select(sa.func.max(_volumes.c.last_chapter_at))
+                .where(_volumes.c.ranobe_id == _ranobe.c.id).scalar_subquery())
+    )
+
+
+@sa.event.listens_for(Chapter, 'after_insert')
+def _chapter_inserted(mapper, connection, target):
+    _add(connection, target.volume_id, chapter_count=1)
+    _refresh_last_chapter(connection, target.volume_id)
+
+
+# комментарии, которые удалит каскад; загруженные в сессию ORM к этому моменту уже удалил сам
+@sa.event.listens_for(Chapter, 'before_delete')
+def _chapter_deleting(mapper, connection, target):
+    comments = connection.execute(
+        sa.select(sa.func.count()).where(_comments.c.chapter_id == target.id)
+    ).scalar()
+    if comments:
+        _add(connection, target.volume_id, comment_count=-comments)
+
+
+@sa.event.listens_for(Chapter, 'after_delete')
+def _chapter_deleted(mapper, connection, target):
+    _add(connection, target.volume_id, chapter_count=-1)
+    _refresh_last_chapter(connection, target.volume_id)
+
+
+# перенос главы в другой том
+@sa.event.listens_for(Chapter, 'after_update')
+def _chapter_updated(mapper, connection, target):
+    history = sa.inspect(target).attrs.volume_id.history
+    if not history.deleted or not history.added:
+        return
+    comments = connection.execute(
+        sa.select(sa.func.count()).where(_comments.c.chapter_id == target.id)
+    ).scalar()
+    for volume_id, sign in ((history.deleted[0], -1), (history.added[0], 1)):
+        _add(connection, volume_id, chapter_count=sign, comment_count=sign * comments)
+        _refresh_last_chapter(connection, volume_id)
+
+
+@sa.event.listens_for(Comment, 'after_insert')
+def _comment_inserted(mapper, connection, target):
+    _add(connection, _volume_of_chapter(target.chapter_id), comment_count=1)
+
+
+@sa.event.listens_for(Comment, 'before_delete')
+def _comment_deleting(mapper, connection, target):
+    replies = connection.execute(
+        sa.select(sa.func.count()).where(_comments.c.parent_id == target.id)
+    ).scalar()
+    if replies:
+        _add(connection, _volume_of_chapter(target.chapter_id), comment_count=-replies)
+
+
+@sa.event.listens_for(Comment, 'after_delete')
+def _comment_deleted(mapper, connection, target):
+    _add(connection, _volume_of_chapter(target.chapter_id), comment_count=-1)
+
+
+# пересчитать счетчики (кроме просмотров) по главам и комментариям:
+# для одного ранобе или, если ranobe_id не указан, для всех
+def recompute(connection, ranobe_id=None):
+    volume_filter = _volumes.c.ranobe_id == ranobe_id if ranobe_id is not None else sa.true()
+    ranobe_filter = _ranobe.c.id == ranobe_id if ranobe_id is not None else sa.true()
+
+    connection.execute(_volumes.update().where(volume_filter).values(
+        chapter_count=sa.select(sa.func.count())
+        .where(_chapters.c.volume_id == _volumes.c.id).scalar_subquery(),
+        comment_count=sa.select(sa.func.count())
+        .select_from(_comments.join(_chapters, _comments.c.chapter_id == _chapters.c.id))
+        .where(_chapters.c.volume_id == _volumes.c.id).scalar_subquery(),
+        last_chapter_at=sa.select(sa.func.max(_chapters.c.created_date))
+        .where(_chapters.c.volume_id == _volumes.c.id).scalar_subquery(),
+    ))
+    connection.execute(_ranobe.update().where(ranobe_filter).values(
+        chapter_count=sa.select(sa.func.coalesce(sa.func.sum(_volumes.c.chapter_count), 0))
+        .where(_volumes.c.ranobe_id == _ranobe.c.id).scalar_subquery(),
+        comment_count=sa.select(sa.func.coalesce(sa.func.sum(_volumes.c.comment_count), 0))
+        .where(_volumes.c.ranobe_id == _ranobe.c.id).scalar_subquery(),
+        last_chapter_at=sa.select(sa.func.max(_volumes.c.last_chapter_at))
+        .where(_volumes.c.ranobe_id == _ranobe.c.id).scalar_subquery(),
+    ))
+
+
+# заполнить счетчики, если их колонки только что добавлены в существующую БД
+def backfill(db_sess, added_columns):
+    if any(f'{table}.{column}' in added_columns
+           for table in ('ranobe', 'volumes') for column in COUNTER_COLUMNS):
+        recompute(db_sess.connection())
+        db_sess.commit()
+
+
+# Просмотры
+
+class ViewCounter:
+    def __init__(self, interval=VIEW_FLUSH_INTERVAL):
+        self._counts = Counter()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flusher = PeriodicFlusher('view-count-flush', self.flush, interval)
+
+    def hit(self, kind, id):
+        with self._lock:
+            self._counts[(kind, id)] += 1
+        self._flusher.start()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                counts, self._counts = self._counts, Counter()
+            if not counts:
+                return 0
+
+            by_kind = {}
+            for (kind, id), n in counts.items():
+                by_kind.setdefault(kind, []).append({'_id': id, '_n': n})
+
+            id, n = sa.bindparam('_id'), sa.bindparam('_n')
+            statements = {
+                'ranobe': [_ranobe.update().where(_ranobe.c.id == id)],
+                'volume': [_volumes.update().where(_volumes.c.id == id),
+                           _ranobe.update().where(_ranobe.c.id == _ranobe_of_volume(id))],
+                'chapter': [_volumes.update().where(_volumes.c.id == _volume_of_chapter(id)),
+                            _ranobe.update().where(_ranobe.c.id == _ranobe_of_volume(_volume_of_chapter(id)))],
+            }
+
+            db_sess = db_session.create_session()
+            try:
+                for kind, params in by_kind.items():
+                    for statement in statements[kind]:
+                        table = statement.table
+                        db_sess.execute(statement.values(view_count=table.c.view_count + n), params)
+                db_sess.commit()
+            except Exception:
+                db_sess.rollback()
+                with self._lock:
+                    self._counts.update(counts)
+                raise
+            finally:
+                db_sess.close()
+            return sum(counts.values())
+
+
+_views = ViewCounter()
+atexit.register(lambda: _views.flush())
+
+
+def hit_ranobe(ranobe_id):
+    _views.hit('ranobe', ranobe_id)
+
+
+def hit_volume(volume_id):
+    _views.hit('volume', volume_id)
+
+
+def hit_chapter(chapter_id):
+    _views.hit('chapter', chapter_id)
+
+
+def flush_views():
+    return _views.flush()
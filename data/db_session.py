@@ -2,13 +2,46 @@ import sqlalchemy as sa
 import sqlalchemy.orm as orm
 from sqlalchemy.orm import Session
 
+from . import metrics
+
 SqlAlchemyBase = orm.declarative_base()
 
 __factory = None
+__engine = None
 
+# Профили настройки движка.
+# default - поведение SQLite "из коробки": rollback-журнал, полный fsync на каждый commit.
+# tuned - WAL (читатели не блокируются писателем), synchronous=NORMAL (fsync только
+# при checkpoint), mmap и увеличенный кэш страниц, ожидание блокировки вместо
+# мгновенной ошибки "database is locked" и пул постоянных соединений.
+ENGINE_PROFILES = {
+    'default': {
+        'pragmas': {},
+        'pool': {},
+    },
+    'tuned': {
+        'pragmas': {
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'mmap_size': 256 * 1024 * 1024,
+            'cache_size': -64 * 1024,
+            'busy_timeout': 5000,
+            'temp_store': 'MEMORY',
+        },
+        'pool': {
+            'poolclass': sa.pool.QueuePool,
+            'pool_size': 8,
+            'max_overflow': 16,
+            'pool_timeout': 30,
+        },
+    },
+}
 
-def global_init(db_file):
-    global __factory
+
+# migrate=False - только подключение (для рабочих процессов сервера, когда
+# схему уже обновил главный процесс, см. gunicorn.conf.py)
+def global_init(db_file, profile='default', migrate=True):
+    global __factory, __engine
 
     if __factory:
         return
@@ -16,15 +49,167 @@ def global_init(db_file):
     if not db_file or not db_file.strip():
         raise Exception("Необходимо указать файл базы данных.")
 
+    if profile not in ENGINE_PROFILES:
+        raise Exception(f"Неизвестный профиль базы данных: {profile}")
+
     conn_str = f'sqlite:///{db_file.strip()}?check_same_thread=False'
-    print(f"Подключение к базе данных по адресу {conn_str}")
+    print(f"Подключение к базе данных по адресу {conn_str} (профиль {profile})")
 
-    engine = sa.create_engine(conn_str, echo=False)
+    engine = create_engine(conn_str, profile)
+    __engine = engine
     __factory = orm.sessionmaker(bind=engine)
 
+    # импорт ради побочного эффекта: модели регистрируются в SqlAlchemyBase.metadata
     from . import __all_models
 
-    SqlAlchemyBase.metadata.create_all(engine)
+    if migrate:
+        SqlAlchemyBase.metadata.create_all(engine)
+        added_columns = _add_missing_columns(engine)
+        _rebuild_foreign_keys(engine)
+        _create_missing_indexes(engine)
+
+    from . import changes, chapter_pages, compression, counters, reading_order, search
+    # импорт ради побочного эффекта: регистрация событий ORM, поднимающих версии сущностей
+    from . import versioning
+
+    session = create_session()
+    try:
+        compression.load_dictionaries(session)
+        search.init(engine, session)
+        if migrate:
+            reading_order.backfill(session)
+            chapter_pages.backfill(session)
+            changes.backfill(session)
+            counters.backfill(session, added_columns)
+    finally:
+        session.close()
+
+
+# закрыть все соединения пула и забыть движок - перед fork, чтобы дочерние
+# процессы не унаследовали открытые соединения SQLite и подключились заново
+def dispose():
+    global __factory, __engine
+    if __engine is not None:
+        __engine.dispose()
+    __factory = None
+    __engine = None
+
+
+def create_engine(conn_str, profile='default'):
+    settings = ENGINE_PROFILES[profile]
+    engine = sa.create_engine(conn_str, echo=False, **settings['pool'])
+    metrics.instrument_engine(engine)
+
+    # SQLite проверяет внешние ключи (и выполняет ON DELETE CASCADE), только если
+    # это включено на каждом соединении - в любом профиле
+    pragmas = {'foreign_keys': 'ON', **settings['pragmas']}
+
+    @sa.event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+    return engine
+
+
+# create_all не трогает существующие таблицы, поэтому колонки,
+# появившиеся в моделях позже, добавляются в старые файлы БД вручную.
+# Возвращает добавленные колонки в виде 'таблица.колонка'
+def _add_missing_columns(engine):
+    inspector = sa.inspect(engine)
+    added = set()
+    with engine.begin() as conn:
+        for table in SqlAlchemyBase.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(engine.dialect)
+                default = ''
+                if column.server_default is not None:
+                    default = f" DEFAULT '{column.server_default.arg}'"
+                conn.execute(sa.text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}{default}'))
+                added.add(f'{table.name}.{column.name}')
+    return added
+
+
+def _foreign_keys(table):
+    return {(tuple(fk.column_keys), (fk.ondelete or 'NO ACTION').upper()) for fk in table.foreign_key_constraints}
+
+
+# внешние ключи SQLite через ALTER TABLE не меняются, поэтому таблица, у которой
+# ON DELETE в файле БД расходится с моделью, пересоздается по модели с переносом
+# строк (порядок из документации SQLite: новая таблица, копирование, удаление
+# старой, переименование). Строки, родитель которых уже удален, не переносятся -
+# каскад удалил бы их. Индексы затем создает _create_missing_indexes
+def _rebuild_foreign_keys(engine):
+    inspector = sa.inspect(engine)
+    stale = []
+    for table in SqlAlchemyBase.metadata.sorted_tables:
+        existing = {(tuple(fk['constrained_columns']), (fk['options'].get('ondelete') or 'NO ACTION').upper())
+                    for fk in inspector.get_foreign_keys(table.name)}
+        if existing != _foreign_keys(table):
+            stale.append((table, [column['name'] for column in inspector.get_columns(table.name)]))
+    if not stale:
+        return
+
+    with engine.connect() as conn:
+        # внутри транзакции PRAGMA foreign_keys не действует
+        conn.exec_driver_sql('PRAGMA foreign_keys=OFF')
+        try:
+            with conn.begin():
+                # DDL в одной транзакции с копированием - иначе драйвер выполнит его сразу
+                conn.exec_driver_sql('BEGIN')
+                for table, columns in stale:
+                    _rebuild_table(conn, table, columns)
+        finally:
+            conn.exec_driver_sql('PRAGMA foreign_keys=ON')
+    print(f"Пересозданы таблицы с новыми внешними ключами: {', '.join(table.name for table, _ in stale)}")
+
+
+def _rebuild_table(conn, table, existing_columns):
+    name, temp = table.name, f'{table.name}_rebuild'
+    ddl = str(sa.schema.CreateTable(table).compile(dialect=conn.dialect))
+    conn.exec_driver_sql(ddl.replace(f'CREATE TABLE {name} (', f'CREATE TABLE {temp} (', 1))
+
+    columns = ', '.join(column.name for column in table.columns if column.name in existing_columns)
+    conditions = []
+    for fk in table.foreign_key_constraints:
+        if (fk.ondelete or '').upper() != 'CASCADE' or fk.referred_table is table:
+            continue
+        column, target = fk.elements[0].parent.name, fk.elements[0].column
+        conditions.append(f'({column} IS NULL OR {column} IN (SELECT {target.name} FROM {target.table.name}))')
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ''
+    conn.exec_driver_sql(f'INSERT INTO {temp} ({columns}) SELECT {columns} FROM {name}{where}')
+    conn.exec_driver_sql(f'DROP TABLE {name}')
+    conn.exec_driver_sql(f'ALTER TABLE {temp} RENAME TO {name}')
+
+    # ссылки на строки той же таблицы (ответы на удаленные комментарии)
+    for fk in table.foreign_key_constraints:
+        if (fk.ondelete or '').upper() == 'CASCADE' and fk.referred_table is table:
+            column, target = fk.elements[0].parent.name, fk.elements[0].column.name
+            while conn.exec_driver_sql(
+                f'DELETE FROM {name} WHERE {column} IS NOT NULL AND {column} NOT IN (SELECT {target} FROM {name})'
+            ).rowcount:
+                pass
+
+
+# то же для индексов, объявленных в __table_args__ моделей
+def _create_missing_indexes(engine):
+    # имена берутся из sqlite_master: рефлексия SQLAlchemy пропускает индексы по выражениям
+    with engine.connect() as conn:
+        existing = {name for name, in conn.exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    for table in SqlAlchemyBase.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            try:
+                index.create(bind=engine)
+            except sa.exc.IntegrityError:
+                # уникальный индекс не создать, пока в таблице есть дубликаты
+                print(f"Не удалось создать индекс {index.name}: в таблице {table.name} есть повторяющиеся значения")
 
 
 def create_session() -> Session:
@@ -0,0 +1,123 @@
+import datetime
+import os
+import time
+
+import sqlalchemy as sa
+
+from . import cache, changes, db_session, export, search, versioning
+from .background import PeriodicFlusher
+from .chapter import Chapter
+from .db_session import SqlAlchemyBase
+from .ranobe import Ranobe
+from .volume import Volume
+
+# Удаление ранобе в фоне.
+#
+# Ранобе с тысячами глав нельзя удалить одним запросом: каскад держит
+# блокировку записи SQLite, пока не удалит все главы и комментарии. Поэтому
+# маршрут только записывает задание в deletion_jobs (ранобе сразу пропадает из
+# каталога и поиска), а фоновый поток удаляет главы пачками по BATCH_SIZE,
+# каждую в своей транзакции с паузой BATCH_PAUSE между ними - между пачками
+# успевают пройти другие записи. Комментарии и позиции чтения удаляемых глав
+# удаляет сама БД (ON DELETE CASCADE). Последняя транзакция удаляет пустое
+# ранобе вместе с томами и задание.
+#
+# Задания лежат в БД, поэтому прерванное удаление продолжается после
+# перезапуска (wake при старте процесса). Если удаление выполняют
+# несколько процессов сразу, они просто делят пачки между собой.
+
+BATCH_SIZE = int(os.environ.get('RANOBE_DELETE_BATCH', 50))
+BATCH_PAUSE = float(os.environ.get('RANOBE_DELETE_PAUSE', 0.05))
+INTERVAL = float(os.environ.get('RANOBE_DELETE_INTERVAL', 60))
+
+_chapters = Chapter.__table__
+
+
+class DeletionJob(SqlAlchemyBase):
+    __tablename__ = 'deletion_jobs'
+
+    id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
+    ranobe_id = sa.Column(sa.Integer, nullable=False, unique=True)
+    created_date = sa.Column(sa.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+
+# условие для запросов каталога и страниц: ранобе не ждет удаления;
+# ranobe_id - колонка с id ранобе (Chapter.ranobe_id, Volume.ranobe_id)
+def not_pending(ranobe_id=Ranobe.id):
+    return ranobe_id.not_in(sa.select(DeletionJob.ranobe_id))
+
+
+# поставить ранобе в очередь на удаление; commit - за вызывающим
+def schedule(db_sess, ranobe_id):
+    if not db_sess.query(DeletionJob.id).filter(DeletionJob.ranobe_id == ranobe_id).first():
+        db_sess.add(DeletionJob(ranobe_id=ranobe_id))
+    search.unindex_ranobe(db_sess.connection(), ranobe_id)
+
+
+# удалить следующую пачку глав; True - глав больше нет и ранобе удалено.
+# Счетчики глав и комментариев ранобе в очереди не поддерживаются: оно уже скрыто,
+# а последняя транзакция удаляет его целиком
+def _delete_batch(ranobe_id):
+    db_sess = db_session.create_session()
+    try:
+        connection = db_sess.connection()
+        rows = db_sess.query(Chapter.id, Chapter.volume_id) \
+            .join(Volume, Chapter.volume_id == Volume.id) \
+            .filter(Volume.ranobe_id == ranobe_id) \
+            .order_by(Chapter.id) \
+            .limit(BATCH_SIZE) \
+            .all()
+
+        if rows:
+            ids = [row.id for row in rows]
+            search.unindex_chapters(connection, ids)
+            connection.execute(_chapters.delete().where(_chapters.c.id.in_(ids)))
+            changes.record(connection, changes.CHAPTER, ids, deleted=True)
+            for volume_id in {row.volume_id for row in rows}:
+                versioning.touch_volume(connection, volume_id)
+            db_sess.commit()
+            cache.invalidate(keys=[cache.page_key('chapter', id) for id in ids] +
+                                  [cache.chapter_key(id) for id in ids])
+            return False
+
+        stale_keys = cache.ranobe_keys(db_sess, ranobe_id)
+        volume_ids = [id for id, in db_sess.query(Volume.id).filter(Volume.ranobe_id == ranobe_id)]
+        search.unindex_ranobe(connection, ranobe_id)
+        connection.execute(Ranobe.__table__.delete().where(Ranobe.id == ranobe_id))
+        changes.record(connection, changes.VOLUME, volume_ids, deleted=True)
+        changes.record(connection, changes.RANOBE, [ranobe_id], deleted=True)
+        connection.execute(DeletionJob.__table__.delete().where(DeletionJob.ranobe_id == ranobe_id))
+        db_sess.commit()
+    finally:
+        db_sess.close()
+
+    cache.invalidate(stale_keys)
+    cache.invalidate_catalogue()
+    export.remove_cached(ranobe_id)
+    return True
+
+
+# удалить ранобе до конца пачками (в текущем потоке)
+def delete_ranobe(ranobe_id):
+    while not _delete_batch(ranobe_id):
+        time.sleep(BATCH_PAUSE)
+
+
+def run_pending():
+    db_sess = db_session.create_session()
+    try:
+        ranobe_ids = [id for id, in db_sess.query(DeletionJob.ranobe_id).order_by(DeletionJob.id)]
+    finally:
+        db_sess.close()
+    for ranobe_id in ranobe_ids:
+        delete_ranobe(ranobe_id)
+    return len(ranobe_ids)
+
+
+_runner = PeriodicFlusher('ranobe-deletion', run_pending, INTERVAL)
+
+
+# выполнить задания сейчас в фоновом потоке: после постановки задания и при
+# старте процесса - чтобы доделать прерванные перезапуском
+def wake():
+    _runner.wake()
@@ -0,0 +1,295 @@
+import glob
+import os
+import re
+import uuid
+import zipfile
+from io import BytesIO
+from xml.sax.saxutils import escape
+
+from . import db_session
+from .chapter import Chapter
+from .ranobe import Ranobe
+from .volume import Volume
+
+# Выгрузка ранобе или тома в EPUB, FB2 или текст.
+#
+# Главы читаются одним запросом с серверным курсором (yield_per) и сразу
+# превращаются в байты ответа - книга целиком в памяти не собирается.
+# Параллельно ответ пишется во временный файл, который после успешной выгрузки
+# становится кэшем: имя файла содержит версию ранобе, а она увеличивается
+# при любом изменении ранобе, его томов и глав (см. data/versioning.py).
+
+EXPORT_DIR = os.environ.get('RANOBE_EXPORT_DIR', os.path.join('db', 'exports'))
+CHAPTER_BATCH_SIZE = 50
+
+FORMATS = {
+    'epub': 'application/epub+zip',
+    'fb2': 'application/x-fictionbook+xml',
+    'txt': 'text/plain; charset=utf-8',
+}
+
+
+class Book:
+    def __init__(self, ranobe, volume=None):
+        self.ranobe_id = ranobe.id
+        self.title = ranobe.title if volume is None else f"{ranobe.title}. {volume.display_title}"
+        self.description = ranobe.description or ''
+        self.volume_id = volume.id if volume is not None else None
+        self.version = ranobe.version
+        self.updated_date = ranobe.updated_date or ranobe.created_date
+        self.name = f'ranobe-{ranobe.id}' if volume is None else f'ranobe-{ranobe.id}-volume-{volume.volume_number}'
+
+    def filename(self, format):
+        return f'{self.name}.{format}'
+
+    def etag(self, format):
+        return f'{self.name}-v{self.version}-{format}'
+
+
+def find_book(db_sess, ranobe_id, volume_number=None):
+    ranobe = db_sess.query(Ranobe).get(ranobe_id)
+    if not ranobe:
+        return None
+    if volume_number is None:
+        return Book(ranobe)
+    volume = db_sess.query(Volume).filter(
+        Volume.ranobe_id == ranobe_id,
+        Volume.volume_number == volume_number
+    ).first()
+    return Book(ranobe, volume) if volume else None
+
+
+def cached_path(book, format):
+    return os.path.join(EXPORT_DIR, f'{book.name}-v{book.version}.{format}')
+
+
+# главы по порядку томов и номеров; текст приходит пачками по CHAPTER_BATCH_SIZE строк
+def _chapters(db_sess, book):
+    query = db_sess.query(Chapter.id, Chapter.title, Chapter.chapter_number, Chapter.content,
+                          Volume.volume_number, Volume.title.label('volume_title')) \
+        .join(Volume, Chapter.volume_id == Volume.id) \
+        .filter(Volume.ranobe_id == book.ranobe_id)
+    if book.volume_id is not None:
+        query = query.filter(Volume.id == book.volume_id)
+    return query.order_by(Volume.volume_number, Chapter.chapter_number) \
+        .execution_options(stream_results=True) \
+        .yield_per(CHAPTER_BATCH_SIZE)
+
+
+def _volume_title(chapter):
+    return chapter.volume_title or f"Том {chapter.volume_number}"
+
+
+def _chapter_title(chapter):
+    return f"Глава {chapter.chapter_number}: {chapter.title}"
+
+
+def _paragraphs(content):
+    return [line.strip() for line in (content or '').splitlines() if line.strip()]
+
+
+# Текст
+
+def _write_txt(book, chapters):
+    header = book.title + '\n\n'
+    if book.description:
+        header += book.description.strip() + '\n\n'
+    yield header.encode('utf-8')
+
+    volume = None
+    for chapter in chapters:
+        parts = []
+        if book.volume_id is None and chapter.volume_number != volume:
+            volume = chapter.volume_number
+            parts.append(f"\n{_volume_title(chapter)}\n\n")
+        parts.append(f"{_chapter_title(chapter)}\n\n")
+        parts.append('\n\n'.join(_paragraphs(chapter.content)) + '\n\n\n')
+        yield ''.join(parts).encode('utf-8')
+
+
+# FB2
+
+def _fb2_section(title, paragraphs):
+    body = ''.join(f'<p>{escape(p)}</p>' for p in paragraphs) or '<empty-line/>'
+    return f'<section><title><p>{escape(title)}</p></title>{body}</section>\n'
+
+
+def _write_fb2(book, chapters):
+    annotation = ''.join(f'<p>{escape(p)}</p>' for p in _paragraphs(book.description))
+    yield (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<FictionBook xmlns="http://www.gribuser.ru/xml/fictionbook/2.0">\n'
+        '<description><title-info>'
+        f'<book-title>{escape(book.title)}</book-title>'
+        f'{f"<annotation>{annotation}</annotation>" if annotation else ""}'
+        '<lang>ru</lang>'
+        '</title-info></description>\n'
+        f'<body><title><p>{escape(book.title)}</p></title>\n'
+    ).encode('utf-8')
+
+    volume = None
+    for chapter in chapters:
+        parts = []
+        if book.volume_id is None and chapter.volume_number != volume:
+            if volume is not None:
+                parts.append('</section>\n')
+            volume = chapter.volume_number
+            parts.append(f'<section><title><p>{escape(_volume_title(chapter))}</p></title>\n')
+        parts.append(_fb2_section(_chapter_title(chapter), _paragraphs(chapter.content)))
+        yield ''.join(parts).encode('utf-8')
+
+    yield (('</section>\n' if volume is not None else '') + '</body>\n</FictionBook>\n').encode('utf-8')
+
+
+# EPUB
+
+# файл для zipfile, из которого генератор забирает готовые байты после каждой записи.
+# zipfile возвращается к заголовку только что записанного файла, поэтому seek
+# поддерживается в пределах еще не отданного буфера
+class _ZipPipe:
+    def __init__(self):
+        self._buffer = BytesIO()
+        self._offset = 0
+
+    def write(self, data):
+        return self._buffer.write(data)
+
+    def tell(self):
+        return self._offset + self._buffer.tell()
+
+    def seek(self, position, whence=os.SEEK_SET):
+        if whence == os.SEEK_END:
+            return self._offset + self._buffer.seek(position, whence)
+        if position < self._offset:
+            raise OSError("Данные уже отправлены")
+        return self._offset + self._buffer.seek(position - self._offset)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = self._buffer.getvalue()
+        self._offset += len(data)
+        self._buffer = BytesIO()
+        return data
+
+
+_XHTML = (
+    '<?xml version="1.0" encoding="utf-8"?>\n'
+    '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="ru" xml:lang="ru">\n'
+    '<head><meta charset="utf-8"/><title>{title}</title></head>\n'
+    '<body>{body}</body>\n</html>\n'
+)
+
+_CONTAINER = (
+    '<?xml version="1.0" encoding="utf-8"?>\n'
+    '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+    '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles>'
+    '</container>\n'
+)
+
+
+def _epub_nav(book, toc):
+    items, volume = [], None
+    for name, chapter_title, volume_number, volume_title in toc:
+        if book.volume_id is None and volume_number != volume:
+            if volume is not None:
+                items.append('</ol></li>')
+            volume = volume_number
+            items.append(f'<li><span>{escape(volume_title)}</span><ol>')
+        items.append(f'<li><a href="{name}">{escape(chapter_title)}</a></li>')
+    if volume is not None:
+        items.append('</ol></li>')
+    body = f'<nav epub:type="toc"><h1>{escape(book.title)}</h1><ol>{"".join(items)}</ol></nav>'
+    return _XHTML.format(title=escape(book.title), body=body)
+
+
+def _epub_opf(book, toc):
+    manifest = ''.join(f'<item id="c{i}" href="{name}" media-type="application/xhtml+xml"/>'
+                       for i, (name, *_) in enumerate(toc))
+    spine = ''.join(f'<itemref idref="c{i}"/>' for i in range(len(toc)))
+    modified = book.updated_date.strftime('%Y-%m-%dT%H:%M:%SZ') if book.updated_date else ''
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="id">'
+        '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">'
+        f'<dc:identifier id="id">urn:ranobe:{book.name}</dc:identifier>'
+        f'<dc:title>{escape(book.title)}</dc:title>'
+        '<dc:language>ru</dc:language>'
+        f'<dc:description>{escape(book.description)}</dc:description>'
+        f'<meta property="dcterms:modified">{modified}</meta>'
+        '</metadata>'
+        '<manifest><item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>'
+        f'{manifest}</manifest>'
+        f'<spine>{spine}</spine>'
+        '</package>\n'
+    )
+
+
+def _write_epub(book, chapters):
+    pipe = _ZipPipe()
+    epub = zipfile.ZipFile(pipe, 'w', zipfile.ZIP_DEFLATED)
+    # mimetype - первый и несжатый файл архива
+    epub.writestr(zipfile.ZipInfo('mimetype'), 'application/epub+zip', zipfile.ZIP_STORED)
+    epub.writestr('META-INF/container.xml', _CONTAINER)
+    yield pipe.drain()
+
+    toc = []
+    for chapter in chapters:
+        name = f'chapter-{chapter.id}.xhtml'
+        title = _chapter_title(chapter)
+        body = f'<h2>{escape(title)}</h2>' + ''.join(f'<p>{escape(p)}</p>' for p in _paragraphs(chapter.content))
+        epub.writestr(f'OEBPS/{name}', _XHTML.format(title=escape(title), body=body))
+        toc.append((name, title, chapter.volume_number, _volume_title(chapter)))
+        yield pipe.drain()
+
+    epub.writestr('OEBPS/nav.xhtml', _epub_nav(book, toc))
+    epub.writestr('OEBPS/content.opf', _epub_opf(book, toc))
+    epub.close()
+    yield pipe.drain()
+
+
+_WRITERS = {'epub': _write_epub, 'fb2': _write_fb2, 'txt': _write_txt}
+
+
+# удалить выгрузки прошлых версий той же книги
+def _remove_stale(book, format, keep):
+    pattern = re.compile(rf'{re.escape(book.name)}-v\d+\.{format}')
+    for path in glob.glob(os.path.join(EXPORT_DIR, f'{book.name}-v*.{format}')):
+        if path != keep and pattern.fullmatch(os.path.basename(path)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+# удалить все выгрузки ранобе и его томов (ранобе удалено)
+def remove_cached(ranobe_id):
+    pattern = re.compile(rf'ranobe-{ranobe_id}(-volume-\d+)?-v\d+\.\w+')
+    for path in glob.glob(os.path.join(EXPORT_DIR, f'ranobe-{ranobe_id}-*')):
+        if pattern.fullmatch(os.path.basename(path)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+# поток байтов выгрузки; файл кэша появляется только если выгрузка дошла до конца
+def generate(book, format):
+    path = cached_path(book, format)
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    db_sess = db_session.create_session()
+    done = False
+    try:
+        with open(tmp_path, 'wb') as file:
+            for chunk in _WRITERS[format](book, _chapters(db_sess, book)):
+                file.write(chunk)
+                yield chunk
+        os.replace(tmp_path, path)
+        done = True
+        _remove_stale(book, format, path)
+    finally:
+        db_sess.close()
+        if not done and os.path.exists(tmp_path):
+            os.remove(tmp_path)
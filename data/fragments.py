@@ -0,0 +1,73 @@
+import os
+
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+from . import cache
+
+# Кэш фрагментов шаблонов и байткода Jinja.
+#
+# {% cache 'имя', ключ1, ключ2 %}...{% endcache %} сохраняет готовый HTML блока
+# под ключом имя:ключ1:ключ2 в отдельном небольшом LRU процесса (размер -
+# RANOBE_FRAGMENT_CACHE_SIZE): фрагментов на странице много, и в общем кэше
+# ответов они вытесняли бы целые страницы. В ключ входит версия сущности
+# (version строки из data/versioning.py), поэтому после изменения просто
+# строится новый фрагмент, а старый вытесняется LRU и сроком жизни. Блок - один
+# целый элемент, внутри не должно быть ничего, что зависит от пользователя:
+# кнопки владельца и формы остаются снаружи.
+#
+# Скомпилированные шаблоны сохраняются на диск (FileSystemBytecodeCache, по
+# умолчанию во временном каталоге пользователя) и при старте процесса
+# загружаются все сразу - первые запросы свежего рабочего процесса не компилируют
+# шаблоны. Байткод сверяется с исходником по контрольной сумме, поэтому после
+# правки шаблона он пересобирается сам.
+
+BYTECODE_DIR = os.environ.get('RANOBE_TEMPLATE_CACHE')
+FRAGMENT_CACHE_SIZE = int(os.environ.get('RANOBE_FRAGMENT_CACHE_SIZE', 512))
+
+_fragments = cache.LRUCache(FRAGMENT_CACHE_SIZE, cache.TTL)
+
+
+class FragmentCacheExtension(Extension):
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        parts = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            parts.append(parser.parse_expression())
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render', [nodes.List(parts)]), [], [], body) \
+            .set_lineno(lineno)
+
+    def _render(self, parts, caller):
+        key = ':'.join(str(part) for part in parts)
+        html = _fragments.get(key)
+        if html is None:
+            html = str(caller())
+            _fragments.set(key, html)
+        return Markup(html)
+
+
+def clear():
+    _fragments.clear()
+
+
+def stats():
+    return _fragments.stats()
+
+
+def configure(env):
+    env.add_extension(FragmentCacheExtension)
+    if BYTECODE_DIR:
+        os.makedirs(BYTECODE_DIR, exist_ok=True)
+    env.bytecode_cache = FileSystemBytecodeCache(BYTECODE_DIR)
+
+
+# скомпилировать (или загрузить из байткода) все шаблоны заранее
+def precompile(env):
+    names = env.list_templates(extensions=('html',))
+    for name in names:
+        env.get_template(name)
+    return len(names)
@@ -0,0 +1,202 @@
+import logging
+import os
+import threading
+import time
+
+import jinja2
+import sqlalchemy as sa
+
+# Метрики запросов.
+#
+# На каждый HTTP-запрос считаются: общее время, число SQL-запросов и время в БД
+# (события before/after_cursor_execute движка), время рендеринга шаблонов и
+# размер ответа. Итог уходит в гистограммы по маршруту, которые /metrics
+# отдает в текстовом формате Prometheus, и в заголовок Server-Timing.
+# Запросы дольше SLOW_REQUEST_MS пишутся в лог ranobe.slow вместе со всеми
+# выполненными SQL - так сразу видно, где появился N+1.
+#
+# Метрики у каждого процесса свои: при нескольких рабочих процессах gunicorn
+# Prometheus видит тот процесс, который ответил на запрос /metrics.
+
+SLOW_REQUEST_MS = float(os.environ.get('RANOBE_SLOW_REQUEST_MS', 500))
+# сколько SQL на запрос хранить для лога медленных запросов
+MAX_STATEMENTS = 200
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+slow_log = logging.getLogger('ranobe.slow')
+
+
+class Histogram:
+    def __init__(self, name, help, labels, buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            counts = series[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted(self._series.items())
+            series = [(labels, list(counts), total, count) for labels, (counts, total, count) in series]
+        for label_values, counts, total, count in series:
+            labels = [f'{name}="{_escape(value)}"' for name, value in zip(self.labels, label_values)]
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{_labels(labels, bound)} {bucket_count}')
+            lines.append(f'{self.name}_bucket{_labels(labels, "+Inf")} {count}')
+            lines.append(f'{self.name}_sum{_labels(labels)} {total}')
+            lines.append(f'{self.name}_count{_labels(labels)} {count}')
+        return lines
+
+
+def _labels(labels, le=None):
+    if le is not None:
+        labels = labels + [f'le="{le}"']
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+REQUEST_SECONDS = Histogram('ranobe_http_request_duration_seconds', 'Время обработки запроса',
+                            ('method', 'route', 'status'), LATENCY_BUCKETS)
+DB_SECONDS = Histogram('ranobe_http_db_seconds', 'Время SQL-запросов за HTTP-запрос',
+                       ('route',), LATENCY_BUCKETS)
+DB_QUERIES = Histogram('ranobe_http_db_queries', 'Число SQL-запросов за HTTP-запрос',
+                       ('route',), QUERY_COUNT_BUCKETS)
+TEMPLATE_SECONDS = Histogram('ranobe_http_template_seconds', 'Время рендеринга шаблонов за HTTP-запрос',
+                             ('route',), LATENCY_BUCKETS)
+RESPONSE_BYTES = Histogram('ranobe_http_response_size_bytes', 'Размер тела ответа (без потоковых)',
+                           ('route',), SIZE_BUCKETS)
+HISTOGRAMS = (REQUEST_SECONDS, DB_SECONDS, DB_QUERIES, TEMPLATE_SECONDS, RESPONSE_BYTES)
+
+# дополнительные показатели: имя -> функция, возвращающая словарь чисел
+_collectors = {}
+
+
+def add_collector(name, collect):
+    _collectors[name] = collect
+
+
+# Учет одного запроса
+
+class RequestStats:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.db_time = 0.0
+        self.db_queries = 0
+        self.template_time = 0.0
+        self.statements = []
+
+
+_local = threading.local()
+
+
+def _current():
+    return getattr(_local, 'request', None)
+
+
+def start_request():
+    _local.request = RequestStats()
+
+
+def discard_request():
+    _local.request = None
+
+
+# закрыть учет запроса; возвращает значение заголовка Server-Timing
+def finish_request(method, route, status, size):
+    stats = _current()
+    if stats is None:
+        return None
+    _local.request = None
+
+    elapsed = time.perf_counter() - stats.start
+    REQUEST_SECONDS.observe(elapsed, method, route, str(status))
+    DB_SECONDS.observe(stats.db_time, route)
+    DB_QUERIES.observe(stats.db_queries, route)
+    TEMPLATE_SECONDS.observe(stats.template_time, route)
+    if size is not None:
+        RESPONSE_BYTES.observe(size, route)
+
+    if elapsed * 1000 >= SLOW_REQUEST_MS:
+        _log_slow(method, route, status, elapsed, stats)
+
+    return ', '.join([
+        f'db;dur={stats.db_time * 1000:.1f};desc="{stats.db_queries} queries"',
+        f'tpl;dur={stats.template_time * 1000:.1f}',
+        f'total;dur={elapsed * 1000:.1f}',
+    ])
+
+
+def _log_slow(method, route, status, elapsed, stats):
+    lines = [f'{method} {route} {status}: {elapsed * 1000:.0f} мс, SQL: {stats.db_queries} '
+             f'за {stats.db_time * 1000:.0f} мс, шаблоны: {stats.template_time * 1000:.0f} мс']
+    lines += [f'  {duration * 1000:7.1f} мс  {" ".join(statement.split())}' for statement, duration in stats.statements]
+    if stats.db_queries > len(stats.statements):
+        lines.append(f'  ... еще {stats.db_queries - len(stats.statements)}')
+    slow_log.warning('\n'.join(lines))
+
+
+# SQL
+
+def instrument_engine(engine):
+    @sa.event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @sa.event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_start'].pop()
+        stats = _current()
+        if stats is None:
+            return
+        stats.db_time += elapsed
+        stats.db_queries += 1
+        if len(stats.statements) < MAX_STATEMENTS:
+            stats.statements.append((statement, elapsed))
+
+
+# Шаблоны: шаблон верхнего уровня рендерится одним вызовом render(),
+# вместе с extends и include, поэтому время не считается дважды
+
+class TimedTemplate(jinja2.Template):
+    def render(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            stats = _current()
+            if stats is not None:
+                stats.template_time += time.perf_counter() - start
+
+
+# Экспорт
+
+def render():
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines += histogram.render()
+    for name, collect in sorted(_collectors.items()):
+        for key, value in sorted(collect().items()):
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                metric = f'ranobe_{name}_{key}'
+                lines += [f'# TYPE {metric} gauge', f'{metric} {value}']
+    return '\n'.join(lines) + '\n'
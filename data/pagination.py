@@ -0,0 +1,63 @@
+import base64
+import binascii
+import json
+
+import sqlalchemy
+
+
+class CursorError(ValueError):
+    pass
+
+
+# курсор - это значения ключа сортировки последней строки страницы,
+# упакованные в json и base64, чтобы клиент передавал его как есть
+def encode_cursor(*values):
+    raw = json.dumps(values, ensure_ascii=False).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, size):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw.decode('utf-8'))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise CursorError('Invalid cursor')
+
+    if not isinstance(values, list) or len(values) != size:
+        raise CursorError('Invalid cursor')
+    return values
+
+
+# курсор для выдачи, которую нельзя продолжить по ключу (например, по рангу поиска)
+def decode_offset(cursor):
+    if not cursor:
+        return 0
+    offset = decode_cursor(cursor, 1)[0]
+    if not isinstance(offset, int) or offset < 0:
+        raise CursorError('Invalid cursor')
+    return offset
+
+
+def parse_limit(value, default, maximum):
+    if value is None or value == '':
+        return default
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        raise ValueError('limit must be an integer')
+    if limit < 1:
+        raise ValueError('limit must be positive')
+    return min(limit, maximum)
+
+
+# keyset-пагинация: вместо OFFSET продолжаем с места, где закончилась
+# прошлая страница, поэтому стоимость запроса не растет с номером страницы
+def keyset_page(query, key_columns, after, limit, descending=False):
+    if after is not None:
+        key = sqlalchemy.tuple_(*key_columns)
+        bound = sqlalchemy.tuple_(*[sqlalchemy.literal(v, type_=c.type) for v, c in zip(after, key_columns)])
+        query = query.filter(key < bound if descending else key > bound)
+
+    order = [c.desc() for c in key_columns] if descending else list(key_columns)
+    rows = query.order_by(*order).limit(limit + 1).all()
+    return rows[:limit], len(rows) > limit
@@ -6,6 +6,10 @@ from .db_session import SqlAlchemyBase
 
 class Ranobe(SqlAlchemyBase, SerializerMixin):
     __tablename__ = 'ranobe'
+    __table_args__ = (
+        # покрывает сортировку каталога и keyset-пагинацию по (title, id)
+        sqlalchemy.Index('ix_ranobe_title_id', 'title', 'id'),
+    )
 
     id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True, autoincrement=True)
     title = sqlalchemy.Column(sqlalchemy.String, nullable=False)
@@ -14,8 +18,20 @@ class Ranobe(SqlAlchemyBase, SerializerMixin):
     author_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('users.id'))
     created_date = sqlalchemy.Column(sqlalchemy.DateTime, default=sqlalchemy.func.now())
 
+    # версия строки и время последнего изменения (UTC) для ETag/Last-Modified,
+    # поддерживаются data/versioning.py
+    version = sqlalchemy.Column(sqlalchemy.Integer, nullable=False, default=1, server_default='1')
+    updated_date = sqlalchemy.Column(sqlalchemy.DateTime, nullable=True)
+
+    # счетчики для карточек и страницы ранобе, поддерживаются data/counters.py
+    chapter_count = sqlalchemy.Column(sqlalchemy.Integer, nullable=False, default=0, server_default='0')
+    comment_count = sqlalchemy.Column(sqlalchemy.Integer, nullable=False, default=0, server_default='0')
+    last_chapter_at = sqlalchemy.Column(sqlalchemy.DateTime, nullable=True)
+    view_count = sqlalchemy.Column(sqlalchemy.Integer, nullable=False, default=0, server_default='0')
+
     author = orm.relationship('User')
-    volumes = orm.relationship('Volume', back_populates='ranobe', cascade='all, delete-orphan')
+    # тома, главы и комментарии удаляет сама БД (ON DELETE CASCADE), ORM их не загружает
+    volumes = orm.relationship('Volume', back_populates='ranobe', cascade='all, delete-orphan', passive_deletes=True)
 
     def __repr__(self):
         return f'<Ranobe {self.id} {self.title}>'
@@ -0,0 +1,61 @@
+import sqlalchemy as sa
+
+from .chapter import Chapter
+from .volume import Volume
+
+# Сквозной порядок чтения глав ранобе: том за томом, внутри тома по номеру главы.
+# Позиция хранится в Chapter.reading_order, поэтому соседние главы (в том числе
+# через границу тома) находятся одним запросом по индексу (ranobe_id, reading_order).
+
+
+# пересчитать позиции глав ранобе; вызывается перед commit в маршрутах, которые
+# меняют состав или нумерацию глав. since=(номер тома, номер главы) - первое
+# затронутое место: главы до него не сдвигаются, пересчитывается только хвост
+def reindex_ranobe(db_sess, ranobe_id, since=None):
+    query = db_sess.query(Chapter.id, Chapter.ranobe_id, Chapter.reading_order) \
+        .join(Volume, Chapter.volume_id == Volume.id) \
+        .filter(Volume.ranobe_id == ranobe_id)
+
+    start = 0
+    if since is not None:
+        volume_number, chapter_number = since
+        before = sa.or_(Volume.volume_number < volume_number,
+                        sa.and_(Volume.volume_number == volume_number, Chapter.chapter_number < chapter_number))
+        start = query.filter(before).with_entities(sa.func.count()).scalar()
+        query = query.filter(sa.not_(before))
+
+    rows = query.order_by(Volume.volume_number, Chapter.chapter_number, Chapter.id).all()
+    changes = [
+        {'id': row.id, 'ranobe_id': ranobe_id, 'reading_order': position}
+        for position, row in enumerate(rows, start + 1)
+        if row.ranobe_id != ranobe_id or row.reading_order != position
+    ]
+    if changes:
+        db_sess.bulk_update_mappings(Chapter, changes)
+
+
+# заполнить порядок для глав, созданных до появления колонки
+def backfill(db_sess):
+    ranobe_ids = db_sess.query(Volume.ranobe_id) \
+        .join(Chapter, Chapter.volume_id == Volume.id) \
+        .filter(Chapter.reading_order.is_(None)) \
+        .distinct() \
+        .all()
+    for ranobe_id, in ranobe_ids:
+        reindex_ranobe(db_sess, ranobe_id)
+    db_sess.commit()
+
+
+# предыдущая и следующая глава (только id, номер и название)
+def get_neighbours(db_sess, chapter):
+    if chapter.reading_order is None:
+        return None, None
+
+    position = chapter.reading_order
+    rows = db_sess.query(Chapter.id, Chapter.title, Chapter.chapter_number, Chapter.reading_order) \
+        .filter(Chapter.ranobe_id == chapter.ranobe_id,
+                Chapter.reading_order.in_((position - 1, position + 1))) \
+        .all()
+
+    by_position = {row.reading_order: row for row in rows}
+    return by_position.get(position - 1), by_position.get(position + 1)
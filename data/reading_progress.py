@@ -0,0 +1,180 @@
+import atexit
+import datetime
+import os
+import threading
+
+import sqlalchemy as sa
+from sqlalchemy.dialects.sqlite import insert
+
+from . import db_session
+from .background import PeriodicFlusher
+from .chapter import Chapter
+from .db_session import SqlAlchemyBase
+from .ranobe import Ranobe
+from .volume import Volume
+
+# Где пользователь остановился в каждом ранобе.
+#
+# Клиенты присылают позицию каждые несколько секунд, поэтому record() не пишет
+# в БД, а кладет последнее значение в буфер процесса (одна запись на пару
+# пользователь-ранобе). Фоновый поток раз в FLUSH_INTERVAL секунд сбрасывает
+# весь буфер одной транзакцией с пакетным upsert. Чтение накладывает
+# несброшенные значения поверх БД, так что пользователь сразу видит свою запись.
+
+FLUSH_INTERVAL = float(os.environ.get('RANOBE_PROGRESS_FLUSH_INTERVAL', 5))
+# при таком размере буфер сбрасывается, не дожидаясь таймера
+MAX_PENDING = 5000
+
+
+class ReadingProgress(SqlAlchemyBase):
+    __tablename__ = 'reading_progress'
+    __table_args__ = (
+        sa.Index('ix_reading_progress_user_ranobe', 'user_id', 'ranobe_id', unique=True),
+        sa.Index('ix_reading_progress_user_updated', 'user_id', 'updated_at'),
+    )
+
+    id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
+    user_id = sa.Column(sa.Integer, sa.ForeignKey('users.id'), nullable=False)
+    ranobe_id = sa.Column(sa.Integer, sa.ForeignKey('ranobe.id', ondelete='CASCADE'), nullable=False)
+    chapter_id = sa.Column(sa.Integer, sa.ForeignKey('chapters.id', ondelete='CASCADE'), nullable=False)
+    # доля прокрутки главы, от 0 до 1
+    scroll_offset = sa.Column(sa.Float, nullable=False, default=0)
+    updated_at = sa.Column(sa.DateTime, nullable=False)
+
+
+class ProgressBuffer:
+    def __init__(self, interval=FLUSH_INTERVAL, max_pending=MAX_PENDING):
+        self.max_pending = max_pending
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flusher = PeriodicFlusher('reading-progress-flush', self.flush, interval)
+        self.flushes = 0
+        self.flushed_rows = 0
+
+    def put(self, user_id, ranobe_id, chapter_id, scroll_offset):
+        entry = {'user_id': user_id, 'ranobe_id': ranobe_id, 'chapter_id': chapter_id,
+                 'scroll_offset': scroll_offset, 'updated_at': datetime.datetime.utcnow()}
+        with self._lock:
+            self._pending[(user_id, ranobe_id)] = entry
+            size = len(self._pending)
+        self._flusher.start()
+        if size >= self.max_pending:
+            self._flusher.wake()
+        return entry
+
+    def pending_for(self, user_id):
+        with self._lock:
+            return [entry for (user, _), entry in self._pending.items() if user == user_id]
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return 0
+
+            statement = insert(ReadingProgress.__table__)
+            statement = statement.on_conflict_do_update(
+                index_elements=['user_id', 'ranobe_id'],
+                set_={
+                    'chapter_id': statement.excluded.chapter_id,
+                    'scroll_offset': statement.excluded.scroll_offset,
+                    'updated_at': statement.excluded.updated_at,
+                },
+                # другой процесс мог уже сохранить более свежую позицию
+                where=statement.excluded.updated_at >= ReadingProgress.__table__.c.updated_at
+            )
+            db_sess = db_session.create_session()
+            try:
+                # глава могла быть удалена, пока позиция ждала в буфере - такая запись нарушила бы внешний ключ
+                rows = list(batch.values())
+                existing = {id for id, in db_sess.query(Chapter.id)
+                            .filter(Chapter.id.in_({row['chapter_id'] for row in rows}))}
+                rows = [row for row in rows if row['chapter_id'] in existing]
+                if rows:
+                    db_sess.execute(statement, rows)
+                db_sess.commit()
+            except Exception:
+                db_sess.rollback()
+                # вернуть в буфер то, что не успели перезаписать более новые значения
+                with self._lock:
+                    for key, entry in batch.items():
+                        self._pending.setdefault(key, entry)
+                raise
+            finally:
+                db_sess.close()
+
+            self.flushes += 1
+            self.flushed_rows += len(batch)
+            return len(batch)
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._pending)
+        return {'pending': pending, 'flushes': self.flushes, 'flushed_rows': self.flushed_rows}
+
+
+_buffer = ProgressBuffer()
+atexit.register(lambda: _buffer.flush())
+
+
+def record(user_id, ranobe_id, chapter_id, scroll_offset):
+    return _buffer.put(user_id, ranobe_id, chapter_id, scroll_offset)
+
+
+def flush():
+    return _buffer.flush()
+
+
+def stats():
+    return _buffer.stats()
+
+
+# прогресс пользователя (по всем ранобе или по одному), новые сверху,
+# вместе с названиями ранобе и глав - два запроса независимо от числа записей.
+# Записи об удаленных главах пропускаются до отсечения limit, чтобы они не
+# занимали места в выдаче
+def get_progress(db_sess, user_id, ranobe_id=None, limit=None):
+    query = db_sess.query(ReadingProgress.ranobe_id, ReadingProgress.chapter_id,
+                          ReadingProgress.scroll_offset, ReadingProgress.updated_at) \
+        .filter(ReadingProgress.user_id == user_id)
+    if ranobe_id is not None:
+        query = query.filter(ReadingProgress.ranobe_id == ranobe_id)
+    entries = {row.ranobe_id: row._asdict() for row in query}
+
+    for entry in _buffer.pending_for(user_id):
+        if ranobe_id is None or entry['ranobe_id'] == ranobe_id:
+            entries[entry['ranobe_id']] = entry
+
+    entries = sorted(entries.values(), key=lambda entry: entry['updated_at'], reverse=True)
+    if not entries:
+        return []
+
+    chapters = {
+        row.id: row for row in
+        db_sess.query(Chapter.id, Chapter.title, Chapter.chapter_number,
+                      Volume.volume_number, Ranobe.title.label('ranobe_title'))
+        .join(Volume, Chapter.volume_id == Volume.id)
+        .join(Ranobe, Volume.ranobe_id == Ranobe.id)
+        .filter(Chapter.id.in_([entry['chapter_id'] for entry in entries]))
+    }
+
+    result = []
+    for entry in entries:
+        if limit is not None and len(result) >= limit:
+            break
+        chapter = chapters.get(entry['chapter_id'])
+        if chapter is None:
+            continue
+        result.append({
+            'ranobe_id': entry['ranobe_id'],
+            'ranobe_title': chapter.ranobe_title,
+            'chapter_id': entry['chapter_id'],
+            'chapter_title': chapter.title,
+            'chapter_number': chapter.chapter_number,
+            'volume_number': chapter.volume_number,
+            'scroll_offset': entry['scroll_offset'],
+            'updated_at': entry['updated_at'].isoformat()
+        })
+    return result
@@ -0,0 +1,174 @@
+import sqlalchemy as sa
+from sqlalchemy import orm
+
+from . import chapter_pages, pagination
+from .chapter import Chapter
+from .chapter_pages import ChapterPage
+from .comment import Comment
+from .ranobe import Ranobe
+from .volume import Volume
+
+# Запросы, которые отдают страницам уже готовый граф объектов.
+# Все связи, к которым обращаются шаблоны, загружаются здесь заранее,
+# поэтому шаблон не делает ленивых SELECT и работает даже после закрытия сессии.
+
+
+# глава с текстом вместе с томом и ранобе - один запрос;
+# content=False - без текста (страница главы читает готовый HTML кусками)
+def get_chapter(db_sess, chapter_id, *criteria, content=True):
+    options = [orm.joinedload(Chapter.volume).joinedload(Volume.ranobe)]
+    if content:
+        options.append(orm.undefer(Chapter.content))
+    return db_sess.query(Chapter) \
+        .options(*options) \
+        .filter(Chapter.id == chapter_id, *criteria) \
+        .first()
+
+
+# смещения страниц готового HTML главы и его размер в байтах; None - главы нет.
+# Глава без HTML (записанная в обход ORM) отрисовывается здесь же
+def get_chapter_pages(db_sess, chapter_id):
+    query = db_sess.query(Chapter.page_offsets, Chapter.html_size) \
+        .filter(Chapter.id == chapter_id)
+    row = query.first()
+    if row and row.html_size is None:
+        chapter_pages.backfill(db_sess, [chapter_id])
+        row = query.first()
+    if not row:
+        return None
+    return chapter_pages.load_offsets(row.page_offsets), row.html_size
+
+
+# готовый HTML одной страницы главы (номер с 1)
+def get_chapter_page(db_sess, chapter_id, page):
+    return db_sess.query(ChapterPage.html) \
+        .filter(ChapterPage.chapter_id == chapter_id, ChapterPage.page == page) \
+        .scalar() or ''
+
+
+# кусок готового HTML главы в байтах: length байт начиная со start. offsets - из
+# get_chapter_pages; читаются только страницы, на которые приходится кусок
+def get_chapter_html(db_sess, chapter_id, offsets, start, length):
+    first = chapter_pages.page_of(offsets, start)
+    last = chapter_pages.page_of(offsets, start + length - 1)
+    pages = db_sess.query(ChapterPage.html) \
+        .filter(ChapterPage.chapter_id == chapter_id, ChapterPage.page.between(first, last)) \
+        .order_by(ChapterPage.page)
+    data = ''.join(html for html, in pages).encode('utf-8')
+    skip = start - offsets[first - 1]
+    return data[skip:skip + length]
+
+
+# том, ранобе и автор главы - для проверки прав без загрузки самой главы,
+# и место главы в ранобе (номера тома и главы)
+def get_chapter_owner(db_sess, chapter_id):
+    return db_sess.query(Chapter.volume_id, Volume.ranobe_id, Ranobe.author_id,
+                         Volume.volume_number, Chapter.chapter_number) \
+        .join(Volume, Chapter.volume_id == Volume.id) \
+        .join(Ranobe, Volume.ranobe_id == Ranobe.id) \
+        .filter(Chapter.id == chapter_id) \
+        .first()
+
+
+# номер, который получит следующая глава тома
+def get_next_chapter_number(db_sess, volume_id):
+    last = db_sess.query(sa.func.max(Chapter.chapter_number)) \
+        .filter(Chapter.volume_id == volume_id) \
+        .scalar()
+    return (last or 0) + 1
+
+
+# версия главы и ее соседей по порядку чтения, версии тома и ранобе без чтения текста -
+# для ETag и ответа 304 (страница главы показывает названия всех четырех)
+def get_chapter_stamp(db_sess, *criteria):
+    prev_chapter = orm.aliased(Chapter)
+    next_chapter = orm.aliased(Chapter)
+
+    return db_sess.query(Chapter.id, Chapter.version, Chapter.created_date, Chapter.updated_date,
+                         prev_chapter.id.label('prev_chapter_id'),
+                         prev_chapter.version.label('prev_chapter_version'),
+                         next_chapter.id.label('next_chapter_id'),
+                         next_chapter.version.label('next_chapter_version'),
+                         Volume.version.label('volume_version'),
+                         Volume.updated_date.label('volume_updated_date'),
+                         Ranobe.version.label('ranobe_version'),
+                         Ranobe.updated_date.label('ranobe_updated_date')) \
+        .join(Volume, Chapter.volume_id == Volume.id) \
+        .join(Ranobe, Chapter.ranobe_id == Ranobe.id) \
+        .outerjoin(prev_chapter, sa.and_(prev_chapter.ranobe_id == Chapter.ranobe_id,
+                                         prev_chapter.reading_order == Chapter.reading_order - 1)) \
+        .outerjoin(next_chapter, sa.and_(next_chapter.ranobe_id == Chapter.ranobe_id,
+                                         next_chapter.reading_order == Chapter.reading_order + 1)) \
+        .filter(*criteria) \
+        .first()
+
+
+# число комментариев и id последнего - меняются при любом добавлении или удалении
+def get_comments_stamp(db_sess, chapter_id):
+    return db_sess.query(sa.func.count(Comment.id), sa.func.max(Comment.id)) \
+        .filter(Comment.chapter_id == chapter_id) \
+        .one()
+
+
+# страница комментариев вместе с авторами и числом ответов - один запрос.
+# Без parent_id - комментарии главы верхнего уровня, новые сверху;
+# с parent_id - ответы на этот комментарий по порядку.
+# Строки: (Comment, created_key, reply_count); created_key - дата в том виде,
+# в каком она хранится, чтобы курсор сравнивался с колонкой без преобразований
+def get_comment_page(db_sess, chapter_id, after=None, limit=20, parent_id=None):
+    replies = orm.aliased(Comment)
+    created_key = sa.type_coerce(Comment.created_date, sa.String).label('created_key')
+    reply_count = db_sess.query(sa.func.count(replies.id)) \
+        .filter(replies.parent_id == Comment.id) \
+        .scalar_subquery() \
+        .label('reply_count')
+
+    query = db_sess.query(Comment, created_key, reply_count) \
+        .options(orm.joinedload(Comment.user)) \
+        .filter(Comment.chapter_id == chapter_id)
+    if parent_id is None:
+        query = query.filter(Comment.parent_id.is_(None))
+    else:
+        query = query.filter(Comment.parent_id == parent_id)
+    return pagination.keyset_page(query, (created_key, Comment.id), after, limit, descending=parent_id is None)
+
+
+# том вместе с ранобе
+def get_volume(db_sess, volume_id, *criteria):
+    return db_sess.query(Volume) \
+        .options(orm.joinedload(Volume.ranobe)) \
+        .filter(Volume.id == volume_id, *criteria) \
+        .first()
+
+
+# оглавление тома: только колонки для списка, без текста глав
+def get_volume_chapters(db_sess, volume_id):
+    return db_sess.query(Chapter.id, Chapter.title, Chapter.chapter_number, Chapter.created_date) \
+        .filter(Chapter.volume_id == volume_id) \
+        .order_by(Chapter.chapter_number) \
+        .all()
+
+
+# тома ранобе; число глав берется из Volume.chapter_count, без загрузки и подсчета глав
+def get_ranobe_volumes(db_sess, ranobe_id):
+    return db_sess.query(Volume) \
+        .filter(Volume.ranobe_id == ranobe_id) \
+        .order_by(Volume.volume_number) \
+        .all()
+
+
+# главы вместе с томом и соседями по порядку чтения - один запрос на всю пачку.
+# Позиции в ранобе идут подряд, поэтому соседи - главы с reading_order на 1 меньше и больше
+def get_chapter_batch(db_sess, *criteria):
+    prev_chapter = orm.aliased(Chapter)
+    next_chapter = orm.aliased(Chapter)
+    return db_sess.query(Chapter.id, Chapter.title, Chapter.chapter_number, Chapter.content,
+                         Chapter.reading_order, Volume.volume_number, Volume.ranobe_id,
+                         prev_chapter.id.label('prev_chapter_id'),
+                         next_chapter.id.label('next_chapter_id')) \
+        .join(Volume, Chapter.volume_id == Volume.id) \
+        .outerjoin(prev_chapter, sa.and_(prev_chapter.ranobe_id == Chapter.ranobe_id,
+                                         prev_chapter.reading_order == Chapter.reading_order - 1)) \
+        .outerjoin(next_chapter, sa.and_(next_chapter.ranobe_id == Chapter.ranobe_id,
+                                         next_chapter.reading_order == Chapter.reading_order + 1)) \
+        .filter(*criteria)
@@ -0,0 +1,296 @@
+import html
+import re
+import unicodedata
+
+import sqlalchemy as sa
+
+from .chapter import Chapter
+from .ranobe import Ranobe
+from .volume import Volume
+
+# Полнотекстовый поиск по ранобе и главам на SQLite FTS5.
+#
+# Одна таблица search_index индексирует название и текст каждого ранобе и каждой главы.
+# rowid кодирует источник: 2 * id для ранобе и 2 * id + 1 для главы, поэтому
+# обновление и удаление записи - это поиск по первичному ключу, а не скан индекса.
+# Таблица обновляется ORM-событиями при добавлении, изменении и удалении.
+#
+# Таблица без содержимого (content=''): сам текст хранится только в ranobe и
+# chapters, а в индексе - лишь словарь слов. Поэтому удаление записи передает FTS5
+# прежние название и текст (они читаются из исходной строки до ее изменения), а
+# подсветка и отрывки для страницы результатов строятся здесь же по исходным строкам.
+
+RANOBE = 'ranobe'
+CHAPTER = 'chapter'
+
+SNIPPET_WORDS = 24
+
+# слово в смысле токенизатора unicode61: буквы и цифры, подчеркивание - разделитель
+_WORD = re.compile(r'[^\W_]+')
+
+_ranobe = Ranobe.__table__
+_chapters = Chapter.__table__
+
+_enabled = False
+
+
+def _rowid(kind, id):
+    return 2 * id + (1 if kind == CHAPTER else 0)
+
+
+# создать таблицу, если ее еще нет, и проиндексировать уже существующие данные.
+# Таблица с копией текста из прежних версий пересоздается без содержимого
+def init(engine, db_sess):
+    global _enabled
+
+    with engine.begin() as conn:
+        sql = conn.execute(sa.text(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'search_index'"
+        )).scalar()
+        if sql and "content=''" in sql.replace(' ', ''):
+            _enabled = True
+            return
+        if sql:
+            conn.execute(sa.text("DROP TABLE search_index"))
+
+        try:
+            conn.execute(sa.text(
+                "CREATE VIRTUAL TABLE search_index USING fts5("
+                "title, body, content = '', tokenize = 'unicode61 remove_diacritics 2')"
+            ))
+        except sa.exc.OperationalError as e:
+            print(f"Полнотекстовый поиск отключен: {e}")
+            return
+
+        conn.execute(sa.text(
+            "INSERT INTO search_index (rowid, title, body) "
+            "SELECT 2 * id, title, coalesce(description, '') FROM ranobe"
+        ))
+    _enabled = True
+
+    # текст глав может храниться сжатым, поэтому он читается через ORM
+    chapters = db_sess.query(Chapter.id, Chapter.title, Chapter.content).yield_per(500)
+    for chapter in chapters:
+        _insert(db_sess.connection(), [(_rowid(CHAPTER, chapter.id), chapter.title, chapter.content)])
+    db_sess.commit()
+
+
+# entries - (rowid, название, текст)
+def _insert(connection, entries):
+    if not _enabled or not entries:
+        return
+    connection.execute(sa.text(
+        "INSERT INTO search_index (rowid, title, body) VALUES (:rowid, :title, :body)"
+    ), [{'rowid': rowid, 'title': title, 'body': body or ''} for rowid, title, body in entries])
+
+
+# удалить записи с прежними значениями; записи, которых нет в индексе, пропускаются -
+# повторное удаление испортило бы статистику индекса
+def _delete(connection, entries):
+    if not _enabled or not entries:
+        return
+    indexed = {rowid for rowid, in connection.execute(
+        sa.text("SELECT id FROM search_index_docsize WHERE id IN :rowids")
+        .bindparams(sa.bindparam('rowids', expanding=True)),
+        {'rowids': [rowid for rowid, _, _ in entries]}
+    )}
+    params = [{'rowid': rowid, 'title': title, 'body': body or ''}
+              for rowid, title, body in entries if rowid in indexed]
+    if params:
+        connection.execute(sa.text(
+            "INSERT INTO search_index (search_index, rowid, title, body) "
+            "VALUES ('delete', :rowid, :title, :body)"
+        ), params)
+
+
+# проиндексированные значения - текущие строки ранобе и глав в БД
+def _indexed_ranobe(connection, ids):
+    rows = connection.execute(sa.select(_ranobe.c.id, _ranobe.c.title, _ranobe.c.description)
+                              .where(_ranobe.c.id.in_(ids)))
+    return [(_rowid(RANOBE, row.id), row.title, row.description) for row in rows]
+
+
+def _indexed_chapters(connection, ids):
+    rows = connection.execute(sa.select(_chapters.c.id, _chapters.c.title, _chapters.c.content)
+                              .where(_chapters.c.id.in_(ids)))
+    return [(_rowid(CHAPTER, row.id), row.title, row.content) for row in rows]
+
+
+# для массовых вставок в обход ORM (импорт глав)
+def index_chapter(connection, id, title, content):
+    _insert(connection, [(_rowid(CHAPTER, id), title, content)])
+
+
+# для удалений в обход ORM (data/deletion.py); вызывать до удаления строк
+def unindex_chapters(connection, ids):
+    if _enabled and ids:
+        _delete(connection, _indexed_chapters(connection, list(ids)))
+
+
+def unindex_ranobe(connection, id):
+    if _enabled:
+        _delete(connection, _indexed_ranobe(connection, [id]))
+
+
+def _changed(target, *names):
+    state = sa.inspect(target)
+    return any(state.attrs[name].history.has_changes() for name in names)
+
+
+# в before_* строка в БД еще прежняя - по ней удаляется старая запись индекса
+
+@sa.event.listens_for(Ranobe, 'after_insert')
+def _ranobe_inserted(mapper, connection, target):
+    _insert(connection, [(_rowid(RANOBE, target.id), target.title, target.description)])
+
+
+@sa.event.listens_for(Ranobe, 'before_update')
+def _ranobe_updating(mapper, connection, target):
+    if _enabled and _changed(target, 'title', 'description'):
+        unindex_ranobe(connection, target.id)
+        _insert(connection, [(_rowid(RANOBE, target.id), target.title, target.description)])
+
+
+@sa.event.listens_for(Ranobe, 'before_delete')
+def _ranobe_deleting(mapper, connection, target):
+    unindex_ranobe(connection, target.id)
+
+
+@sa.event.listens_for(Chapter, 'after_insert')
+def _chapter_inserted(mapper, connection, target):
+    _insert(connection, [(_rowid(CHAPTER, target.id), target.title, target.content)])
+
+
+# текст главы загружается отложенно; если его не меняли и не читали, берется прежний
+@sa.event.listens_for(Chapter, 'before_update')
+def _chapter_updating(mapper, connection, target):
+    if not _enabled or not _changed(target, 'title', 'content'):
+        return
+    entries = _indexed_chapters(connection, [target.id])
+    _delete(connection, entries)
+    content = entries[0][2] if 'content' in sa.inspect(target).unloaded and entries else target.content
+    _insert(connection, [(_rowid(CHAPTER, target.id), target.title, content)])
+
+
+@sa.event.listens_for(Chapter, 'before_delete')
+def _chapter_deleting(mapper, connection, target):
+    unindex_chapters(connection, [target.id])
+
+
+# пользовательский ввод превращается в набор слов в кавычках (все должны встретиться),
+# последнее слово ищется по префиксу; так синтаксис FTS5 из запроса не исполняется
+def build_match(query):
+    words = [word.replace('"', '') for word in query.split()]
+    words = [word for word in words if word]
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+# слово без регистра и диакритики - как его сравнивает unicode61 remove_diacritics 2
+def _fold(word):
+    decomposed = unicodedata.normalize('NFKD', word)
+    return ''.join(char for char in decomposed if not unicodedata.combining(char)).casefold()
+
+
+# проверка слова текста на совпадение с запросом (последнее слово - по префиксу)
+def _matcher(query):
+    words = [_fold(word) for word in _WORD.findall(query)]
+    if not words:
+        return lambda word: False
+    whole, prefix = set(words[:-1]), words[-1]
+    return lambda word: _fold(word) in whole or _fold(word).startswith(prefix)
+
+
+# HTML куска text[start:end] с совпадениями в <mark>
+def _highlight(text, match, start=0, end=None):
+    end = len(text) if end is None else end
+    parts, position = [], start
+    for word in _WORD.finditer(text, start, end):
+        if match(word.group()):
+            parts.append(html.escape(text[position:word.start()]))
+            parts.append(f'<mark>{html.escape(word.group())}</mark>')
+            position = word.end()
+    parts.append(html.escape(text[position:end]))
+    return ''.join(parts)
+
+
+# отрывок из SNIPPET_WORDS слов вокруг первого совпадения
+def _snippet(text, match):
+    words = list(_WORD.finditer(text or ''))
+    if not words:
+        return ''
+    first = next((i for i, word in enumerate(words) if match(word.group())), 0)
+    begin = max(min(first - SNIPPET_WORDS // 4, len(words) - SNIPPET_WORDS), 0)
+    last = min(begin + SNIPPET_WORDS, len(words))
+    return ('…' if begin else '') + _highlight(text, match, words[begin].start(), words[last - 1].end()) + \
+        ('…' if last < len(words) else '')
+
+
+# страница результатов, отсортированных по bm25 (название весит больше текста)
+def search(db_sess, query, kind=None, offset=0, limit=20):
+    match = build_match(query)
+    if not _enabled or not match:
+        return [], False
+
+    kind_filter = ''
+    if kind == RANOBE:
+        kind_filter = 'AND search_index.rowid % 2 = 0'
+    elif kind == CHAPTER:
+        kind_filter = 'AND search_index.rowid % 2 = 1'
+
+    # ранобе, ждущее удаления (data/deletion.py), убирается из индекса сразу, а его
+    # главы - пачками по ходу удаления, поэтому до тех пор они отсеиваются здесь
+    # (для каждой найденной главы - поиск по первичному ключу, а не перебор глав)
+    rows = db_sess.execute(sa.text(
+        f"SELECT rowid FROM search_index WHERE search_index MATCH :match {kind_filter} "
+        "AND NOT EXISTS (SELECT 1 FROM chapters "
+        "JOIN deletion_jobs ON deletion_jobs.ranobe_id = chapters.ranobe_id "
+        "WHERE search_index.rowid % 2 = 1 AND chapters.id = search_index.rowid / 2) "
+        "ORDER BY bm25(search_index, 10.0, 1.0) LIMIT :limit OFFSET :offset"
+    ), {'match': match, 'limit': limit + 1, 'offset': offset}).all()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    # название и текст - только для найденной страницы
+    ranobe_ids = [row.rowid // 2 for row in rows if row.rowid % 2 == 0]
+    ranobe = {}
+    if ranobe_ids:
+        ranobe = {
+            item.id: item
+            for item in db_sess.query(Ranobe.id, Ranobe.title, Ranobe.description).filter(Ranobe.id.in_(ranobe_ids))
+        }
+    chapter_ids = [row.rowid // 2 for row in rows if row.rowid % 2 == 1]
+    chapters = {}
+    if chapter_ids:
+        chapters = {
+            chapter.id: chapter
+            for chapter in db_sess.query(Chapter.id, Chapter.title, Chapter.content, Volume.ranobe_id,
+                                         Chapter.volume_id, Chapter.chapter_number)
+            .join(Volume, Chapter.volume_id == Volume.id)
+            .filter(Chapter.id.in_(chapter_ids))
+        }
+
+    matches = _matcher(query)
+    results = []
+    for row in rows:
+        id = row.rowid // 2
+        result_type = CHAPTER if row.rowid % 2 else RANOBE
+        source = (chapters if result_type == CHAPTER else ranobe).get(id)
+        if not source:
+            continue
+        body = source.content if result_type == CHAPTER else source.description
+        result = {
+            'type': result_type,
+            'id': id,
+            'title': _highlight(source.title, matches),
+            'snippet': _snippet(body, matches),
+        }
+        if result_type == CHAPTER:
+            result.update(ranobe_id=source.ranobe_id, volume_id=source.volume_id,
+                          chapter_number=source.chapter_number)
+        results.append(result)
+    return results, has_more
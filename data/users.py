@@ -1,4 +1,5 @@
 import datetime
+import os
 import sqlalchemy
 from flask_login import UserMixin
 from sqlalchemy import orm
@@ -6,6 +7,10 @@ from sqlalchemy_serializer import SerializerMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 from .db_session import SqlAlchemyBase
 
+# параметры хэша для новых паролей; хэши со старыми параметрами
+# пересчитываются при следующем успешном входе (см. data/auth.py)
+PASSWORD_METHOD = os.environ.get('RANOBE_PASSWORD_METHOD', 'pbkdf2:sha256:600000')
+
 
 class User(SqlAlchemyBase, UserMixin, SerializerMixin):
     __tablename__ = 'users'
@@ -18,6 +23,11 @@ class User(SqlAlchemyBase, UserMixin, SerializerMixin):
     avatar = sqlalchemy.Column(sqlalchemy.String, default='default.jpg')
     is_admin = sqlalchemy.Column(sqlalchemy.Boolean, default=False)
 
+    # вход сравнивает email без учета регистра (data/auth.py)
+    __table_args__ = (
+        sqlalchemy.Index('ix_users_email_lower', sqlalchemy.func.lower(email)),
+    )
+
     ranobe = orm.relationship("Ranobe", back_populates="author")
     comments = orm.relationship("Comment", back_populates="user")
 
@@ -25,7 +35,10 @@ class User(SqlAlchemyBase, UserMixin, SerializerMixin):
         return f'<User> {self.id} {self.username} {self.email}'
 
     def set_password(self, password):
-        self.hashed_password = generate_password_hash(password)
+        self.hashed_password = generate_password_hash(password, PASSWORD_METHOD)
 
     def check_password(self, password):
-        return check_password_hash(self.hashed_password, password)
\ No newline at end of file
+        return check_password_hash(self.hashed_password, password)
+
+    def password_needs_rehash(self):
+        return self.hashed_password.split('$', 1)[0] != PASSWORD_METHOD
\ No newline at end of file
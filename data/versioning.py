@@ -0,0 +1,82 @@
+import datetime
+
+import sqlalchemy as sa
+
+from . import changes
+from .chapter import Chapter
+from .ranobe import Ranobe
+from .volume import Volume
+
+# Версии строк для условных GET-запросов.
+#
+# Каждое изменение ранобе, тома или главы увеличивает ее version и обновляет
+# updated_date. Изменение главы дополнительно "касается" ее тома и ранобе,
+# изменение тома - ранобе: состав и соседи глав - часть их представления.
+# Поэтому ETag ответа можно собрать из нескольких целых чисел, не читая content.
+# Касания попадают и в ленту изменений (data/changes.py).
+
+
+def _now():
+    return datetime.datetime.utcnow()
+
+
+def _stamp(target):
+    target.version = (target.version or 0) + 1
+    target.updated_date = _now()
+
+
+def _touch(connection, table, id):
+    if id is None:
+        return
+    connection.execute(
+        sa.update(table)
+        .where(table.c.id == id)
+        .values(version=sa.func.coalesce(table.c.version, 0) + 1, updated_date=_now())
+    )
+    changes.record(connection, changes.KINDS[table], [id])
+
+
+def _touch_ranobe_of_volume(connection, volume_id):
+    if volume_id is None:
+        return
+    ranobe_id = connection.execute(
+        sa.select(Volume.ranobe_id).where(Volume.id == volume_id)
+    ).scalar()
+    _touch(connection, Ranobe.__table__, ranobe_id)
+
+
+# для массовых вставок в обход ORM (импорт глав): отметить изменение тома и его ранобе
+def touch_volume(connection, volume_id):
+    _touch(connection, Volume.__table__, volume_id)
+    _touch_ranobe_of_volume(connection, volume_id)
+
+
+@sa.event.listens_for(Ranobe, 'before_insert')
+@sa.event.listens_for(Volume, 'before_insert')
+@sa.event.listens_for(Chapter, 'before_insert')
+def _inserted(mapper, connection, target):
+    target.version = 1
+    target.updated_date = _now()
+
+
+@sa.event.listens_for(Ranobe, 'before_update')
+@sa.event.listens_for(Volume, 'before_update')
+@sa.event.listens_for(Chapter, 'before_update')
+def _updated(mapper, connection, target):
+    if sa.orm.object_session(target).is_modified(target, include_collections=False):
+        _stamp(target)
+
+
+@sa.event.listens_for(Volume, 'after_insert')
+@sa.event.listens_for(Volume, 'after_update')
+@sa.event.listens_for(Volume, 'after_delete')
+def _volume_changed(mapper, connection, target):
+    _touch(connection, Ranobe.__table__, target.ranobe_id)
+
+
+@sa.event.listens_for(Chapter, 'after_insert')
+@sa.event.listens_for(Chapter, 'after_update')
+@sa.event.listens_for(Chapter, 'after_delete')
+def _chapter_changed(mapper, connection, target):
+    _touch(connection, Volume.__table__, target.volume_id)
+    _touch_ranobe_of_volume(connection, target.volume_id)
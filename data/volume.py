@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey
+from sqlalchemy import Column, Integer, String, ForeignKey, Index, DateTime
 from sqlalchemy.orm import relationship
 from .db_session import SqlAlchemyBase
 from sqlalchemy_serializer import SerializerMixin
@@ -6,14 +6,28 @@ from sqlalchemy_serializer import SerializerMixin
 
 class Volume(SqlAlchemyBase, SerializerMixin):
     __tablename__ = 'volumes'
+    __table_args__ = (
+        Index('ix_volumes_ranobe_number', 'ranobe_id', 'volume_number', unique=True),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     volume_number = Column(Integer, nullable=False)
-    ranobe_id = Column(Integer, ForeignKey('ranobe.id'))
+    ranobe_id = Column(Integer, ForeignKey('ranobe.id', ondelete='CASCADE'))
     title = Column(String, nullable=True)
 
+    # версия строки и время последнего изменения (UTC) для ETag/Last-Modified,
+    # поддерживаются data/versioning.py
+    version = Column(Integer, nullable=False, default=1, server_default='1')
+    updated_date = Column(DateTime, nullable=True)
+
+    # счетчики для страниц тома и ранобе, поддерживаются data/counters.py
+    chapter_count = Column(Integer, nullable=False, default=0, server_default='0')
+    comment_count = Column(Integer, nullable=False, default=0, server_default='0')
+    last_chapter_at = Column(DateTime, nullable=True)
+    view_count = Column(Integer, nullable=False, default=0, server_default='0')
+
     ranobe = relationship('Ranobe', back_populates='volumes')
-    chapters = relationship('Chapter', back_populates='volume', cascade='all, delete-orphan')
+    chapters = relationship('Chapter', back_populates='volume', cascade='all, delete-orphan', passive_deletes=True)
 
     def __repr__(self):
         return f'<Volume {self.volume_number}>'
@@ -1,6 +1,7 @@
 from flask_wtf import FlaskForm
 from wtforms import StringField, TextAreaField, SubmitField, IntegerField
-from wtforms.validators import DataRequired
+from wtforms.validators import DataRequired, Optional
+from wtforms.widgets import HiddenInput
 
 
 class RanobeForm(FlaskForm):
@@ -19,6 +20,8 @@ class ChapterForm(FlaskForm):
 
 class CommentForm(FlaskForm):
     content = TextAreaField('Comment', validators=[DataRequired()])
+    # id комментария, на который отвечают
+    parent_id = IntegerField('Parent', widget=HiddenInput(), validators=[Optional()])
     submit = SubmitField('Submit')
 
 
@@ -13,7 +13,7 @@ class RegisterForm(FlaskForm):
         EqualTo('password', message="Passwords must match!")
     ])
     avatar = FileField('Аватар (необязательно)', validators=[
-        FileAllowed(['jpg', 'png'], 'Только JPG или PNG!')
+        FileAllowed(['jpg', 'jpeg', 'png', 'webp'], 'Только JPG, PNG или WebP!')
     ])
     submit = SubmitField('Register')
 
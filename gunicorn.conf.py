@@ -0,0 +1,72 @@
+import multiprocessing
+import os
+
+# Настройки gunicorn для боевого запуска: gunicorn -c gunicorn.conf.py server:app
+#
+# Все значения переопределяются переменными окружения. Рабочие процессы -
+# gthread: простаивающие keep-alive соединения ждут в общем poller'е и не
+# занимают потоки, а запрос держит поток только пока выполняется. Медленных
+# клиентов (отдача длинных глав) лучше принимать буферизующим прокси (nginx)
+# перед gunicorn - тогда поток освобождается сразу после ответа.
+#
+# Асинхронного варианта JSON API (async-маршруты, gevent/eventlet) нет
+# намеренно: вся работа с БД идет через синхронный sqlite3, а async-маршруты
+# Flask 2.0 все равно выполняют каждый запрос в отдельном потоке, так что
+# поток не освобождается. Кооперативные рабочие процессы требуют подмены
+# threading, от которой зависят пулы хэширования паролей и аватаров и фоновые
+# потоки (data/background.py), а подсчет PBKDF2 останавливал бы весь процесс.
+#
+# Плавный перезапуск без потери запросов: kill -HUP <pid главного процесса>.
+
+DB_FILE = os.environ.get('RANOBE_DB', 'db/ranobe.db')
+DB_PROFILE = os.environ.get('RANOBE_DB_PROFILE', 'tuned')
+
+bind = os.environ.get('RANOBE_BIND', '127.0.0.1:8080')
+# кэш ответов в памяти у каждого процесса свой, и сброс ключей после записи
+# до других процессов не доходит - поэтому несколько процессов только с общим
+# кэшем в Redis (RANOBE_CACHE_REDIS_URL), без него - один процесс с потоками
+REDIS_URL = os.environ.get('RANOBE_CACHE_REDIS_URL')
+workers = int(os.environ.get('RANOBE_WORKERS', multiprocessing.cpu_count() * 2 + 1 if REDIS_URL else 1))
+if workers > 1 and not REDIS_URL:
+    raise RuntimeError('RANOBE_WORKERS > 1 требует общий кэш: задайте RANOBE_CACHE_REDIS_URL')
+worker_class = 'gthread'
+threads = int(os.environ.get('RANOBE_THREADS', 4))
+
+keepalive = int(os.environ.get('RANOBE_KEEPALIVE', 5))
+timeout = int(os.environ.get('RANOBE_TIMEOUT', 60))
+graceful_timeout = int(os.environ.get('RANOBE_GRACEFUL_TIMEOUT', 30))
+
+# периодический перезапуск рабочих процессов страхует от утечек памяти;
+# разброс не дает всем процессам уйти на перезапуск одновременно
+max_requests = int(os.environ.get('RANOBE_MAX_REQUESTS', 5000))
+max_requests_jitter = int(os.environ.get('RANOBE_MAX_REQUESTS_JITTER', 500))
+
+reload = os.environ.get('RANOBE_RELOAD') == '1'
+preload_app = False
+
+accesslog = os.environ.get('RANOBE_ACCESS_LOG', '-')
+errorlog = '-'
+
+
+# схема БД обновляется один раз в главном процессе, до запуска рабочих
+def on_starting(server):
+    from data import db_session
+
+    db_session.global_init(DB_FILE, DB_PROFILE)
+    db_session.dispose()
+
+
+# у каждого рабочего процесса свой движок и пул соединений
+def post_fork(server, worker):
+    from data import db_session
+
+    db_session.global_init(DB_FILE, DB_PROFILE, migrate=False)
+
+
+# шаблоны компилируются (или читаются из байткода) до первого запроса;
+# удаления ранобе, прерванные перезапуском, продолжаются в фоне
+def post_worker_init(worker):
+    from data import deletion, fragments
+
+    fragments.precompile(worker.wsgi.jinja_env)
+    deletion.wake()
@@ -0,0 +1,128 @@
+import argparse
+import os
+
+import sqlalchemy as sa
+
+from data import avatars, cache, chapter_import, compression, counters, db_session
+from data.users import User
+
+DEFAULT_DB = "db/ranobe.db"
+
+
+# пересжатие текста всех глав текущим кодеком
+def recompress(args):
+    compression.configure(args.codec)
+    db_sess = db_session.create_session()
+    try:
+        before = os.path.getsize(args.db)
+        done = compression.recompress(db_sess, train=args.train_dictionary)
+        db_sess.execute(sa.text('VACUUM'))
+        print(f"Глав: {done}, размер БД: {before} -> {os.path.getsize(args.db)} байт")
+    finally:
+        db_sess.close()
+
+
+# импорт глав из JSON lines, EPUB или каталога .txt с контрольными точками
+def import_chapters(args):
+    checkpoint = args.checkpoint or args.source.rstrip('/\\') + '.import-checkpoint.json'
+    resume = args.resume or os.path.exists(checkpoint)
+
+    def progress(processed, imported, skipped):
+        print(f"Обработано: {processed}, добавлено: {imported}, пропущено: {skipped}")
+
+    db_sess = db_session.create_session()
+    try:
+        importer = chapter_import.ChapterImporter(
+            db_sess, args.ranobe,
+            volume_number=args.volume,
+            batch_size=args.batch_size,
+            skip_existing=resume or args.skip_existing,
+            checkpoint=checkpoint,
+            progress=progress
+        )
+        try:
+            summary = importer.run(chapter_import.read_source(args.source, args.format))
+        except chapter_import.ChapterImportError as e:
+            raise SystemExit(f"Импорт остановлен: {e}. Повторный запуск продолжит с контрольной точки")
+        cache.invalidate(cache.ranobe_keys(db_sess, args.ranobe))
+        cache.invalidate_catalogue()
+        print(f"Готово: добавлено {summary['imported']}, пропущено {summary['skipped']}")
+    finally:
+        db_sess.close()
+
+
+# пересчет счетчиков глав и комментариев с нуля (просмотры не трогаются - их не из чего восстановить)
+def repair_counters(args):
+    db_sess = db_session.create_session()
+    try:
+        counters.recompute(db_sess.connection(), args.ranobe)
+        db_sess.commit()
+        cache.invalidate_catalogue()
+        print("Счетчики пересчитаны")
+    finally:
+        db_sess.close()
+
+
+# перевод загруженных раньше аватаров (исходных файлов) на миниатюры с хэшем в имени
+def convert_avatars(args):
+    if avatars.Image is None:
+        raise SystemExit("Нужен пакет Pillow")
+    db_sess = db_session.create_session()
+    try:
+        names = [name for name, in db_sess.query(User.avatar).distinct()
+                 if name and name != avatars.DEFAULT_AVATAR and '.' in name]
+        for name in names:
+            path = os.path.join(avatars.AVATAR_DIR, name)
+            try:
+                digest = avatars.convert(path)
+            except (OSError, avatars.AvatarError) as e:
+                print(f"{name}: пропущен ({e})")
+                continue
+            db_sess.query(User).filter(User.avatar == name).update({User.avatar: digest})
+            db_sess.commit()
+            if args.delete_originals and not avatars.is_hashed(name):
+                os.remove(path)
+            print(f"{name} -> {digest}")
+        # в закэшированных страницах старые адреса аватаров
+        cache.invalidate(prefixes=('page:',))
+    finally:
+        db_sess.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Служебные команды Ranobe Reader')
+    parser.add_argument('--db', default=DEFAULT_DB, help='файл базы данных')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('recompress', help='пересжать текст глав')
+    command.add_argument('--codec', choices=['none', 'zlib', 'zstd'],
+                         default=os.environ.get('RANOBE_CONTENT_CODEC', 'zlib'))
+    command.add_argument('--train-dictionary', action='store_true', help='обучить новый словарь на главах')
+    command.set_defaults(handler=recompress)
+
+    command = commands.add_parser('import-chapters', help='массовый импорт глав')
+    command.add_argument('source', help='файл .jsonl, .epub или каталог с .txt')
+    command.add_argument('--ranobe', type=int, required=True, help='id ранобе')
+    command.add_argument('--volume', type=int, help='номер тома по умолчанию (создается, если его нет)')
+    command.add_argument('--format', choices=['jsonl', 'epub', 'txt'], help='формат источника (по расширению)')
+    command.add_argument('--batch-size', type=int, default=chapter_import.DEFAULT_BATCH_SIZE)
+    command.add_argument('--checkpoint', help='файл контрольной точки')
+    command.add_argument('--resume', action='store_true', help='продолжить с контрольной точки')
+    command.add_argument('--skip-existing', action='store_true', help='пропускать уже существующие главы')
+    command.set_defaults(handler=import_chapters)
+
+    command = commands.add_parser('repair-counters', help='пересчитать счетчики глав и комментариев')
+    command.add_argument('--ranobe', type=int, help='только для одного ранобе')
+    command.set_defaults(handler=repair_counters)
+
+    command = commands.add_parser('convert-avatars', help='построить миниатюры для старых аватаров')
+    command.add_argument('--delete-originals', action='store_true', help='удалить исходные файлы')
+    command.set_defaults(handler=convert_avatars)
+
+    args = parser.parse_args()
+    db_session.global_init(args.db)
+    args.handler(args)
+
+
+if __name__ == '__main__':
+    main()
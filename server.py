@@ -1,10 +1,14 @@
+import json
 import os
 
-from flask import Flask, render_template, redirect, request, abort, flash, jsonify, url_for
+import sqlalchemy as sa
+from flask import Flask, render_template, redirect, request, abort, flash, jsonify, url_for, send_file, send_from_directory
 from flask_login import LoginManager, login_user, login_required, logout_user, current_user
 from datetime import datetime
 
-from werkzeug.utils import secure_filename
+from markupsafe import Markup
+from werkzeug.http import is_resource_modified
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 from forms.user import RegisterForm, LoginForm
 from forms.ranobe import RanobeForm, ChapterForm, CommentForm
@@ -13,32 +17,188 @@ from data.ranobe import Ranobe
 from data.volume import Volume
 from data.chapter import Chapter
 from data.comment import Comment
-from data import db_session
+from data import auth, avatars, cache, changes, chapter_import, chapter_pages, compression, counters, db_session, deletion, export, fragments, metrics, reading_order, reading_progress, repository, search
+from data.pagination import CursorError, decode_cursor, decode_offset, encode_cursor, keyset_page, parse_limit
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'yandexlyceum_secret_key'
 
+# число обратных прокси (nginx и т.п.) перед приложением: адрес клиента, схема и
+# хост берутся из X-Forwarded-* только от стольких прокси. 0 - заголовкам не
+# доверяем, remote_addr - адрес соединения (иначе клиент подделает свой IP
+# и обойдет лимит попыток входа)
+PROXY_HOPS = int(os.environ.get('RANOBE_PROXY_HOPS', 0))
+if PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_HOPS, x_proto=PROXY_HOPS, x_host=PROXY_HOPS)
+app.jinja_env.template_class = metrics.TimedTemplate
+fragments.configure(app.jinja_env)
+
 login_manager = LoginManager()
 login_manager.init_app(app)
 
+CATALOGUE_PAGE_SIZE = 30
+API_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 200
+RANOBE_API_FIELDS = ('id', 'title', 'description', 'cover_image',
+                     'chapter_count', 'comment_count', 'last_chapter_at', 'view_count', 'updated_date')
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 50
+CHANGES_PAGE_SIZE = 200
+CHANGES_MAX_PAGE_SIZE = 1000
+CONTINUE_READING_SIZE = 3
+CHAPTER_BATCH_MAX = 50
+CHAPTER_BATCH_MAX_BYTES = 2 * 1024 * 1024
+CHAPTER_SLICE_MAX_BYTES = 1024 * 1024
+COMMENTS_PAGE_SIZE = 20
+COMMENTS_MAX_PAGE_SIZE = 100
+
+# политики кэширования для прокси и CDN
+CHAPTER_API_CACHE_CONTROL = 'public, max-age=300'
+CHAPTER_PAGE_CACHE_CONTROL = 'public, max-age=0, must-revalidate'
+PRIVATE_PAGE_CACHE_CONTROL = 'private, no-cache'
+PUBLIC_PAGE_CACHE_CONTROL = 'public, max-age=30'
+EXPORT_CACHE_CONTROL = 'public, max-age=0, must-revalidate'
+# файлы с хэшем содержимого в имени не меняются никогда
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# если задан, /metrics требует заголовок Authorization: Bearer <токен>
+METRICS_TOKEN = os.environ.get('RANOBE_METRICS_TOKEN')
+
+metrics.add_collector('cache', cache.stats)
+metrics.add_collector('fragments', fragments.stats)
+metrics.add_collector('reading_progress', reading_progress.stats)
+
+
+# учет времени, SQL и шаблонов каждого запроса (см. data/metrics.py)
+@app.before_request
+def start_metrics():
+    metrics.start_request()
+
+
+@app.after_request
+def finish_metrics(response):
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    size = None if response.is_streamed else response.calculate_content_length()
+    timing = metrics.finish_request(request.method, route, response.status_code, size)
+    if timing:
+        response.headers.add('Server-Timing', timing)
+    return response
+
+
+@app.teardown_request
+def discard_metrics(error):
+    metrics.discard_request()
+
+
+# одна страница каталога, отсортированного по (title, id); ранобе в очереди на удаление не показываются
+def get_ranobe_page(db_sess, entities, cursor=None, limit=CATALOGUE_PAGE_SIZE):
+    after = decode_cursor(cursor, 2) if cursor else None
+    query = db_sess.query(*entities).filter(deletion.not_pending())
+    rows, has_more = keyset_page(query, (Ranobe.title, Ranobe.id), after, limit)
+    next_cursor = encode_cursor(rows[-1].title, rows[-1].id) if has_more else None
+    return rows, next_cursor
+
+
+# страница комментариев главы (или ответов на комментарий parent_id) и курсор следующей
+def get_comments_page(db_sess, chapter_id, cursor=None, limit=COMMENTS_PAGE_SIZE, parent_id=None):
+    after = decode_cursor(cursor, 2) if cursor else None
+    rows, has_more = repository.get_comment_page(db_sess, chapter_id, after, limit, parent_id)
+    next_cursor = encode_cursor(rows[-1].created_key, rows[-1].Comment.id) if has_more else None
+    return rows, next_cursor
+
+
+def set_cache_headers(response, etag, last_modified, cache_control):
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+
+# ответ 304, если у клиента актуальная версия; иначе None и ответ строится как обычно
+def not_modified(etag, last_modified, cache_control):
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return None
+    return set_cache_headers(app.response_class(status=304), etag, last_modified, cache_control)
+
+
+# анонимные страницы одинаковы для всех посетителей и берутся из кэша целиком;
+# авторизованным страница строится каждый раз (в ней кнопки владельца и CSRF-токен)
+def anonymous_page(key, build):
+    if current_user.is_authenticated:
+        response = app.make_response(build())
+        response.headers['Cache-Control'] = PRIVATE_PAGE_CACHE_CONTROL
+        return response
+
+    html = cache.get(key)
+    if html is None:
+        html = build()
+        cache.put(key, html)
+    response = app.make_response(html)
+    response.headers['Cache-Control'] = PUBLIC_PAGE_CACHE_CONTROL
+    response.vary.add('Cookie')
+    return response
+
+
+# валидаторы зависят только от самой главы и ее соседей (на них ссылки в ответе),
+# поэтому записи в другие главы ранобе не сбрасывают кэш клиентов
+def chapter_validators(stamp):
+    etag = f'chapter-{stamp.id}-{stamp.version}-{stamp.prev_chapter_id or 0}-{stamp.next_chapter_id or 0}'
+    return etag, stamp.updated_date or stamp.created_date
+
+
+# страница главы показывает еще названия ранобе, тома и соседних глав, поэтому ее
+# валидаторы учитывают и их версии; любая запись в главы ранобе поднимает версию ранобе
+def chapter_page_validators(stamp):
+    etag = f'chapter-page-{stamp.id}-{stamp.version}-{stamp.volume_version}-{stamp.ranobe_version}' \
+           f'-{stamp.prev_chapter_id or 0}-{stamp.prev_chapter_version or 0}' \
+           f'-{stamp.next_chapter_id or 0}-{stamp.next_chapter_version or 0}'
+    dates = [stamp.updated_date or stamp.created_date, stamp.volume_updated_date, stamp.ranobe_updated_date]
+    return etag, max(date for date in dates if date is not None)
+
 
-# загрузка пользователя
+# загрузка пользователя (из кэша процесса, см. data/auth.py)
 @login_manager.user_loader
 def load_user(user_id):
+    return auth.load_user(user_id)
+
+
+# главная страница
+@app.route('/')
+def index():
+    cursor = request.args.get('cursor')
+    return anonymous_page(cache.page_key('index', cursor or ''), lambda: render_index(cursor))
+
+
+def render_index(cursor):
     db_sess = db_session.create_session()
     try:
-        return db_sess.query(User).get(user_id)
+        try:
+            ranobe_list, next_cursor = get_ranobe_page(db_sess, (Ranobe,), cursor)
+        except CursorError:
+            abort(400)
+        continue_reading = []
+        if current_user.is_authenticated and not cursor:
+            continue_reading = reading_progress.get_progress(db_sess, current_user.id, limit=CONTINUE_READING_SIZE)
+        return render_template('index.html', ranobe_list=ranobe_list, next_cursor=next_cursor,
+                               continue_reading=continue_reading)
     finally:
         db_sess.close()
 
 
-# главная страница
-@app.route('/')
-def index():
+# поиск по названиям и текстам
+@app.route('/search')
+def search_page():
+    query = request.args.get('q', '').strip()
     db_sess = db_session.create_session()
     try:
-        ranobe_list = db_sess.query(Ranobe).order_by(Ranobe.title).all()
-        return render_template('index.html', ranobe_list=ranobe_list)
+        try:
+            offset = decode_offset(request.args.get('cursor'))
+        except CursorError:
+            abort(400)
+        results, has_more = search.search(db_sess, query, offset=offset, limit=SEARCH_PAGE_SIZE)
+        next_cursor = encode_cursor(offset + SEARCH_PAGE_SIZE) if has_more else None
+        return render_template('search.html', query=query, results=results, next_cursor=next_cursor,
+                               title='Поиск')
     finally:
         db_sess.close()
 
@@ -50,31 +210,41 @@ def register():
     if form.validate_on_submit():
         db_sess = db_session.create_session()
         try:
-            if db_sess.query(User).filter(User.email == form.email.data).first():
+            email = auth.normalize_email(form.email.data)
+            if db_sess.query(User).filter(sa.func.lower(User.email) == email).first():
                 return render_template('register.html', form=form)
 
-            avatar_filename = 'default.jpg'
+            avatar = None
 
-            # если загружен пользовательский аватар
+            # если загружен пользовательский аватар - миниатюры строятся в фоне,
+            # а до их готовности у пользователя аватар по умолчанию
             if form.avatar.data:
-                avatar = form.avatar.data
-                avatar_filename = f"user_{datetime.now().timestamp()}.{secure_filename(avatar.filename).split('.')[-1]}"
-                avatar.save(os.path.join('static', 'uploads', 'avatars', avatar_filename))
+                try:
+                    avatar = avatars.save(form.avatar.data)
+                except avatars.AvatarError as e:
+                    form.avatar.errors.append(str(e))
+                    return render_template('register.html', form=form)
 
             user = User(
                 username=form.username.data,
-                email=form.email.data,
-                avatar=avatar_filename,
+                email=email,
+                avatar=avatars.DEFAULT_AVATAR,
                 created_date=datetime.now()
             )
-            user.set_password(form.password.data)
+            auth.set_password(user, form.password.data)
 
             db_sess.add(user)
             db_sess.commit()
+            if avatar:
+                avatars.assign(user.id, avatar)
 
             login_user(user)
             return redirect(url_for('index'))
 
+        except auth.PasswordPoolBusy:
+            db_sess.rollback()
+            flash('Сервер перегружен, попробуйте еще раз через минуту', 'danger')
+            return render_template('register.html', form=form), 503
         except Exception as e:
             db_sess.rollback()
             app.logger.error(f"Registration error: {e}")
@@ -84,23 +254,42 @@ def register():
     return render_template('register.html', form=form)
 
 
+# файлы аватаров; миниатюры с хэшем в имени кэшируются навсегда
+@app.route('/avatars/<filename>')
+def avatar_file(filename):
+    response = send_from_directory(avatars.AVATAR_DIR, filename)
+    if avatars.is_hashed(filename):
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    return response
+
+
+# адрес аватара пользователя нужного размера; None, если в этом формате его нет
+@app.template_global()
+def avatar_url(avatar, size=avatars.SIZES[0], ext='jpg'):
+    name = avatars.filename(avatar, size, ext)
+    return url_for('avatar_file', filename=name) if name else None
+
+
 # вход в систему
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     form = LoginForm()
     if form.validate_on_submit():
-        db_sess = db_session.create_session()
         try:
-            user = db_sess.query(User).filter(User.email == form.email.data).first()
-
-            if user and user.check_password(form.password.data):
-                login_user(user, remember=form.remember_me.data)
-                next_page = request.args.get('next')
-                return redirect(next_page or '/')
-
-            flash('Неправильный логин или пароль', 'danger')
-        finally:
-            db_sess.close()
+            user = auth.authenticate(form.email.data, form.password.data, request.remote_addr)
+        except auth.LoginRateLimited:
+            flash('Слишком много попыток входа, попробуйте позже', 'danger')
+            return render_template('login.html', form=form), 429
+        except auth.PasswordPoolBusy:
+            flash('Сервер перегружен, попробуйте еще раз через минуту', 'danger')
+            return render_template('login.html', form=form), 503
+
+        if user:
+            login_user(user, remember=form.remember_me.data)
+            next_page = request.args.get('next')
+            return redirect(next_page or '/')
+
+        flash('Неправильный логин или пароль', 'danger')
     return render_template('login.html', form=form)
 
 
@@ -115,14 +304,22 @@ def logout():
 # страница определенного ранобе
 @app.route('/ranobe/<int:id>')
 def view_ranobe(id):
+    counters.hit_ranobe(id)
+    return anonymous_page(cache.page_key('ranobe', id), lambda: render_ranobe(id))
+
+
+def render_ranobe(id):
     db_sess = db_session.create_session()
     try:
-        ranobe = db_sess.query(Ranobe).get(id)
+        ranobe = db_sess.query(Ranobe).filter(Ranobe.id == id, deletion.not_pending()).first()
         if not ranobe:
             abort(404)
 
-        volumes = db_sess.query(Volume).filter(Volume.ranobe_id == id).order_by(Volume.volume_number).all()
-        return render_template('ranobe.html', ranobe=ranobe, volumes=volumes)
+        volumes = repository.get_ranobe_volumes(db_sess, id)
+        progress = None
+        if current_user.is_authenticated:
+            progress = next(iter(reading_progress.get_progress(db_sess, current_user.id, ranobe_id=id)), None)
+        return render_template('ranobe.html', ranobe=ranobe, volumes=volumes, progress=progress)
     finally:
         db_sess.close()
 
@@ -143,6 +340,7 @@ def add_ranobe():
             )
             db_sess.add(ranobe)
             db_sess.commit()
+            cache.invalidate_catalogue()
             return redirect('/')
         finally:
             db_sess.close()
@@ -166,6 +364,8 @@ def edit_ranobe(id):
             ranobe.description = form.description.data
             ranobe.cover_image = form.cover_image.data
             db_sess.commit()
+            cache.invalidate(cache.ranobe_keys(db_sess, id))
+            cache.invalidate_catalogue()
             return redirect(f'/ranobe/{id}')
 
         if request.method == 'GET':
@@ -189,8 +389,16 @@ def delete_ranobe(id):
         if not ranobe or (current_user.id != ranobe.author_id and current_user.id != 1):
             abort(403)
 
-        db_sess.delete(ranobe)
+        # главы, комментарии и тома удаляются пачками (data/deletion.py);
+        # небольшое ранобе - сразу, большое - в фоне
+        deletion.schedule(db_sess, id)
         db_sess.commit()
+        cache.invalidate(cache.ranobe_keys(db_sess, id))
+        cache.invalidate_catalogue()
+        if ranobe.chapter_count <= deletion.BATCH_SIZE:
+            deletion.delete_ranobe(id)
+        else:
+            deletion.wake()
         return redirect('/')
     finally:
         db_sess.close()
@@ -207,18 +415,20 @@ def new_volume(ranobe_id):
         if not ranobe or (current_user.id != ranobe.author_id and current_user.id != 1):
             abort(403)
 
-        last_volume = db_sess.query(Volume).filter(Volume.ranobe_id == ranobe_id) \
-            .order_by(Volume.volume_number.desc()).first()
+        last_volume_number = db_sess.query(sa.func.max(Volume.volume_number)) \
+            .filter(Volume.ranobe_id == ranobe_id).scalar()
 
-        new_volume_number = last_volume.volume_number + 1 if last_volume else 1
+        new_volume_number = (last_volume_number or 0) + 1
 
         volume = Volume(
             volume_number=new_volume_number,
             ranobe_id=ranobe_id,
             title=f"Том {new_volume_number}"
         )
+        # новый том пуст и идет последним - порядок чтения глав не меняется
         db_sess.add(volume)
         db_sess.commit()
+        cache.invalidate(keys=[cache.page_key('ranobe', ranobe_id)])
         return redirect(f'/ranobe/{ranobe_id}')
     finally:
         db_sess.close()
@@ -227,13 +437,18 @@ def new_volume(ranobe_id):
 # список всех глав определенного тома
 @app.route('/volume/<int:id>')
 def view_volume(id):
+    counters.hit_volume(id)
+    return anonymous_page(cache.page_key('volume', id), lambda: render_volume(id))
+
+
+def render_volume(id):
     db_sess = db_session.create_session()
     try:
-        volume = db_sess.query(Volume).get(id)
+        volume = repository.get_volume(db_sess, id, deletion.not_pending(Volume.ranobe_id))
         if not volume:
             abort(404)
 
-        chapters = db_sess.query(Chapter).filter(Chapter.volume_id == id).order_by(Chapter.chapter_number).all()
+        chapters = repository.get_volume_chapters(db_sess, id)
         return render_template('volume.html', volume=volume, chapters=chapters)
     finally:
         db_sess.close()
@@ -270,6 +485,7 @@ def add_chapter(ranobe_id):
                 )
                 db_sess.add(volume)
                 db_sess.commit()
+                cache.invalidate(keys=[cache.page_key('ranobe', ranobe_id)])
 
         if form.validate_on_submit():
             chapter = Chapter(
@@ -279,15 +495,13 @@ def add_chapter(ranobe_id):
                 volume_id=volume.id
             )
             db_sess.add(chapter)
+            reading_order.reindex_ranobe(db_sess, ranobe_id, since=(volume.volume_number, chapter.chapter_number))
             db_sess.commit()
+            cache.invalidate(cache.chapter_keys(db_sess, chapter.id))
+            cache.invalidate_catalogue()
             return redirect(f'/volume/{volume.id}')
 
-        if volume.chapters:
-            next_chapter_num = max(c.chapter_number for c in volume.chapters) + 1
-        else:
-            next_chapter_num = 1
-
-        form.chapter_number.data = next_chapter_num
+        form.chapter_number.data = repository.get_next_chapter_number(db_sess, volume.id)
         return render_template('add_chapter.html', form=form, ranobe=ranobe, volume=volume)
     finally:
         db_sess.close()
@@ -300,16 +514,24 @@ def edit_chapter(id):
     form = ChapterForm()
     db_sess = db_session.create_session()
     try:
-        chapter = db_sess.query(Chapter).get(id)
+        chapter = repository.get_chapter(db_sess, id)
 
         if not chapter or (current_user.id != chapter.volume.ranobe.author_id and current_user.id != 1):
             abort(403)
 
         if form.validate_on_submit():
+            stale_keys = cache.chapter_keys(db_sess, id)
+            old_number = chapter.chapter_number
             chapter.title = form.title.data
             chapter.content = form.content.data
             chapter.chapter_number = form.chapter_number.data
+            if chapter.chapter_number != old_number:
+                reading_order.reindex_ranobe(
+                    db_sess, chapter.volume.ranobe_id,
+                    since=(chapter.volume.volume_number, min(old_number, chapter.chapter_number))
+                )
             db_sess.commit()
+            cache.invalidate(stale_keys + cache.chapter_keys(db_sess, id))
             return redirect(f'/chapter/{id}')
 
         if request.method == 'GET':
@@ -332,14 +554,19 @@ def edit_chapter(id):
 def delete_chapter(id):
     db_sess = db_session.create_session()
     try:
-        chapter = db_sess.query(Chapter).get(id)
+        owner = repository.get_chapter_owner(db_sess, id)
 
-        if not chapter or (current_user.id != chapter.volume.ranobe.author_id and current_user.id != 1):
+        if not owner or (current_user.id != owner.author_id and current_user.id != 1):
             abort(403)
 
-        volume_id = chapter.volume.id
-        db_sess.delete(chapter)
+        volume_id, ranobe_id = owner.volume_id, owner.ranobe_id
+        stale_keys = cache.chapter_keys(db_sess, id)
+        db_sess.delete(db_sess.query(Chapter).get(id))
+        db_sess.flush()
+        reading_order.reindex_ranobe(db_sess, ranobe_id, since=(owner.volume_number, owner.chapter_number))
         db_sess.commit()
+        cache.invalidate(stale_keys)
+        cache.invalidate_catalogue()
         return redirect(f'/volume/{volume_id}')
     finally:
         db_sess.close()
@@ -349,46 +576,118 @@ def delete_chapter(id):
 @app.route('/chapter/<int:id>', methods=['GET', 'POST'])
 def view_chapter(id):
     form = CommentForm()
+    if request.method == 'GET':
+        counters.hit_chapter(id)
+
+    # ?comments_cursor= - продолжение комментариев для браузеров без JS
+    comments_cursor = request.args.get('comments_cursor')
+    # ?page= - страница текста (с 1); ?offset= - место во всей главе (0..1) из
+    # "Продолжить чтение", по нему выбирается страница
+    page = request.args.get('page', type=int)
+    position = request.args.get('offset', type=float)
+
+    # анонимная страница одинакова для всех, поэтому она кэшируется целиком
+    # и подтверждается через 304; у авторизованных в странице есть CSRF-токен и кнопки.
+    # Все страницы главы лежат в одной записи {номер: (html, etag, last_modified)}
+    cacheable = request.method == 'GET' and not current_user.is_authenticated and not comments_cursor \
+        and position is None
+    page_key = cache.page_key('chapter', id)
+    if cacheable:
+        cached_page = (cache.get(page_key) or {}).get(1 if page is None else page)
+        if cached_page is not None:
+            return chapter_page_response(*cached_page)
+
     db_sess = db_session.create_session()
     try:
-        chapter = db_sess.query(Chapter).get(id)
+        if cacheable:
+            stamp = repository.get_chapter_stamp(db_sess, Chapter.id == id, deletion.not_pending())
+            if not stamp:
+                abort(404)
+            comments_count, last_comment_id = repository.get_comments_stamp(db_sess, id)
+            etag, last_modified = chapter_page_validators(stamp)
+            etag = f'{etag}-{comments_count}-{last_comment_id}'
+            cached = not_modified(etag, last_modified, CHAPTER_PAGE_CACHE_CONTROL)
+            if cached:
+                cached.vary.add('Cookie')
+                return cached
+
+        chapter = repository.get_chapter(db_sess, id, deletion.not_pending(Chapter.ranobe_id), content=False)
 
         if not chapter:
             abort(404)
 
-        prev_chapter = db_sess.query(Chapter).filter(
-            Chapter.volume_id == chapter.volume_id,
-            Chapter.chapter_number < chapter.chapter_number
-        ).order_by(Chapter.chapter_number.desc()).first()
+        offsets, size = repository.get_chapter_pages(db_sess, id)
+        if page is None:
+            page = chapter_pages.page_at(offsets, size, position) if position is not None else 1
+        bounds = chapter_pages.page_bounds(offsets, size, page)
+        if not bounds:
+            abort(404)
+        start, end = bounds
 
-        next_chapter = db_sess.query(Chapter).filter(
-            Chapter.volume_id == chapter.volume_id,
-            Chapter.chapter_number > chapter.chapter_number
-        ).order_by(Chapter.chapter_number.asc()).first()
+        prev_chapter, next_chapter = reading_order.get_neighbours(db_sess, chapter)
 
         if form.validate_on_submit() and current_user.is_authenticated:
+            parent_id = None
+            if form.parent_id.data:
+                parent = db_sess.query(Comment.id, Comment.parent_id) \
+                    .filter(Comment.id == form.parent_id.data, Comment.chapter_id == id) \
+                    .first()
+                if not parent:
+                    abort(400)
+                # ответ на ответ попадает в ту же ветку
+                parent_id = parent.parent_id or parent.id
+
             comment = Comment(
                 content=form.content.data,
                 user_id=current_user.id,
-                chapter_id=id
+                chapter_id=id,
+                parent_id=parent_id
             )
             db_sess.add(comment)
             db_sess.commit()
-            return redirect(f'/chapter/{id}')
-
-        comments = db_sess.query(Comment).filter(Comment.chapter_id == id) \
-            .order_by(Comment.created_date.desc()).all()
+            cache.invalidate_comments(db_sess, id)
+            return redirect(f'/chapter/{id}#comment-{parent_id}' if parent_id else f'/chapter/{id}')
 
-        return render_template('chapter.html',
-                             chapter=chapter,
-                             prev_chapter=prev_chapter,
-                             next_chapter=next_chapter,
-                             comments=comments,
-                             form=form)
+        try:
+            comments, comments_next = get_comments_page(db_sess, id, comments_cursor)
+        except CursorError:
+            abort(400)
+
+        html = render_template('chapter.html',
+                               chapter=chapter,
+                               # текст страницы читается, только если его нет в кэше фрагментов
+                               page_html=lambda: Markup(repository.get_chapter_page(db_sess, id, page)),
+                               page=page,
+                               pages=len(offsets),
+                               page_start=start,
+                               page_end=end,
+                               chapter_size=size,
+                               prev_chapter=prev_chapter,
+                               next_chapter=next_chapter,
+                               comments=comments,
+                               comments_next=comments_next,
+                               form=form)
+        if cacheable:
+            cached_pages = dict(cache.get(page_key) or {})
+            cached_pages[page] = (html, etag, last_modified)
+            cache.put(page_key, cached_pages, ranobe_id=chapter.ranobe_id)
+            return chapter_page_response(html, etag, last_modified)
+
+        response = app.make_response(html)
+        response.headers['Cache-Control'] = PRIVATE_PAGE_CACHE_CONTROL
+        return response
     finally:
         db_sess.close()
 
 
+def chapter_page_response(html, etag, last_modified):
+    response = not_modified(etag, last_modified, CHAPTER_PAGE_CACHE_CONTROL)
+    if response is None:
+        response = set_cache_headers(app.make_response(html), etag, last_modified, CHAPTER_PAGE_CACHE_CONTROL)
+    response.vary.add('Cookie')
+    return response
+
+
 # удаление коммента
 @app.route('/delete_comment/<int:id>')
 @login_required
@@ -403,78 +702,274 @@ def delete_comment(id):
         chapter_id = comment.chapter_id
         db_sess.delete(comment)
         db_sess.commit()
+        cache.invalidate_comments(db_sess, chapter_id)
         return redirect(f'/chapter/{chapter_id}')
     finally:
         db_sess.close()
 
 
-# Возвращает json со списком всех ранобе
-@app.route('/api/ranobe', methods=['GET'])
-def api_get_all_ranobe():
+# Возвращает json со страницей комментариев главы, новые сверху
+# ?parent= - ответы на комментарий (по порядку), ?limit=, ?cursor= - как в /api/ranobe
+@app.route('/api/chapters/<int:id>/comments', methods=['GET'])
+def api_get_chapter_comments(id):
+    try:
+        limit = parse_limit(request.args.get('limit'), COMMENTS_PAGE_SIZE, COMMENTS_MAX_PAGE_SIZE)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    parent_id = request.args.get('parent', type=int)
+
     db_sess = db_session.create_session()
     try:
-        ranobe_list = db_sess.query(Ranobe).order_by(Ranobe.title).all()
-        return jsonify([{
-            'id': ranobe.id,
-            'title': ranobe.title,
-            'description': ranobe.description,
-            'cover_image': ranobe.cover_image
-        } for ranobe in ranobe_list])
+        if not db_sess.query(Chapter.id).filter(Chapter.id == id).first():
+            return jsonify({'error': 'Chapter not found'}), 404
+
+        rows, next_cursor = get_comments_page(db_sess, id, request.args.get('cursor'), limit, parent_id)
+        response = jsonify([comment_item(row.Comment, row.reply_count) for row in rows])
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+            next_url = url_for('api_get_chapter_comments', id=id, cursor=next_cursor, limit=limit,
+                               parent=parent_id, _external=True)
+            response.headers['Link'] = f'<{next_url}>; rel="next"'
+        return response
+    except CursorError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
         db_sess.close()
 
 
+def comment_item(comment, reply_count):
+    return {
+        'id': comment.id,
+        'content': comment.content,
+        'created_date': comment.created_date.isoformat() if comment.created_date else None,
+        'parent_id': comment.parent_id,
+        'reply_count': reply_count,
+        'user': {
+            'id': comment.user.id,
+            'username': comment.user.username,
+            'avatar_url': avatar_url(comment.user.avatar),
+            'avatar_webp_url': avatar_url(comment.user.avatar, ext='webp'),
+            'avatar_large_url': avatar_url(comment.user.avatar, avatars.SIZES[-1])
+        }
+    }
+
+
+# Возвращает json со страницей списка ранобе
+# ?fields=id,title - какие поля отдавать, ?limit= - размер страницы,
+# ?cursor= - значение из заголовка X-Next-Cursor предыдущего ответа
+@app.route('/api/ranobe', methods=['GET'])
+def api_get_all_ranobe():
+    fields = request.args.get('fields')
+    fields = [f.strip() for f in fields.split(',') if f.strip()] if fields else list(RANOBE_API_FIELDS)
+    unknown = [f for f in fields if f not in RANOBE_API_FIELDS]
+    if unknown:
+        return jsonify({'error': f'Unknown fields: {", ".join(unknown)}'}), 400
+
+    try:
+        limit = parse_limit(request.args.get('limit'), API_PAGE_SIZE, API_MAX_PAGE_SIZE)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # id и title нужны всегда - из них строится курсор
+    columns = [Ranobe.id, Ranobe.title] + [getattr(Ranobe, f) for f in fields if f not in ('id', 'title')]
+    cursor = request.args.get('cursor')
+    key = f'ranobe-list:{",".join(fields)}:{limit}:{cursor or ""}'
+
+    try:
+        page = cache.get(key)
+        if page is None:
+            db_sess = db_session.create_session()
+            try:
+                ranobe_list, next_cursor = get_ranobe_page(db_sess, columns, cursor, limit)
+                page = ([{f: getattr(ranobe, f) for f in fields} for ranobe in ranobe_list], next_cursor)
+            finally:
+                db_sess.close()
+            cache.put(key, page)
+
+        items, next_cursor = page
+        response = jsonify(items)
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+            next_url = url_for('api_get_all_ranobe', cursor=next_cursor, limit=limit,
+                               fields=request.args.get('fields'), _external=True)
+            response.headers['Link'] = f'<{next_url}>; rel="next"'
+        return response
+    except CursorError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
 # Возвращает json со списком глав указанного тома
 @app.route('/api/ranobe/<int:ranobe_id>/volumes/<int:volume_number>/chapters', methods=['GET'])
 def api_get_volume_chapters(ranobe_id, volume_number):
+    key = cache.volume_chapters_key(ranobe_id, volume_number)
+    chapters = cache.get(key)
+    if chapters is not None:
+        return jsonify(chapters)
+
     db_sess = db_session.create_session()
     try:
-        volume = db_sess.query(Volume).filter(
+        volume_id = db_sess.query(Volume.id).filter(
             Volume.ranobe_id == ranobe_id,
             Volume.volume_number == volume_number
-        ).first()
+        ).scalar()
 
-        if not volume:
+        if not volume_id:
             return jsonify({'error': 'Volume not found'}), 404
 
-        chapters = db_sess.query(Chapter).filter(
-            Chapter.volume_id == volume.id
+        chapters = db_sess.query(Chapter.id, Chapter.title, Chapter.chapter_number).filter(
+            Chapter.volume_id == volume_id
         ).order_by(Chapter.chapter_number).all()
 
-        return jsonify([{
+        chapters = [{
             'id': chapter.id,
             'title': chapter.title,
             'chapter_number': chapter.chapter_number
-        } for chapter in chapters])
+        } for chapter in chapters]
+        cache.put(key, chapters, ranobe_id=ranobe_id)
+        return jsonify(chapters)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
         db_sess.close()
 
 
-# Возвращает json с содержимым главы по глобальному ID главы
+# общий ответ API с содержимым главы: из кэша или из БД, 304 по ETag или полный json.
+# lookup(db_sess) возвращает версии главы (None, если ее нет),
+# not_found(db_sess) - текст ошибки для 404
+def chapter_content_response(key, lookup, not_found):
+    entry = cache.get(key)
+    if entry is None:
+        db_sess = db_session.create_session()
+        try:
+            stamp = lookup(db_sess)
+            if not stamp:
+                return jsonify({'error': not_found(db_sess)}), 404
+
+            etag, last_modified = chapter_validators(stamp)
+            cached = not_modified(etag, last_modified, CHAPTER_API_CACHE_CONTROL)
+            if cached:
+                return cached
+
+            entry = (chapter_payload(db_sess, stamp.id), etag, last_modified)
+        finally:
+            db_sess.close()
+        cache.put(key, entry, ranobe_id=entry[0]['ranobe_id'])
+
+    payload, etag, last_modified = entry
+    cached = not_modified(etag, last_modified, CHAPTER_API_CACHE_CONTROL)
+    if cached:
+        return cached
+    return set_cache_headers(jsonify(payload), etag, last_modified, CHAPTER_API_CACHE_CONTROL)
+
+
+def chapter_payload(db_sess, chapter_id):
+    chapter = repository.get_chapter(db_sess, chapter_id)
+    prev_chapter, next_chapter = reading_order.get_neighbours(db_sess, chapter)
+    offsets, size = repository.get_chapter_pages(db_sess, chapter_id)
+
+    return {
+        'id': chapter.id,
+        'title': chapter.title,
+        'chapter_number': chapter.chapter_number,
+        'content': chapter.content,
+        'html_size': size,
+        'page_offsets': offsets,
+        'volume_number': chapter.volume.volume_number,
+        'ranobe_id': chapter.volume.ranobe_id,
+        'prev_chapter_id': prev_chapter.id if prev_chapter else None,
+        'next_chapter_id': next_chapter.id if next_chapter else None
+    }
+
+
+# кусок готового HTML главы: ?offset= - начало в байтах (начала страниц - page_offsets
+# полного ответа), ?length= - число байт; конец куска сдвигается до границы символа
+def chapter_html_slice(chapter_id):
+    try:
+        offset = int(request.args.get('offset', 0))
+        length = int(request.args.get('length', chapter_pages.PAGE_BYTES))
+    except ValueError:
+        return jsonify({'error': 'offset and length must be integers'}), 400
+    if offset < 0 or not 1 <= length <= CHAPTER_SLICE_MAX_BYTES:
+        return jsonify({'error': f'offset must be non-negative and length between 1 and {CHAPTER_SLICE_MAX_BYTES}'}), 400
+
+    db_sess = db_session.create_session()
+    try:
+        stamp = repository.get_chapter_stamp(db_sess, Chapter.id == chapter_id)
+        if not stamp:
+            return jsonify({'error': 'Chapter not found'}), 404
+
+        etag, last_modified = chapter_validators(stamp)
+        cached = not_modified(etag, last_modified, CHAPTER_API_CACHE_CONTROL)
+        if cached:
+            return cached
+
+        offsets, size = repository.get_chapter_pages(db_sess, chapter_id)
+        if offset > size:
+            return jsonify({'error': 'offset is past the end of the chapter'}), 400
+        # символ UTF-8 занимает до 4 байт - берем с запасом, чтобы дочитать последний
+        data = repository.get_chapter_html(db_sess, chapter_id, offsets, offset, length + 3)
+    finally:
+        db_sess.close()
+
+    if data and data[0] & 0xC0 == 0x80:
+        return jsonify({'error': 'offset must be on a character boundary'}), 400
+    end = min(length, len(data))
+    while end < len(data) and data[end] & 0xC0 == 0x80:
+        end += 1
+
+    payload = {
+        'id': chapter_id,
+        'offset': offset,
+        'length': end,
+        'html_size': size,
+        'next_offset': offset + end if offset + end < size else None,
+        'html': data[:end].decode('utf-8')
+    }
+    return set_cache_headers(jsonify(payload), etag, last_modified, CHAPTER_API_CACHE_CONTROL)
+
+
+# Возвращает json с содержимым главы по глобальному ID главы;
+# ?offset=&length= - только кусок готового HTML (см. chapter_html_slice)
 @app.route('/api/chapters/<int:chapter_id>', methods=['GET'])
 def api_get_chapter_content(chapter_id):
+    try:
+        if 'offset' in request.args or 'length' in request.args:
+            return chapter_html_slice(chapter_id)
+        return chapter_content_response(
+            cache.chapter_key(chapter_id),
+            lambda db_sess: repository.get_chapter_stamp(db_sess, Chapter.id == chapter_id),
+            lambda db_sess: 'Chapter not found'
+        )
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+# Возвращает только текст главы (text/plain). Если текст хранится сжатым без словаря
+# и клиент принимает этот Content-Encoding, сжатые байты отдаются без распаковки
+@app.route('/api/chapters/<int:chapter_id>/content', methods=['GET'])
+def api_get_chapter_text(chapter_id):
     db_sess = db_session.create_session()
     try:
-        chapter = db_sess.query(Chapter).get(chapter_id)
-        if not chapter:
+        # сырое значение колонки, без распаковки в CompressedText
+        raw = db_sess.execute(
+            sa.text('SELECT content FROM chapters WHERE id = :id'), {'id': chapter_id}
+        ).scalar()
+        if raw is None:
             return jsonify({'error': 'Chapter not found'}), 404
 
-        volume = db_sess.query(Volume).get(chapter.volume_id)
-        if not volume:
-            return jsonify({'error': 'Volume not found'}), 404
-
-        return jsonify({
-            'id': chapter.id,
-            'title': chapter.title,
-            'chapter_number': chapter.chapter_number,
-            'content': chapter.content,
-            'volume_number': volume.volume_number,
-            'ranobe_id': volume.ranobe_id
-        })
+        encoding, payload = compression.http_encoding(raw)
+        if encoding and encoding in request.accept_encodings:
+            response = app.response_class(payload, mimetype='text/plain')
+            response.headers['Content-Encoding'] = encoding
+        else:
+            response = app.response_class(compression.decompress(raw), mimetype='text/plain')
+        response.vary.add('Accept-Encoding')
+        response.headers['Cache-Control'] = CHAPTER_API_CACHE_CONTROL
+        return response
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
@@ -484,38 +979,331 @@ def api_get_chapter_content(chapter_id):
 # Возвращает json с содержимым главы по номеру тома и номеру главы в определенном ранобе
 @app.route('/api/ranobe/<int:ranobe_id>/volumes/<int:volume_number>/chapters/<int:chapter_number>', methods=['GET'])
 def api_get_chapter_content2(ranobe_id, volume_number, chapter_number):
-    db_sess = db_session.create_session()
-    try:
-        volume = db_sess.query(Volume).filter(
+    def lookup(db_sess):
+        return repository.get_chapter_stamp(
+            db_sess,
+            Volume.ranobe_id == ranobe_id,
+            Volume.volume_number == volume_number,
+            Chapter.chapter_number == chapter_number
+        )
+
+    def not_found(db_sess):
+        volume = db_sess.query(Volume.id).filter(
             Volume.ranobe_id == ranobe_id,
             Volume.volume_number == volume_number
         ).first()
+        return 'Chapter not found' if volume else 'Volume not found'
 
-        if not volume:
-            return jsonify({'error': 'Volume not found'}), 404
+    try:
+        return chapter_content_response(
+            cache.chapter_by_number_key(ranobe_id, volume_number, chapter_number), lookup, not_found
+        )
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
-        chapter = db_sess.query(Chapter).filter(
-            Chapter.volume_id == volume.id,
-            Chapter.chapter_number == chapter_number
-        ).first()
 
-        if not chapter:
-            return jsonify({'error': 'Chapter not found'}), 404
+def chapter_batch_item(row):
+    return {
+        'id': row.id,
+        'title': row.title,
+        'chapter_number': row.chapter_number,
+        'content': row.content,
+        'volume_number': row.volume_number,
+        'ranobe_id': row.ranobe_id,
+        'reading_order': row.reading_order,
+        'prev_chapter_id': row.prev_chapter_id,
+        'next_chapter_id': row.next_chapter_id
+    }
+
+
+# сериализованные главы пачки, пока не исчерпан бюджет байтов (первая глава отдается всегда)
+def chapter_batch_lines(rows):
+    budget = CHAPTER_BATCH_MAX_BYTES
+    for row in rows:
+        line = json.dumps(chapter_batch_item(row), ensure_ascii=False).encode('utf-8')
+        if len(line) > budget and budget < CHAPTER_BATCH_MAX_BYTES:
+            return
+        budget -= len(line)
+        yield line
+
+
+# пачка глав json-массивом или, при ?format=ndjson, потоком по строке на главу.
+# load(db_sess) возвращает строки repository.get_chapter_batch в нужном порядке.
+# Если пачка не уместилась в CHAPTER_BATCH_MAX_BYTES, ответ короче запрошенного:
+# в json это отмечает заголовок X-Truncated, в ndjson - меньшее число строк
+def chapter_batch_response(load):
+    if request.args.get('format', 'json') == 'ndjson':
+        def stream():
+            db_sess = db_session.create_session()
+            try:
+                for line in chapter_batch_lines(load(db_sess)):
+                    yield line + b'\n'
+            finally:
+                db_sess.close()
+
+        return app.response_class(stream(), mimetype='application/x-ndjson')
 
-        return jsonify({
-            'id': chapter.id,
-            'title': chapter.title,
-            'chapter_number': chapter.chapter_number,
-            'content': chapter.content,
-            'volume_number': volume.volume_number,
-            'ranobe_id': volume.ranobe_id
-        })
+    db_sess = db_session.create_session()
+    try:
+        rows = list(load(db_sess))
+        lines = list(chapter_batch_lines(rows))
+    finally:
+        db_sess.close()
+    response = app.response_class(b'[' + b','.join(lines) + b']', mimetype='application/json')
+    if len(lines) < len(rows):
+        response.headers['X-Truncated'] = '1'
+    return response
+
+
+# Возвращает несколько глав по ID: ?ids=1,2,3 (не больше CHAPTER_BATCH_MAX), ?format=json|ndjson.
+# Главы идут в порядке ids, отсутствующие пропускаются
+@app.route('/api/chapters', methods=['GET'])
+def api_get_chapters():
+    try:
+        ids = list(dict.fromkeys(int(id) for id in request.args.get('ids', '').split(',') if id.strip()))
+    except ValueError:
+        return jsonify({'error': 'ids must be a comma-separated list of integers'}), 400
+    if not ids:
+        return jsonify({'error': 'ids is required'}), 400
+    if len(ids) > CHAPTER_BATCH_MAX:
+        return jsonify({'error': f'At most {CHAPTER_BATCH_MAX} chapters per request'}), 400
+    if request.args.get('format', 'json') not in ('json', 'ndjson'):
+        return jsonify({'error': 'format must be json or ndjson'}), 400
+
+    def load(db_sess):
+        rows = {row.id: row for row in repository.get_chapter_batch(db_sess, Chapter.id.in_(ids))}
+        return [rows[id] for id in ids if id in rows]
+
+    return chapter_batch_response(load)
+
+
+# Возвращает count глав ранобе подряд в порядке чтения, начиная с позиции from (с 1).
+# Позиция главы - поле reading_order; следующая пачка начинается с reading_order последней + 1
+@app.route('/api/ranobe/<int:ranobe_id>/chapters', methods=['GET'])
+def api_get_ranobe_chapters(ranobe_id):
+    start = request.args.get('from', 1, type=int)
+    count = request.args.get('count', CHAPTER_BATCH_MAX, type=int)
+    if start < 1 or not 1 <= count <= CHAPTER_BATCH_MAX:
+        return jsonify({'error': f'from must be positive and count between 1 and {CHAPTER_BATCH_MAX}'}), 400
+    if request.args.get('format', 'json') not in ('json', 'ndjson'):
+        return jsonify({'error': 'format must be json or ndjson'}), 400
+
+    db_sess = db_session.create_session()
+    try:
+        if not db_sess.query(Ranobe.id).filter(Ranobe.id == ranobe_id).first():
+            return jsonify({'error': 'Ranobe not found'}), 404
+    finally:
+        db_sess.close()
+
+    def load(db_sess):
+        return repository.get_chapter_batch(
+            db_sess,
+            Chapter.ranobe_id == ranobe_id,
+            Chapter.reading_order >= start,
+            Chapter.reading_order < start + count
+        ).order_by(Chapter.reading_order).yield_per(10)
+
+    return chapter_batch_response(load)
+
+
+# выгрузка всего ранобе одним файлом, ?format=epub|fb2|txt
+@app.route('/api/ranobe/<int:ranobe_id>/export', methods=['GET'])
+def api_export_ranobe(ranobe_id):
+    return export_response(lambda db_sess: export.find_book(db_sess, ranobe_id))
+
+
+# выгрузка одного тома
+@app.route('/api/ranobe/<int:ranobe_id>/volumes/<int:volume_number>/export', methods=['GET'])
+def api_export_volume(ranobe_id, volume_number):
+    return export_response(lambda db_sess: export.find_book(db_sess, ranobe_id, volume_number))
+
+
+# готовый файл отдается с диска, иначе выгрузка строится потоком и заодно сохраняется
+def export_response(lookup):
+    format = request.args.get('format', 'epub')
+    if format not in export.FORMATS:
+        return jsonify({'error': f"format must be one of: {', '.join(export.FORMATS)}"}), 400
+
+    db_sess = db_session.create_session()
+    try:
+        book = lookup(db_sess)
+    finally:
+        db_sess.close()
+    if not book:
+        return jsonify({'error': 'Ranobe or volume not found'}), 404
+
+    etag = book.etag(format)
+    cached = not_modified(etag, book.updated_date, EXPORT_CACHE_CONTROL)
+    if cached:
+        return cached
+
+    path = export.cached_path(book, format)
+    if os.path.exists(path):
+        response = send_file(os.path.abspath(path), mimetype=export.FORMATS[format], as_attachment=True,
+                             download_name=book.filename(format), etag=False, conditional=False)
+    else:
+        response = app.response_class(export.generate(book, format), mimetype=export.FORMATS[format])
+        response.headers.set('Content-Disposition', 'attachment', filename=book.filename(format))
+    return set_cache_headers(response, etag, book.updated_date, EXPORT_CACHE_CONTROL)
+
+
+# Лента изменений ранобе, томов и глав по возрастанию номера изменения (см. data/changes.py):
+# [{"type", "id", "deleted", "updated_at", ...}], у живых томов и глав - их адрес в API.
+# ?since= - курсор из прошлого ответа (без него - с начала), ?limit=.
+# X-Next-Cursor есть всегда - с него продолжать в следующий раз; Link - если страница не последняя
+@app.route('/api/changes', methods=['GET'])
+def api_get_changes():
+    try:
+        limit = parse_limit(request.args.get('limit'), CHANGES_PAGE_SIZE, CHANGES_MAX_PAGE_SIZE)
+        since = decode_offset(request.args.get('since'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    db_sess = db_session.create_session()
+    try:
+        items, has_more, last_id = changes.get_page(db_sess, since, limit)
+        next_cursor = encode_cursor(last_id)
+        response = jsonify(items)
+        response.headers['X-Next-Cursor'] = next_cursor
+        if has_more:
+            next_url = url_for('api_get_changes', since=next_cursor, limit=limit, _external=True)
+            response.headers['Link'] = f'<{next_url}>; rel="next"'
+        return response
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        db_sess.close()
+
+
+# Возвращает json со страницей результатов поиска
+# ?q= - запрос, ?type=ranobe|chapter - где искать, ?limit=, ?cursor= - как в /api/ranobe
+@app.route('/api/search', methods=['GET'])
+def api_search():
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': 'Query is required'}), 400
+
+    kind = request.args.get('type')
+    if kind not in (None, search.RANOBE, search.CHAPTER):
+        return jsonify({'error': 'type must be ranobe or chapter'}), 400
+
+    try:
+        limit = parse_limit(request.args.get('limit'), SEARCH_PAGE_SIZE, SEARCH_MAX_PAGE_SIZE)
+        offset = decode_offset(request.args.get('cursor'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    db_sess = db_session.create_session()
+    try:
+        results, has_more = search.search(db_sess, query, kind, offset, limit)
+        response = jsonify(results)
+        if has_more:
+            response.headers['X-Next-Cursor'] = encode_cursor(offset + limit)
+        return response
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
         db_sess.close()
 
 
+# массовый импорт глав: тело запроса - JSON lines, по объекту на главу
+# ({"title", "content", "chapter_number"?, "volume_number"?}).
+# ?volume= - том по умолчанию, ?skip_existing=1 - пропускать уже существующие главы
+# (повторная отправка после обрыва). Каждая пачка коммитится отдельно
+@app.route('/api/ranobe/<int:ranobe_id>/import', methods=['POST'])
+@login_required
+def api_import_chapters(ranobe_id):
+    db_sess = db_session.create_session()
+    try:
+        ranobe = db_sess.query(Ranobe).get(ranobe_id)
+        if not ranobe:
+            return jsonify({'error': 'Ranobe not found'}), 404
+        if current_user.id != ranobe.author_id and current_user.id != 1:
+            return jsonify({'error': 'Forbidden'}), 403
+
+        importer = chapter_import.ChapterImporter(
+            db_sess, ranobe_id,
+            volume_number=request.args.get('volume', type=int),
+            skip_existing=request.args.get('skip_existing') == '1'
+        )
+        try:
+            summary = importer.run(chapter_import.read_jsonl(request.stream))
+            status = 200
+        except chapter_import.ChapterImportError as e:
+            summary = {'error': str(e), 'imported': importer.imported, 'skipped': importer.skipped}
+            status = 400
+        if importer.imported:
+            cache.invalidate(cache.ranobe_keys(db_sess, ranobe_id))
+            cache.invalidate_catalogue()
+        return jsonify(summary), status
+    finally:
+        db_sess.close()
+
+
+# позиции чтения текущего пользователя по всем ранобе, последние сверху
+@app.route('/api/progress', methods=['GET'])
+@login_required
+def api_get_all_progress():
+    db_sess = db_session.create_session()
+    try:
+        return jsonify(reading_progress.get_progress(db_sess, current_user.id))
+    finally:
+        db_sess.close()
+
+
+# позиция чтения текущего пользователя в ранобе
+@app.route('/api/ranobe/<int:ranobe_id>/progress', methods=['GET'])
+@login_required
+def api_get_progress(ranobe_id):
+    db_sess = db_session.create_session()
+    try:
+        progress = reading_progress.get_progress(db_sess, current_user.id, ranobe_id=ranobe_id)
+        if not progress:
+            return jsonify({'error': 'Progress not found'}), 404
+        return jsonify(progress[0])
+    finally:
+        db_sess.close()
+
+
+# сохранить позицию: {"chapter_id": ..., "scroll_offset": 0..1}.
+# Запись попадает в буфер и сохраняется в БД пачкой вместе с остальными (см. data/reading_progress.py)
+@app.route('/api/ranobe/<int:ranobe_id>/progress', methods=['PUT'])
+@login_required
+def api_put_progress(ranobe_id):
+    data = request.get_json(silent=True) or {}
+    chapter_id = data.get('chapter_id')
+    scroll_offset = data.get('scroll_offset', 0)
+    if not isinstance(chapter_id, int) or isinstance(scroll_offset, bool) \
+            or not isinstance(scroll_offset, (int, float)) or not 0 <= scroll_offset <= 1:
+        return jsonify({'error': 'chapter_id must be an integer and scroll_offset a number between 0 and 1'}), 400
+
+    db_sess = db_session.create_session()
+    try:
+        chapter = db_sess.query(Chapter.id).filter(Chapter.id == chapter_id, Chapter.ranobe_id == ranobe_id).first()
+        if not chapter:
+            return jsonify({'error': 'Chapter not found'}), 404
+    finally:
+        db_sess.close()
+
+    entry = reading_progress.record(current_user.id, ranobe_id, chapter_id, float(scroll_offset))
+    return jsonify({'ranobe_id': ranobe_id, 'chapter_id': chapter_id, 'scroll_offset': entry['scroll_offset'],
+                    'updated_at': entry['updated_at'].isoformat()}), 202
+
+
+# метрики процесса в формате Prometheus
+@app.route('/metrics')
+def prometheus_metrics():
+    if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+        abort(403)
+    return app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+# счетчики кэша ответов
+@app.route('/api/cache/stats', methods=['GET'])
+def api_cache_stats():
+    return jsonify(cache.stats())
+
+
 @app.errorhandler(404)
 def not_found(error):
     return render_template('404.html'), 404
@@ -526,8 +1314,11 @@ def forbidden(error):
     return render_template('403.html'), 403
 
 
+# сервер разработки; для боевого запуска - gunicorn -c gunicorn.conf.py server:app
 def main():
-    db_session.global_init("db/ranobe.db")
+    db_session.global_init(os.environ.get('RANOBE_DB', "db/ranobe.db"), os.environ.get('RANOBE_DB_PROFILE', 'tuned'))
+    fragments.precompile(app.jinja_env)
+    deletion.wake()
     app.run(port=8080, host='127.0.0.1')
 
 
@@ -22,4 +22,5 @@ fi
 $VIRTUALENV/bin/pip install -r requirements.txt
 
 # Run your glorious application
-$VIRTUALENV/bin/python3 server.py
+# (gunicorn.conf.py: workers, threads and the rest are set via RANOBE_* variables)
+$VIRTUALENV/bin/gunicorn -c gunicorn.conf.py server:app
@@ -0,0 +1,120 @@
+import contextlib
+import os
+import sys
+
+import pytest
+import sqlalchemy as sa
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Общие фикстуры: приложение на временной БД (одна на весь прогон - движок в
+# data/db_session.py глобальный), владелец ранобе, тестовые ранобе и счетчик SQL-запросов.
+
+PASSWORD = 'password'
+
+
+@pytest.fixture(scope='session')
+def app(tmp_path_factory):
+    from data import db_session
+
+    db_session.global_init(str(tmp_path_factory.mktemp('db') / 'test.db'))
+    import server
+
+    server.app.config.update(TESTING=True, WTF_CSRF_ENABLED=False)
+    return server.app
+
+
+@pytest.fixture(scope='session')
+def engine(app):
+    from data import db_session
+
+    db_sess = db_session.create_session()
+    try:
+        return db_sess.get_bind()
+    finally:
+        db_sess.close()
+
+
+@pytest.fixture(scope='session')
+def author(app):
+    from data import db_session
+    from data.users import User
+
+    db_sess = db_session.create_session()
+    try:
+        user = User(username='author', email='author@example.com')
+        user.set_password(PASSWORD)
+        db_sess.add(user)
+        db_sess.commit()
+        return user.id
+    finally:
+        db_sess.close()
+
+
+# make_ranobe(size) - ранобе из двух томов по size глав; у первой главы size
+# комментариев с ответами. Возвращает id ранобе, первого тома и первой главы
+@pytest.fixture(scope='session')
+def make_ranobe(app, author):
+    from data import db_session, reading_order
+    from data.chapter import Chapter
+    from data.comment import Comment
+    from data.ranobe import Ranobe
+    from data.volume import Volume
+
+    def make(size):
+        db_sess = db_session.create_session()
+        try:
+            ranobe = Ranobe(title=f'Ranobe {size}', description='description', author_id=author)
+            db_sess.add(ranobe)
+            db_sess.flush()
+            chapters = []
+            for volume_number in (1, 2):
+                volume = Volume(volume_number=volume_number, ranobe_id=ranobe.id, title=f'Том {volume_number}')
+                db_sess.add(volume)
+                db_sess.flush()
+                for number in range(1, size + 1):
+                    chapter = Chapter(title=f'Глава {number}', content=f'Текст главы {number}\nВторой абзац',
+                                      chapter_number=number, volume_id=volume.id)
+                    db_sess.add(chapter)
+                    chapters.append(chapter)
+            db_sess.flush()
+            reading_order.reindex_ranobe(db_sess, ranobe.id)
+
+            chapter = chapters[0]
+            for number in range(size):
+                comment = Comment(content=f'Комментарий {number}', user_id=author, chapter_id=chapter.id)
+                db_sess.add(comment)
+                db_sess.flush()
+                db_sess.add(Comment(content='Ответ', user_id=author, chapter_id=chapter.id, parent_id=comment.id))
+            db_sess.commit()
+            return {'ranobe': ranobe.id, 'volume': chapter.volume_id, 'chapter': chapter.id}
+        finally:
+            db_sess.close()
+
+    return make
+
+
+@pytest.fixture
+def author_client(app, author):
+    client = app.test_client()
+    client.post('/login', data={'email': 'author@example.com', 'password': PASSWORD})
+    return client
+
+
+# SQL-запросы, выполненные внутри блока with: пары (текст, параметры)
+@pytest.fixture
+def count_queries(engine):
+    @contextlib.contextmanager
+    def counter():
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append((statement, parameters))
+
+        sa.event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            sa.event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+    return counter
@@ -0,0 +1,19 @@
+from data import auth
+
+from conftest import PASSWORD
+
+
+def test_email_is_matched_without_case(app, author):
+    user = auth.authenticate(' Author@Example.COM ', PASSWORD, '10.0.0.1')
+    assert user is not None and user.id == author
+
+
+# неизвестный email проверяется так же долго, как известный: хэш считается всегда
+def test_unknown_email_still_checks_a_hash(app, monkeypatch):
+    checked = []
+    check = auth.check_password_hash
+    monkeypatch.setattr(auth, 'check_password_hash',
+                        lambda password_hash, password: checked.append(password_hash) or check(password_hash, password))
+
+    assert auth.authenticate('nobody@example.com', PASSWORD, '10.0.0.2') is None
+    assert checked == [auth._dummy_hash]
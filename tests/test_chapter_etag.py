@@ -0,0 +1,45 @@
+import pytest
+
+from data import cache, db_session
+from data.volume import Volume
+
+# Страница главы показывает названия ранобе, тома и соседних глав, поэтому после их
+# изменения условный GET со старым ETag должен получить новую страницу, а не 304.
+
+
+def rename_ranobe(client, ids):
+    response = client.post(f'/edit_ranobe/{ids["ranobe"]}', data={'title': 'Новое название ранобе'})
+    assert response.status_code == 302
+
+
+def rename_volume(client, ids):
+    db_sess = db_session.create_session()
+    try:
+        db_sess.query(Volume).get(ids['volume']).title = 'Новое название тома'
+        db_sess.commit()
+        cache.invalidate(cache.ranobe_keys(db_sess, ids['ranobe']))
+    finally:
+        db_sess.close()
+
+
+# следующая глава первого тома - id первой главы + 1 (главы тома создаются подряд)
+def rename_next_chapter(client, ids):
+    response = client.post(f'/edit_chapter/{ids["chapter"] + 1}', data={
+        'title': 'Новое название соседа', 'content': 'Текст главы 2', 'chapter_number': 2
+    })
+    assert response.status_code == 302
+
+
+@pytest.mark.parametrize('edit', [rename_ranobe, rename_volume, rename_next_chapter])
+def test_chapter_page_etag_changes_with_shown_titles(app, author_client, make_ranobe, edit):
+    ids = make_ranobe(2)
+    reader = app.test_client()
+    url = f'/chapter/{ids["chapter"]}'
+
+    etag = reader.get(url).headers['ETag']
+    assert reader.get(url, headers={'If-None-Match': etag}).status_code == 304
+
+    edit(author_client, ids)
+    response = reader.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
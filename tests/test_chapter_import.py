@@ -0,0 +1,70 @@
+import pytest
+
+from data import chapter_import, counters, db_session, reading_order
+from data.chapter import Chapter
+from data.ranobe import Ranobe
+from data.volume import Volume
+
+# Импорт пересчитывает порядок чтения и счетчики один раз после последней пачки;
+# при ошибке - для пачек, записанных до нее.
+
+
+def import_items(ranobe_id, items, batch_size=2):
+    db_sess = db_session.create_session()
+    try:
+        importer = chapter_import.ChapterImporter(db_sess, ranobe_id, volume_number=1, batch_size=batch_size)
+        return importer.run(items)
+    finally:
+        db_sess.close()
+
+
+# позиции глав в порядке томов и номеров - должны идти подряд с 1
+def assert_contiguous(ranobe_id):
+    db_sess = db_session.create_session()
+    try:
+        positions = [position for position, in db_sess.query(Chapter.reading_order)
+                     .join(Volume, Chapter.volume_id == Volume.id)
+                     .filter(Volume.ranobe_id == ranobe_id)
+                     .order_by(Volume.volume_number, Chapter.chapter_number)]
+    finally:
+        db_sess.close()
+    assert positions == list(range(1, len(positions) + 1))
+
+
+def chapter_counts(ranobe_id):
+    db_sess = db_session.create_session()
+    try:
+        volumes = db_sess.query(Volume.chapter_count).filter(Volume.ranobe_id == ranobe_id) \
+            .order_by(Volume.volume_number).all()
+        return db_sess.query(Ranobe).get(ranobe_id).chapter_count, [count for count, in volumes]
+    finally:
+        db_sess.close()
+
+
+def test_import_between_existing_chapters(make_ranobe, monkeypatch):
+    ids = make_ranobe(2)
+    calls = []
+    for module, name in ((reading_order, 'reindex_ranobe'), (counters, 'recompute')):
+        original = getattr(module, name)
+        monkeypatch.setattr(module, name, lambda *args, original=original, name=name, **kwargs:
+                            calls.append((name, kwargs.get('since'))) or original(*args, **kwargs))
+
+    items = [{'title': f'Глава {number}', 'content': 'Текст', 'chapter_number': number} for number in (5, 3, 4)]
+    assert import_items(ids['ranobe'], items) == {'imported': 3, 'skipped': 0}
+
+    # две пачки, но один пересчет - с места самой ранней новой главы
+    assert calls == [('reindex_ranobe', (1, 3)), ('recompute', None)]
+
+    assert_contiguous(ids['ranobe'])
+    assert chapter_counts(ids['ranobe']) == (7, [5, 2])
+
+
+def test_failed_import_keeps_written_batches_consistent(make_ranobe):
+    ids = make_ranobe(2)
+    items = [{'title': 'Глава 3', 'content': 'Текст'}, {'title': 'Глава 4', 'content': 'Текст'},
+             {'title': '', 'content': 'Текст'}]
+    with pytest.raises(chapter_import.ChapterImportError):
+        import_items(ids['ranobe'], items)
+
+    assert_contiguous(ids['ranobe'])
+    assert chapter_counts(ids['ranobe']) == (6, [4, 2])
@@ -0,0 +1,33 @@
+from data import cache, db_session, deletion, search
+
+# Ранобе в очереди на удаление пропадает сразу: страницы ранобе, тома и глав
+# отвечают 404, а главы не находятся поиском, пока фоновый поток еще удаляет их пачками.
+
+
+def found_chapters(query):
+    db_sess = db_session.create_session()
+    try:
+        return {result['id'] for result in search.search(db_sess, query, search.CHAPTER, limit=1000)[0]}
+    finally:
+        db_sess.close()
+
+
+def test_pending_ranobe_pages_are_not_found(app, make_ranobe):
+    ids = make_ranobe(2)
+    reader = app.test_client()
+    urls = [f'/ranobe/{ids["ranobe"]}', f'/volume/{ids["volume"]}', f'/chapter/{ids["chapter"]}']
+    for url in urls:
+        assert reader.get(url).status_code == 200
+    assert ids['chapter'] in found_chapters('Текст главы')
+
+    db_sess = db_session.create_session()
+    try:
+        deletion.schedule(db_sess, ids['ranobe'])
+        db_sess.commit()
+        cache.invalidate(cache.ranobe_keys(db_sess, ids['ranobe']))
+    finally:
+        db_sess.close()
+
+    for url in urls:
+        assert reader.get(url).status_code == 404
+    assert ids['chapter'] not in found_chapters('Текст главы')
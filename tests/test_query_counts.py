@@ -0,0 +1,48 @@
+import pytest
+
+from data import fragments
+
+# Число запросов страницы не должно зависеть от размера данных: ранобе с N и с
+# 10N главами и комментариями обслуживаются одинаковым числом SELECT (без N+1).
+
+N = 5
+
+
+@pytest.fixture(scope='module')
+def datasets(make_ranobe):
+    return {'small': make_ranobe(N), 'large': make_ranobe(10 * N)}
+
+
+# число запросов повторного GET: первый прогревает кэши процесса, а кэш
+# фрагментов сбрасывается, чтобы шаблон снова обошел все объекты
+def get_queries(client, count_queries, url):
+    assert client.get(url).status_code == 200
+    fragments.clear()
+    with count_queries() as statements:
+        assert client.get(url).status_code == 200
+    return len(statements)
+
+
+@pytest.mark.parametrize('url', [
+    '/chapter/{chapter}',
+    '/volume/{volume}',
+    '/ranobe/{ranobe}',
+    '/edit_chapter/{chapter}',
+])
+def test_page_queries_do_not_grow_with_data(author_client, count_queries, datasets, url):
+    small = get_queries(author_client, count_queries, url.format(**datasets['small']))
+    large = get_queries(author_client, count_queries, url.format(**datasets['large']))
+    assert small == large
+
+
+def test_edit_chapter_post_queries_do_not_grow_with_data(author_client, count_queries, datasets):
+    counts = []
+    for name in ('small', 'large'):
+        chapter_id = datasets[name]['chapter']
+        with count_queries() as statements:
+            response = author_client.post(f'/edit_chapter/{chapter_id}', data={
+                'title': 'Новое название', 'content': f'Новый текст {name}', 'chapter_number': 1
+            })
+        assert response.status_code == 302
+        counts.append(len(statements))
+    assert counts[0] == counts[1]
@@ -0,0 +1,137 @@
+import re
+
+import pytest
+
+from data import cache, changes, db_session, reading_order, reading_progress, repository, search
+from data.chapter import Chapter
+from data.ranobe import Ranobe
+from data.volume import Volume
+
+# Каждый запрос data/repository.py и других модулей чтения, а также запросы самих
+# маршрутов server.py должны находить строки ранобе, томов, глав (и их страниц),
+# комментариев, прогресса чтения и ленты изменений по индексу: в EXPLAIN QUERY PLAN
+# у этих таблиц только SEARCH ... USING [COVERING] INDEX (или по первичному ключу)
+# и ни одного SCAN. Постраничные выдачи проверяются со второй страницы (с курсором).
+
+INDEXED_TABLES = ('ranobe', 'volumes', 'chapters', 'chapter_pages', 'comments', 'reading_progress', 'changes')
+PLAN_LINE = re.compile(r'^(SCAN|SEARCH) (\w+?)(?:_\d+)?(?: AS \w+)?(?: |$)')
+INDEX_ACCESS = ('USING INDEX', 'USING COVERING INDEX', 'USING INTEGER PRIMARY KEY', 'USING PRIMARY KEY')
+
+
+@pytest.fixture(scope='module')
+def ranobe(make_ranobe):
+    return make_ranobe(3)
+
+
+def neighbours(db_sess, chapter_id):
+    return reading_order.get_neighbours(db_sess, db_sess.query(Chapter).get(chapter_id))
+
+
+def repository_calls(ranobe):
+    import server
+
+    ranobe_id, volume_id, chapter_id = ranobe['ranobe'], ranobe['volume'], ranobe['chapter']
+    return {
+        'get_chapter': lambda db_sess: repository.get_chapter(db_sess, chapter_id),
+        'get_chapter_pages': lambda db_sess: repository.get_chapter_pages(db_sess, chapter_id),
+        'get_chapter_page': lambda db_sess: repository.get_chapter_page(db_sess, chapter_id, 1),
+        'get_chapter_html': lambda db_sess: repository.get_chapter_html(db_sess, chapter_id, [0], 0, 100),
+        'get_chapter_owner': lambda db_sess: repository.get_chapter_owner(db_sess, chapter_id),
+        'get_next_chapter_number': lambda db_sess: repository.get_next_chapter_number(db_sess, volume_id),
+        'get_chapter_stamp': lambda db_sess: repository.get_chapter_stamp(db_sess, Chapter.id == chapter_id),
+        'get_chapter_stamp_by_number': lambda db_sess: repository.get_chapter_stamp(
+            db_sess, Volume.ranobe_id == ranobe_id, Volume.volume_number == 1, Chapter.chapter_number == 1),
+        'get_comments_stamp': lambda db_sess: repository.get_comments_stamp(db_sess, chapter_id),
+        'get_comment_page': lambda db_sess: repository.get_comment_page(db_sess, chapter_id),
+        'get_comment_replies': lambda db_sess: repository.get_comment_page(db_sess, chapter_id, parent_id=1),
+        'get_volume': lambda db_sess: repository.get_volume(db_sess, volume_id),
+        'get_volume_chapters': lambda db_sess: repository.get_volume_chapters(db_sess, volume_id),
+        'get_ranobe_volumes': lambda db_sess: repository.get_ranobe_volumes(db_sess, ranobe_id),
+        'get_chapter_batch': lambda db_sess: repository.get_chapter_batch(
+            db_sess, Chapter.id.in_([chapter_id])).all(),
+        'get_chapter_batch_range': lambda db_sess: repository.get_chapter_batch(
+            db_sess, Chapter.ranobe_id == ranobe_id, Chapter.reading_order >= 1, Chapter.reading_order < 3
+        ).order_by(Chapter.reading_order).all(),
+        'get_ranobe_page': lambda db_sess: server.get_ranobe_page(
+            db_sess, (Ranobe.id, Ranobe.title), server.encode_cursor('', 0)),
+        'get_neighbours': lambda db_sess: neighbours(db_sess, chapter_id),
+        'chapter_keys': lambda db_sess: cache.chapter_keys(db_sess, chapter_id),
+        'ranobe_keys': lambda db_sess: cache.ranobe_keys(db_sess, ranobe_id),
+        'changes_page': lambda db_sess: changes.get_page(db_sess, 1, 20),
+        'search': lambda db_sess: search.search(db_sess, 'Глава'),
+        'get_progress': lambda db_sess: reading_progress.get_progress(db_sess, 1, ranobe_id=ranobe_id),
+    }
+
+
+CALLS = list(repository_calls({'ranobe': 0, 'volume': 0, 'chapter': 0}))
+
+# запросы маршрутов, в том числе написанные прямо в server.py
+URLS = [
+    '/?cursor={catalogue_cursor}',
+    '/ranobe/{ranobe}',
+    '/volume/{volume}',
+    '/chapter/{chapter}',
+    '/search?q=Глава',
+    '/api/ranobe?cursor={catalogue_cursor}',
+    '/api/chapters/{chapter}',
+    '/api/chapters/{chapter}/content',
+    '/api/chapters/{chapter}/comments',
+    '/api/chapters?ids={chapter}',
+    '/api/ranobe/{ranobe}/chapters?from=1&count=2',
+    '/api/ranobe/{ranobe}/volumes/1/chapters',
+    '/api/ranobe/{ranobe}/volumes/1/chapters/1',
+    '/api/changes?since={changes_cursor}',
+    '/api/search?q=Глава',
+    '/api/progress',
+    '/api/ranobe/{ranobe}/progress',
+]
+
+
+def run_call(count_queries, call):
+    db_sess = db_session.create_session()
+    try:
+        with count_queries() as statements:
+            call(db_sess)
+    finally:
+        db_sess.close()
+    return statements
+
+
+# строки плана для таблиц из INDEXED_TABLES во всех запросах
+def plan_lines(engine, statements):
+    assert statements
+    lines = []
+    with engine.connect() as conn:
+        for statement, parameters in statements:
+            for row in conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters):
+                match = PLAN_LINE.match(row[-1])
+                if match and match.group(2) in INDEXED_TABLES:
+                    lines.append(row[-1])
+    return lines
+
+
+def assert_index_access(lines):
+    assert lines
+    for line in lines:
+        assert not line.startswith('SCAN'), line
+        assert any(access in line for access in INDEX_ACCESS), line
+
+
+@pytest.mark.parametrize('name', CALLS)
+def test_repository_query_uses_indexes(engine, count_queries, ranobe, name):
+    assert_index_access(plan_lines(engine, run_call(count_queries, repository_calls(ranobe)[name])))
+
+
+@pytest.mark.parametrize('url', URLS)
+def test_route_queries_use_indexes(engine, count_queries, author, author_client, ranobe, url):
+    import server
+
+    # позиция чтения, чтобы выдаче прогресса было что читать; кэши ответов сбрасываются
+    reading_progress.record(author, ranobe['ranobe'], ranobe['chapter'], 0.5)
+    reading_progress.flush()
+    cache.invalidate(prefixes=('',))
+    url = url.format(catalogue_cursor=server.encode_cursor('', 0), changes_cursor=server.encode_cursor(1), **ranobe)
+
+    with count_queries() as statements:
+        assert author_client.get(url).status_code == 200
+    assert_index_access(plan_lines(engine, statements))
@@ -0,0 +1,48 @@
+from data import db_session
+from data.chapter import Chapter
+from data.volume import Volume
+
+# Маршруты пересчитывают только хвост порядка чтения после измененного места;
+# после любых правок позиции должны совпадать с полным пересчетом: 1, 2, 3...
+# по томам и номерам глав.
+
+
+def chapters_in_order(ranobe_id):
+    db_sess = db_session.create_session()
+    try:
+        return db_sess.query(Chapter.id, Chapter.reading_order) \
+            .join(Volume, Chapter.volume_id == Volume.id) \
+            .filter(Volume.ranobe_id == ranobe_id) \
+            .order_by(Volume.volume_number, Chapter.chapter_number, Chapter.id) \
+            .all()
+    finally:
+        db_sess.close()
+
+
+def assert_contiguous(ranobe_id):
+    positions = [row.reading_order for row in chapters_in_order(ranobe_id)]
+    assert positions == list(range(1, len(positions) + 1))
+
+
+def test_reading_order_after_chapter_edits(author_client, make_ranobe):
+    ids = make_ranobe(3)
+    ranobe_id, chapter_id = ids['ranobe'], ids['chapter']
+
+    # новая глава в середине первого тома сдвигает хвост
+    response = author_client.post(f'/ranobe/{ranobe_id}/add_chapter?volume_id={ids["volume"]}', data={
+        'title': 'Вставка', 'content': 'Текст', 'chapter_number': 2
+    })
+    assert response.status_code == 302
+    assert_contiguous(ranobe_id)
+
+    # перенос первой главы в конец тома и обратно
+    for number, position in ((10, 4), (1, 1)):
+        response = author_client.post(f'/edit_chapter/{chapter_id}', data={
+            'title': 'Глава', 'content': 'Текст', 'chapter_number': number
+        })
+        assert response.status_code == 302
+        assert_contiguous(ranobe_id)
+        assert chapters_in_order(ranobe_id)[position - 1].id == chapter_id
+
+    assert author_client.get(f'/delete_chapter/{chapter_id + 1}').status_code == 302
+    assert_contiguous(ranobe_id)
@@ -0,0 +1,47 @@
+import sqlalchemy as sa
+
+from data import db_session, search
+
+# Индекс поиска хранит только слова (content=''): при правке и удалении FTS5
+# получает прежние значения, а подсветка строится по исходным строкам.
+
+
+def find(query):
+    db_sess = db_session.create_session()
+    try:
+        return search.search(db_sess, query)[0]
+    finally:
+        db_sess.close()
+
+
+def check_index():
+    db_sess = db_session.create_session()
+    try:
+        db_sess.execute(sa.text("INSERT INTO search_index (search_index, rank) VALUES ('integrity-check', 0)"))
+    finally:
+        db_sess.close()
+
+
+def test_index_follows_chapter_edits(author_client, make_ranobe):
+    ids = make_ranobe(2)
+    chapter_id = ids['chapter']
+
+    response = author_client.post(f'/edit_chapter/{chapter_id}', data={
+        'title': 'Северный перевал', 'content': 'Караван поднимался к перевалу', 'chapter_number': 1
+    })
+    assert response.status_code == 302
+    check_index()
+
+    results = [result for result in find('караван') if result['id'] == chapter_id]
+    assert results and results[0]['snippet'] == '<mark>Караван</mark> поднимался к перевалу'
+    assert [result['title'] for result in find('северный перевал')] == ['<mark>Северный</mark> <mark>перевал</mark>']
+
+    response = author_client.post(f'/edit_chapter/{chapter_id}', data={
+        'title': 'Глава 1', 'content': 'Текст главы 1', 'chapter_number': 1
+    })
+    assert response.status_code == 302
+    check_index()
+    assert find('караван') == []
+
+    assert author_client.get(f'/delete_chapter/{chapter_id}').status_code == 302
+    check_index()